@@ -0,0 +1,22 @@
+import os
+import tensorflow as tf
+import utils.autotune as autotune
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       autotune thread pools and batch sizes for the PNVAE config of train_AE.py on this host
+#       the result is cached (utils/autotune.py : DEFAULT_CACHE_PATH) and picked up by training and scoring
+# ********************************************************
+
+nodes_n, feat_sz = 100, 3
+max_memory_mb = 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**2
+
+setting = pnvae_setting(nodes_n, feat_sz,
+                        knn_engines=['exact', 'exact', 'exact'], # as train_AE.py, these enter the cost of a step
+                        recompute_blocks=[False, False, False],
+                        fused_edgeconv=False)
+
+if __name__ == '__main__':
+    best = autotune.autotune(setting, batch_sizes=(64, 128, 256, 512, 1024), inter_threads=(1, 2), n_steps=5, max_memory_mb=max_memory_mb)
+    print('best training config: ', best['train'])
+    print('best scoring config: ', best['score'])
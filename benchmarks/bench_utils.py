@@ -0,0 +1,34 @@
+import os, sys
+import time
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def make_setting(nodes_n=100, feat_sz=3, **overrides):
+    ''' PNVAE setting as used in train_AE.py, any attribute can be overridden '''
+    from utils.settings import pnvae_setting
+    return pnvae_setting(nodes_n, feat_sz, **overrides)
+
+
+def random_particles(n, nodes_n=100, feat_sz=3, seed=0):
+    ''' random jets with the shape of the training samples, for timing only '''
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n, nodes_n, feat_sz)).astype(np.float32)
+
+
+def time_call(fn, n_repeat=5, n_warmup=1):
+    ''' median wall time in seconds of fn() '''
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def roc_auc(scores_bg, scores_sig):
+    from sklearn.metrics import roc_auc_score
+    labels = np.concatenate([np.zeros(len(scores_bg)), np.ones(len(scores_sig))])
+    return roc_auc_score(labels, np.concatenate([scores_bg, scores_sig]))
@@ -0,0 +1,66 @@
+import time
+import numpy as np
+import h5py
+import tensorflow as tf
+import bench_utils as bu
+import models.models as models
+import models.scoring as scoring
+import utils.preprocessing as prepr
+from utils.latent_index import LatentIndex
+
+# ********************************************************
+#       benchmark cascade scoring (cheap first stage -> PNVAE) vs PNVAE on all jets
+# ********************************************************
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+SIG_PATH = '/eos/project/d/dshep/TOPCLASS/DijetAnomaly/VAE_data/events/'
+SIG_NAME = 'RSGraviton_WW_NARROW_13TeV_PU40_3.5TeV_NEW'
+filename_sig = SIG_PATH + SIG_NAME + '_parts/' + SIG_NAME + '_concat_001.h5'
+PN_WEIGHTS_PATH = None  # PN_VAE_weights_*.hdf5
+GCN_WEIGHTS_PATH = None # weights_gcnae.*.hdf5, used if FIRST_STAGE == 'gcn'
+INDEX_PATH = 'latent_index_bg.npz' # from latent_index_benchmark.py, used if FIRST_STAGE == 'latent_index'
+FIRST_STAGE = 'gcn'
+
+n_calib, n_test = 20000, 5000
+bg_efficiencies = [0.5, 0.2, 0.1, 0.05]
+
+
+def build_first_stage(pnvae, nodes_n, feat_sz):
+    if FIRST_STAGE == 'latent_index':
+        return scoring.latent_index_scorer(pnvae, LatentIndex.load(INDEX_PATH))
+    gcnae = models.GCNAutoEncoder(nodes_n=nodes_n, feat_sz=feat_sz, activation=tf.nn.tanh, latent_dim=5)
+    dummy = np.zeros((1, nodes_n, feat_sz), dtype=np.float32)
+    gcnae((dummy, np.zeros((1, nodes_n, nodes_n), dtype=np.float32)))
+    if GCN_WEIGHTS_PATH is not None:
+        gcnae.load_weights(GCN_WEIGHTS_PATH)
+    return scoring.gcn_reco_scorer(gcnae)
+
+
+if __name__ == '__main__':
+    with h5py.File(filename_bg, 'r') as inFile:
+        particles_bg_calib = inFile['particle_bg_valid'][0:n_calib]
+        particles_bg_test = inFile['particle_bg_test'][0:n_test]
+    _,_, particles_sig = prepr.prepare_data_constituents(filename_sig,n_test,0,n_test)
+    particles_test = np.concatenate([particles_bg_test, particles_sig])
+    nodes_n, feat_sz = particles_bg_test.shape[1:]
+
+    pnvae = scoring.load_pnvae(bu.make_setting(nodes_n=nodes_n, feat_sz=feat_sz), PN_WEIGHTS_PATH)
+    full_stage = scoring.pn_reco_scorer(pnvae)
+    full_stage(particles_test[:1024]) # warmup / tracing
+
+    start = time.perf_counter()
+    full_scores = full_stage(particles_test)
+    full_time = time.perf_counter() - start
+    full_auc = bu.roc_auc(full_scores[:n_test], full_scores[n_test:])
+    print('PNVAE on all jets: {:.1f} jets/s, AUC = {:.4f}'.format(particles_test.shape[0]/full_time, full_auc))
+
+    cascade = scoring.CascadeScorer(build_first_stage(pnvae, nodes_n, feat_sz), full_stage)
+    for bg_eff in bg_efficiencies:
+        cascade.calibrate(particles_bg_calib, bg_eff)
+        start = time.perf_counter()
+        scores = cascade(particles_test)
+        cascade_time = time.perf_counter() - start
+        auc = bu.roc_auc(scores[:n_test], scores[n_test:])
+        print('cascade bg_eff={:.2f}: pass={:.3f}, {:.1f} jets/s (x{:.2f}), AUC = {:.4f} (diff {:+.4f})'.format(
+            bg_eff, cascade.stats['pass_fraction'], particles_test.shape[0]/cascade_time, full_time/cascade_time, auc, auc-full_auc))
@@ -0,0 +1,72 @@
+import sys
+import json
+import resource
+import subprocess
+import numpy as np
+
+# ********************************************************
+#       fused EdgeConv (setting.fused_edgeconv) vs the gather_nd / tile implementation : same weights, output agreement,
+#       then inference and train step time and measured peak memory, conv_params of train_AE.py, every configuration
+#       in a fresh process (peak device memory on GPU, peak RSS on CPU)
+# ********************************************************
+
+WEIGHTS_PATH = None # PN_VAE_weights_*.hdf5, random weights if None
+configs = {'none': False, 'auto': True, 'all': [True, True, True]} # auto : blocks with channels[0] <= C_in (pnae.fused_blocks)
+batch_sizes = [256, 1024]
+n_steps = 10
+
+
+def agreement():
+    import tensorflow as tf
+    import bench_utils as bu
+    import models.scoring as scoring
+    import models.inference as inference
+    import models.ParticleNetAE as pnae
+    models = {config: scoring.load_pnvae(bu.make_setting(fused_edgeconv=fused), WEIGHTS_PATH) for config, fused in configs.items()}
+    particles = bu.random_particles(1024, nodes_n=100, feat_sz=3)
+    points, features = tf.convert_to_tensor(particles[:,:,0:2]), tf.convert_to_tensor(particles)
+    z_ref, reco_ref = inference.reference_outputs(models['none'], points, features)
+    for config, model in models.items():
+        if config == 'none':
+            continue
+        model.set_weights(models['none'].get_weights()) # same checkpoint layout
+        z, reco = inference.reference_outputs(model, points, features)
+        print('fused {:>4s} {}: max |dz_mean| = {:.2e}, max |dreco| = {:.2e}'.format(config, [int(f) for f in pnae.fused_blocks(model.setting)],
+              np.max(np.abs(z_ref - z)), np.max(np.abs(reco_ref - reco))))
+
+
+def run(config, batch_size):
+    import tensorflow as tf
+    import bench_utils as bu
+    import models.scoring as scoring
+    import models.inference as inference
+    model = scoring.load_pnvae(bu.make_setting(fused_edgeconv=configs[config]), WEIGHTS_PATH)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.001))
+    particles = bu.random_particles(batch_size * n_steps, nodes_n=100, feat_sz=3)
+    dataset = tf.data.Dataset.from_tensor_slices(((particles[:,:,0:2], particles), particles)).batch(batch_size).cache()
+    forward = tf.function(lambda p, f: inference.reference_outputs(model, p, f))
+    p, f = tf.convert_to_tensor(particles[:batch_size,:,0:2]), tf.convert_to_tensor(particles[:batch_size])
+    model.fit(dataset.take(2), epochs=1, verbose=0) # tracing
+    gpu = bool(tf.config.list_physical_devices('GPU'))
+    if gpu:
+        tf.config.experimental.reset_memory_stats('GPU:0')
+    t_forward = bu.time_call(lambda: forward(p, f), n_repeat=10, n_warmup=2)
+    t_train = bu.time_call(lambda: model.fit(dataset, epochs=1, verbose=0), n_repeat=3, n_warmup=0) / n_steps
+    peak_mb = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20 if gpu else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return dict(forward_ms=1e3 * t_forward, step_ms=1e3 * t_train, peak_mb=peak_mb, device='GPU' if gpu else 'CPU (max RSS)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        print(json.dumps(run(sys.argv[1], int(sys.argv[2]))))
+        sys.exit(0)
+    agreement()
+    for batch_size in batch_sizes:
+        results = {}
+        for config in configs:
+            output = subprocess.run([sys.executable, __file__, config, str(batch_size)], check=True, capture_output=True, text=True).stdout
+            results[config] = json.loads(output.strip().splitlines()[-1])
+        for config, result in results.items():
+            print('batch {:5d} fused {:>4s}: forward {:8.2f} ms, train step {:8.2f} ms, peak {:8.0f} MB {} ({:+.0f}% time, {:+.0f}% memory vs none)'.format(
+                batch_size, config, result['forward_ms'], result['step_ms'], result['peak_mb'], result['device'],
+                100*(result['step_ms']/results['none']['step_ms']-1), 100*(result['peak_mb']/results['none']['peak_mb']-1)))
@@ -0,0 +1,61 @@
+import numpy as np
+import tensorflow as tf
+import bench_utils as bu
+import models.models as models
+import utils.preprocessing as prepr
+import utils.input_pipeline as inpipe
+
+# ********************************************************
+#       benchmark train step time of the GCN / EdgeConv autoencoders : eager vs compiled (tf.function)
+# ********************************************************
+
+n_jets, nodes_n, feat_sz = 8192, 100, 3
+k_neighbors, latent_dim = 7, 5
+batch_sizes = [128, 512]
+n_epochs = 2
+
+
+def make_models():
+    activation = tf.keras.layers.LeakyReLU(alpha=0.1)
+    return {
+        'GCNAutoEncoder': lambda: models.GCNAutoEncoder(nodes_n=nodes_n, feat_sz=feat_sz, activation=activation, latent_dim=latent_dim),
+        'GCNVariationalAutoEncoder': lambda: models.GCNVariationalAutoEncoder(nodes_n=nodes_n, feat_sz=feat_sz, activation=activation,
+                                                                             latent_dim=latent_dim, beta_kl=10, kl_warmup_time=0),
+        'EdgeConvAutoEncoder': lambda: models.EdgeConvAutoEncoder(nodes_n=nodes_n, feat_sz=feat_sz, k_neighbors=k_neighbors,
+                                                                 activation=activation, latent_dim=latent_dim),
+        'EdgeConvVariationalAutoEncoder': lambda: models.EdgeConvVariationalAutoEncoder(nodes_n=nodes_n, feat_sz=feat_sz, k_neighbors=k_neighbors,
+                                                                                       activation=activation, latent_dim=latent_dim,
+                                                                                       beta_kl=10, kl_warmup_time=0),
+    }
+
+
+def make_data(name, particles):
+    if name.startswith('GCN'):
+        # GCN train_step unpacks data as (X, adj)
+        return particles, prepr.normalized_adjacency(prepr.make_adjacencies(particles))
+    # random edge features : only the shapes matter for timing
+    edges = bu.random_particles(particles.shape[0], nodes_n=nodes_n, feat_sz=k_neighbors*feat_sz, seed=1)
+    return (particles, edges), particles
+
+
+def time_fit(build, data, batch_size, run_eagerly):
+    model = build()
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.001), run_eagerly=run_eagerly)
+    dataset = inpipe.make_graph_dataset(*data, batch_size=batch_size)
+    model.fit(dataset, epochs=1, verbose=0) # warmup / tracing
+    n_steps = n_jets // batch_size
+    seconds = bu.time_call(lambda: model.fit(dataset, epochs=n_epochs, verbose=0), n_repeat=3, n_warmup=0)
+    n_traces = model.train_function.experimental_get_tracing_count() if not run_eagerly else 0
+    return 1e3*seconds/(n_epochs*n_steps), n_traces
+
+
+if __name__ == '__main__':
+    particles = bu.random_particles(n_jets, nodes_n=nodes_n, feat_sz=feat_sz)
+    particles[:,:,0] = np.abs(particles[:,:,0]) # make_adjacencies masks on the first feature
+    for name, build in make_models().items():
+        data = make_data(name, particles)
+        for batch_size in batch_sizes:
+            eager_ms, _ = time_fit(build, data, batch_size, run_eagerly=True)
+            graph_ms, n_traces = time_fit(build, data, batch_size, run_eagerly=False)
+            print('{:>32s} batch {:4d}: eager {:8.2f} ms/step, graph {:8.2f} ms/step ({:.1f}x), train_function traced {} time(s)'.format(
+                name, batch_size, eager_ms, graph_ms, eager_ms/graph_ms, n_traces))
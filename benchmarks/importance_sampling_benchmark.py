@@ -0,0 +1,69 @@
+import time
+import h5py
+import tensorflow as tf
+import bench_utils as bu
+import models.ParticleNetAE as pnae
+import utils.input_pipeline as inpipe
+import utils.importance_sampling as imps
+
+# ********************************************************
+#       wall time to reach the val_loss of uniform training : uniform vs loss-aware importance sampling
+# ********************************************************
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+train_n, valid_n = int(2*10e4), int(2*10e4)
+batch_size, learning_rate = 256, 0.001
+uniform_epochs, max_epochs = 10, 30
+
+
+class StopAtLoss(tf.keras.callbacks.Callback):
+    ''' stop as soon as val_loss reaches target, records the wall time '''
+    def __init__(self, target):
+        super(StopAtLoss, self).__init__()
+        self.target = target
+        self.reached = None
+
+    def on_train_begin(self, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.target is not None and logs['val_loss'] <= self.target:
+            self.reached = (epoch+1, time.perf_counter() - self.start)
+            self.model.stop_training = True
+
+
+def train(model, train_ds, valid, epochs, target=None):
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate))
+    stop = StopAtLoss(target)
+    start = time.perf_counter()
+    history = model.fit(train_ds, validation_data=valid, epochs=epochs, validation_batch_size=1024, verbose=2,
+                        callbacks=[stop, tf.keras.callbacks.ReduceLROnPlateau(factor=0.1, patience=3, verbose=2)])
+    return history, stop.reached, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    with h5py.File(filename_bg, 'r') as inFile:
+        particles = inFile['particle_bg'][0:train_n]
+        particles_valid = inFile['particle_bg_valid'][0:valid_n]
+    nodes_n, feat_sz = particles.shape[1:]
+    valid = ((particles_valid[:,:,0:2], particles_valid), particles_valid)
+    setting = bu.make_setting(nodes_n=nodes_n, feat_sz=feat_sz, kl_warmup_time=0)
+
+    tf.random.set_seed(0)
+    uniform = pnae.PNVAE(setting=setting, name='PN_AE_')
+    history, _, uniform_time = train(uniform, inpipe.make_pn_dataset(particles, batch_size), valid, uniform_epochs)
+    target = min(history.history['val_loss'])
+    print('uniform : {} epochs, {:.1f} s, best val_loss {:.4f}'.format(uniform_epochs, uniform_time, target))
+
+    tf.random.set_seed(0)
+    store = imps.LossStore(particles.shape[0])
+    sampler = imps.ImportanceSampler(store, batch_size, epoch_fraction=0.5, uniform_mix=0.2, warmup_epochs=2, seed=0)
+    model = pnae.ImportanceSampledPNVAE(setting=setting, loss_store=store, name='PN_AE_')
+    history, reached, total_time = train(model, imps.make_importance_dataset(particles, sampler), valid, max_epochs, target=target)
+    if reached is None:
+        print('importance sampling : val_loss {:.4f} not reached in {} epochs ({:.1f} s), best {:.4f}'.format(
+            target, max_epochs, total_time, min(history.history['val_loss'])))
+    else:
+        print('importance sampling : val_loss {:.4f} reached after {} epochs, {:.1f} s ({:.2f}x faster)'.format(
+            target, reached[0], reached[1], uniform_time / reached[1]))
@@ -0,0 +1,32 @@
+import numpy as np
+import tensorflow as tf
+import bench_utils as bu
+import models.scoring as scoring
+import models.inference as inference
+
+# ********************************************************
+#       latency of the lean inference PNVAE (folded BN, matmuls, z_mean) vs the original model
+# ********************************************************
+
+WEIGHTS_PATH = None # PN_VAE_weights_*.hdf5, random weights if None (BN statistics are then trivial)
+batch_sizes = [1, 64, 1024, 4096]
+
+
+if __name__ == '__main__':
+    setting = bu.make_setting()
+    model = scoring.load_pnvae(setting, WEIGHTS_PATH)
+    particles = bu.random_particles(max(batch_sizes), nodes_n=setting.num_points, feat_sz=setting.num_features)
+    lean = inference.export_inference_model(model, check_particles=particles[:1024])
+    diff_z, diff_reco = inference.max_abs_difference(model, lean, particles[:1024])
+    print('max |dz_mean| = {:.2e}, max |dreco| = {:.2e}'.format(diff_z, diff_reco))
+
+    original = tf.function(lambda points, features: model((points, features), training=False))
+    deterministic = tf.function(lambda points, features: inference.reference_outputs(model, points, features))
+    for batch_size in batch_sizes:
+        points = tf.convert_to_tensor(particles[:batch_size,:,0:2])
+        features = tf.convert_to_tensor(particles[:batch_size])
+        t_original = bu.time_call(lambda: original(points, features), n_repeat=20, n_warmup=2)
+        t_deterministic = bu.time_call(lambda: deterministic(points, features), n_repeat=20, n_warmup=2)
+        t_lean = bu.time_call(lambda: lean(points, features), n_repeat=20, n_warmup=2)
+        print('batch {:5d}: original {:8.3f} ms, original z_mean {:8.3f} ms, lean {:8.3f} ms ({:.2f}x)'.format(
+            batch_size, 1e3*t_original, 1e3*t_deterministic, 1e3*t_lean, t_original/t_lean))
@@ -0,0 +1,77 @@
+import numpy as np
+import tensorflow as tf
+import bench_utils as bu
+import models.custom_functions as funcs
+
+# ********************************************************
+#       benchmark of the kNN engines of the EdgeConv blocks : exact (distance matrix + top_k) vs grid (spatial hash)
+#       recall of the exact neighbours, time per batch and memory of the largest intermediate, as a function of P,
+#       on full jets and on padded jets as in the training data (fewer real constituents, padding on one coordinate)
+# ********************************************************
+
+n_jets, batch_size = 4096, 256
+num_points_list = [100, 200, 300, 500]
+k_list = [7, 16]
+
+
+def jet_points(n, num_points, seed=0):
+    ''' (eta, phi) with a dense core and wide tails, as the constituents around the jet axis '''
+    rng = np.random.default_rng(seed)
+    width = rng.exponential(0.1, size=(n, num_points, 1)) + 0.02
+    return (rng.normal(size=(n, num_points, 2)) * width).astype(np.float32)
+
+
+def padded_jet_points(n, num_points, seed=0):
+    ''' jet_points with 10 to num_points real constituents, the padded slots all at one (normalized) coordinate, and the mask of the real ones '''
+    rng = np.random.default_rng(seed)
+    points = jet_points(n, num_points, seed)
+    mask = np.arange(num_points)[np.newaxis, :] < rng.integers(10, num_points + 1, size=(n, 1))
+    points[~mask] = np.array([-0.5, 0.3], dtype=np.float32)
+    return points, mask
+
+
+def recall(exact, approx, mask=None):
+    ''' fraction of the exact neighbours found by approx, both (N, P, K), over the points of mask (N, P) only if given
+        (ties between padded points make their exact neighbours arbitrary) '''
+    hits = (approx[:, :, :, np.newaxis] == exact[:, :, np.newaxis, :]).any(axis=2)
+    return float(np.mean(hits if mask is None else hits[mask]))
+
+
+def self_fraction(indices):
+    ''' fraction of neighbour slots pointing to the point itself (fallback of the grid engine) '''
+    return float(np.mean(indices == np.arange(indices.shape[1])[np.newaxis, :, np.newaxis]))
+
+
+def largest_intermediate_mb(engine, num_points, k):
+    ''' float32 bytes per batch : (P x P) distances for exact, (P x 9 C) candidates (index, distance, 2 coordinates) for grid '''
+    if engine == 'exact':
+        n_values = num_points * num_points
+    else:
+        cell_capacity = 3 * max(k // 2, 1)
+        n_values = num_points * 9 * cell_capacity * 4
+    return batch_size * n_values * 4 / 2**20
+
+
+def peak_memory_mb(fn):
+    ''' peak device memory of fn() on GPU, None on CPU '''
+    if not tf.config.list_physical_devices('GPU'):
+        return None
+    tf.config.experimental.reset_memory_stats('GPU:0')
+    fn()
+    return tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20
+
+
+if __name__ == '__main__':
+    for num_points in num_points_list:
+        for jets in ['full', 'padded']:
+            points, mask = (jet_points(n_jets, num_points), None) if jets == 'full' else padded_jet_points(n_jets, num_points)
+            batches = [tf.convert_to_tensor(points[start:start+batch_size]) for start in range(0, n_jets, batch_size)]
+            for k in k_list:
+                engines = {name: tf.function(lambda p, fn=fn: fn(p, k)) for name, fn in funcs.KNN_ENGINES.items()}
+                indices = {name: np.concatenate([engine(batch).numpy() for batch in batches]) for name, engine in engines.items()}
+                for name, engine in engines.items():
+                    seconds = bu.time_call(lambda: [engine(batch) for batch in batches], n_repeat=3)
+                    peak = peak_memory_mb(lambda: engine(batches[0]).numpy())
+                    print('P {:4d} {:>6s} K {:3d} {:>6s}: recall {:.4f}, self {:.4f}, {:8.2f} ms/batch, largest intermediate {:8.1f} MB/batch{}'.format(
+                        num_points, jets, k, name, recall(indices['exact'], indices[name], mask), self_fraction(indices[name]), 1e3*seconds/len(batches),
+                        largest_intermediate_mb(name, num_points, k), '' if peak is None else ', peak {:.1f} MB'.format(peak)))
@@ -0,0 +1,51 @@
+import os
+import time
+import numpy as np
+import h5py
+import bench_utils as bu
+import models.scoring as scoring
+import utils.preprocessing as prepr
+from utils.latent_index import LatentIndex
+
+# ********************************************************
+#       benchmark encoder-only latent index scoring vs reconstruction loss scoring
+# ********************************************************
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+SIG_PATH = '/eos/project/d/dshep/TOPCLASS/DijetAnomaly/VAE_data/events/'
+SIG_NAME = 'RSGraviton_WW_NARROW_13TeV_PU40_3.5TeV_NEW'
+filename_sig = SIG_PATH + SIG_NAME + '_parts/' + SIG_NAME + '_concat_001.h5'
+WEIGHTS_PATH = None # PN_VAE_weights_*.hdf5 checkpoint, untrained model if None (timing only)
+INDEX_PATH = 'latent_index_bg.npz'
+
+n_index, n_test, k = int(5*10e4), 5000, 5
+
+
+if __name__ == '__main__':
+    with h5py.File(filename_bg, 'r') as inFile:
+        particles_bg = inFile['particle_bg'][0:n_index]
+        particles_bg_test = inFile['particle_bg_test'][0:n_test]
+    _,_, particles_sig = prepr.prepare_data_constituents(filename_sig,n_test,0,n_test)
+
+    setting = bu.make_setting(nodes_n=particles_bg.shape[1], feat_sz=particles_bg.shape[2])
+    model = scoring.load_pnvae(setting, WEIGHTS_PATH)
+
+    start = time.perf_counter()
+    embeddings_bg = scoring.latent_embeddings(model, scoring.pn_inputs(particles_bg))
+    embed_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index = LatentIndex(n_lists=int(np.sqrt(n_index)), n_probe=8).fit(embeddings_bg)
+    build_time = time.perf_counter() - start
+    index.save(INDEX_PATH)
+    index = LatentIndex.load(INDEX_PATH)
+    print('Index: {} vectors, {:.1f} MB on disk, embedding {:.1f} s, build {:.1f} s'.format(
+        embeddings_bg.shape[0], os.path.getsize(INDEX_PATH)/1e6, embed_time, build_time))
+
+    results = {}
+    for name, score_fn in [('latent_index', lambda x: scoring.latent_index_scores(model, scoring.pn_inputs(x), index, k=k)),
+                           ('reco_loss', lambda x: scoring.reco_loss_scores(model, scoring.pn_inputs(x), x))]:
+        latency = bu.time_call(lambda: score_fn(particles_bg_test), n_repeat=3)
+        auc = bu.roc_auc(score_fn(particles_bg_test), score_fn(particles_sig))
+        results[name] = (latency, auc)
+        print('{:>14s}: {:.3f} ms/jet, AUC = {:.4f}'.format(name, 1e3*latency/n_test, auc))
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+import bench_utils as bu
+import models.models as models
+import models.scoring as scoring
+import models.inference as inference
+import models.numpy_inference as npinf
+import utils.preprocessing as prepr
+
+# ********************************************************
+#       TensorFlow-free numpy inference : agreement with TF, startup time of a fresh scoring process and throughput
+# ********************************************************
+
+WEIGHTS_PATH = None # PN_VAE_weights_*.hdf5, random weights if None
+n_jets = 16384
+n_workers_list = [1, 2, 4]
+REPO_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def startup_seconds(code, n_repeat=3):
+    ''' median wall time of a fresh python process running code (imports and model loading included) '''
+    times = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=REPO_PATH, env=dict(os.environ, OMP_NUM_THREADS='1'))
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    out_dir = tempfile.mkdtemp()
+    setting = bu.make_setting()
+    model = scoring.load_pnvae(setting, WEIGHTS_PATH)
+    particles = bu.random_particles(n_jets, nodes_n=setting.num_points, feat_sz=setting.num_features)
+
+    npz_path = os.path.join(out_dir, 'pnvae.npz')
+    saved_model_path = os.path.join(out_dir, 'pnvae_saved_model')
+    np_model = inference.export_npz(model, npz_path, check_inputs=particles[:1024])
+    lean = inference.export_inference_model(model, save_path=saved_model_path)
+    scores_tf, scores_np = lean.scores(particles[:1024]), np_model.scores(particles[:1024])
+    print('PNVAE : max |dscore| numpy vs TF = {:.2e} (relative {:.2e})'.format(
+        np.max(np.abs(scores_tf - scores_np)), np.max(np.abs(scores_tf - scores_np) / np.abs(scores_tf))))
+
+    # GCN autoencoder on dense adjacencies
+    gcn = models.GCNVariationalAutoEncoder(nodes_n=setting.num_points, feat_sz=setting.num_features, activation=tf.nn.tanh,
+                                           latent_dim=5, beta_kl=10, kl_warmup_time=0)
+    features = np.abs(particles[:1024])
+    adjacency = prepr.normalized_adjacency(prepr.make_adjacencies(features))
+    gcn((features, adjacency))
+    inference.export_npz(gcn, os.path.join(out_dir, 'gcn.npz'), check_inputs=(features, adjacency))
+    print('GCNVariationalAutoEncoder : numpy export agrees with TF')
+
+    t_numpy = startup_seconds('import models.numpy_inference as npinf; npinf.load_npz("{}")'.format(npz_path))
+    t_tf = startup_seconds('import tensorflow as tf; tf.saved_model.load("{}")'.format(saved_model_path))
+    print('process startup to loaded model : numpy {:.2f} s, tensorflow saved_model {:.2f} s'.format(t_numpy, t_tf))
+
+    t_lean = bu.time_call(lambda: lean.scores(particles), n_repeat=3)
+    print('throughput : TF lean {:8.0f} jets/s'.format(n_jets / t_lean))
+    for n_workers in n_workers_list:
+        t_np = bu.time_call(lambda: npinf.parallel_scores(npz_path, particles, n_workers=n_workers), n_repeat=3)
+        print('             numpy {} worker(s) {:8.0f} jets/s (pool startup included)'.format(n_workers, n_jets / t_np))
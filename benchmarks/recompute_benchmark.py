@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import resource
+import subprocess
+import numpy as np
+
+# ********************************************************
+#       EdgeConv gradient checkpointing (setting.recompute_blocks) : same weights and BatchNormalization moving statistics
+#       as without recomputation after n_steps train steps, then peak memory vs train step time,
+#       conv_params of train_AE.py, every configuration in a fresh process (peak RSS on CPU, peak device memory on GPU)
+# ********************************************************
+
+configs = {'none': [False, False, False], 'first': [True, False, False], 'all': [True, True, True]}
+batch_sizes = [256, 1024]
+n_steps = 20
+
+
+def agreement(batch_size=256):
+    import tensorflow as tf
+    import bench_utils as bu
+    import models.ParticleNetAE as pnae
+    particles = bu.random_particles(batch_size * n_steps, nodes_n=100, feat_sz=3)
+    dataset = tf.data.Dataset.from_tensor_slices(((particles[:,:,0:2], particles), particles)).batch(batch_size)
+    models = {config: pnae.PNVAE(setting=bu.make_setting(recompute_blocks=recompute), name='PN_AE_') for config, recompute in configs.items()}
+    initial_weights = models['none'].get_weights()
+    for config, model in models.items():
+        model.set_weights(initial_weights) # same initial weights and statistics
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.001))
+        model.fit(dataset, epochs=1, verbose=0, shuffle=False)
+    for config, model in models.items():
+        if config == 'none':
+            continue
+        statistics = lambda m: [v for v in m.non_trainable_variables if 'moving_' in v.name] # same layout, auto-named layers differ
+        dw = max(np.max(np.abs(ref.numpy() - v.numpy())) for ref, v in zip(models['none'].trainable_variables, model.trainable_variables))
+        ds = max(np.max(np.abs(ref.numpy() - v.numpy())) for ref, v in zip(statistics(models['none']), statistics(model)))
+        print('recompute {:>6s}: after {} steps max |dweight| = {:.2e}, max |dmoving stat| = {:.2e} vs none'.format(config, n_steps, dw, ds))
+
+
+def run(config, batch_size):
+    import tensorflow as tf
+    import bench_utils as bu
+    import models.ParticleNetAE as pnae
+    setting = bu.make_setting(recompute_blocks=configs[config])
+    model = pnae.PNVAE(setting=setting, name='PN_AE_')
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.001))
+    particles = bu.random_particles(batch_size * n_steps, nodes_n=setting.num_points, feat_sz=setting.num_features)
+    dataset = tf.data.Dataset.from_tensor_slices(((particles[:,:,0:2], particles), particles)).batch(batch_size).cache()
+    model.fit(dataset.take(2), epochs=1, verbose=0) # tracing
+    gpu = bool(tf.config.list_physical_devices('GPU'))
+    if gpu:
+        tf.config.experimental.reset_memory_stats('GPU:0')
+    seconds = bu.time_call(lambda: model.fit(dataset, epochs=1, verbose=0), n_repeat=3, n_warmup=0)
+    peak_mb = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20 if gpu else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return dict(step_ms=1e3 * seconds / n_steps, peak_mb=peak_mb, device='GPU' if gpu else 'CPU (max RSS)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        print(json.dumps(run(sys.argv[1], int(sys.argv[2]))))
+        sys.exit(0)
+    agreement()
+    for batch_size in batch_sizes:
+        results = {}
+        for config in configs:
+            output = subprocess.run([sys.executable, __file__, config, str(batch_size)], check=True, capture_output=True, text=True).stdout
+            results[config] = json.loads(output.strip().splitlines()[-1])
+        for config, result in results.items():
+            print('batch {:5d} recompute {:>6s}: {:8.1f} ms/step, peak {:8.0f} MB {} ({:+.0f}% time, {:+.0f}% memory vs none)'.format(
+                batch_size, config, result['step_ms'], result['peak_mb'], result['device'],
+                100*(result['step_ms']/results['none']['step_ms']-1), 100*(result['peak_mb']/results['none']['peak_mb']-1)))
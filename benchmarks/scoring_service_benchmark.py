@@ -0,0 +1,82 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+import numpy as np
+import bench_utils as bu
+import models.scoring as scoring
+from utils.scoring_service import ScoringServer, ScoringClient, encode_message, read_message
+
+# ********************************************************
+#       load generator for the local scoring service : n concurrent clients sending small requests,
+#       client side latency / throughput and server batch fill for several max_wait_ms, vs one request at a time
+# ********************************************************
+
+n_clients_list = [1, 8, 32]
+jets_per_request = 4
+duration_s = 5.
+max_batch_size = 512
+max_wait_ms_list = [0., 2., 5., 10.]
+
+
+def start_server(score_fn, path, max_wait_ms):
+    ''' server running in a background thread, returns once the socket accepts connections '''
+    server = ScoringServer(score_fn, path=path, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    ready = threading.Event()
+    thread = threading.Thread(target=lambda: asyncio.run(server.serve(ready)), daemon=True)
+    thread.start()
+    ready.wait()
+    return server
+
+
+async def client(path, particles, stop_time, latencies):
+    reader, writer = await asyncio.open_unix_connection(path)
+    rng = np.random.default_rng()
+    while time.perf_counter() < stop_time:
+        start = rng.integers(0, particles.shape[0] - jets_per_request)
+        batch = particles[start:start+jets_per_request]
+        t0 = time.perf_counter()
+        writer.write(encode_message({'op': 'score', 'shape': list(batch.shape)}, batch))
+        await writer.drain()
+        await read_message(reader)
+        latencies.append(time.perf_counter() - t0)
+    writer.close()
+
+
+async def load(path, particles, n_clients):
+    latencies = []
+    stop_time = time.perf_counter() + duration_s
+    await asyncio.gather(*[client(path, particles, stop_time, latencies) for _ in range(n_clients)])
+    return np.asarray(latencies)
+
+
+def report(label, latencies):
+    print('{:>40s}: {:8.0f} jets/s, latency p50 {:7.2f} ms p99 {:7.2f} ms'.format(
+        label, jets_per_request * len(latencies) / duration_s, 1e3*np.percentile(latencies, 50), 1e3*np.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    setting = bu.make_setting()
+    model = scoring.load_pnvae(setting)
+    score_fn = scoring.pn_reco_scorer(model, batch_size=max_batch_size)
+    particles = bu.random_particles(8192, nodes_n=setting.num_points, feat_sz=setting.num_features)
+
+    # reference : every client request scored on its own, one at a time
+    latencies = []
+    stop_time = time.perf_counter() + duration_s
+    while time.perf_counter() < stop_time:
+        t0 = time.perf_counter()
+        score_fn(particles[:jets_per_request])
+        latencies.append(time.perf_counter() - t0)
+    report('no batching (serial)', np.asarray(latencies))
+
+    for max_wait_ms in max_wait_ms_list:
+        path = os.path.join(tempfile.mkdtemp(), 'scoring.sock')
+        start_server(score_fn, path, max_wait_ms)
+        for n_clients in n_clients_list:
+            report('max_wait {:4.1f} ms, {:2d} clients'.format(max_wait_ms, n_clients), asyncio.run(load(path, particles, n_clients)))
+        with ScoringClient(path=path) as metrics_client:
+            metrics = metrics_client.metrics()
+        print('{:>40s}  batch fill {:.3f}, {:.1f} requests/batch, server latency p50 {:.2f} ms p99 {:.2f} ms'.format(
+            '', metrics['batch_fill_mean'], metrics['requests_per_batch_mean'], metrics['latency_ms_p50'], metrics['latency_ms_p99']))
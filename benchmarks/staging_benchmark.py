@@ -0,0 +1,83 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import h5py
+import bench_utils as bu
+from utils.staging import StagingCache
+
+# ********************************************************
+#       staging cache vs direct reads, with a throttled local directory standing in for the remote mount
+# ********************************************************
+
+n_shards, rows_per_shard = 6, 20000
+bandwidth_mb_s = 200. # simulated remote read bandwidth
+latency_s = 0.05 # simulated per file open latency
+n_epochs = 3
+quota_gb = 0.2 # smaller than all shards : exercises LRU eviction
+
+
+def slow_copy(src, dst, block=2**22):
+    ''' copy at bandwidth_mb_s after latency_s, like a read from the remote filesystem '''
+    time.sleep(latency_s)
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while True:
+            data = fin.read(block)
+            if not data:
+                break
+            fout.write(data)
+            time.sleep(len(data) / (bandwidth_mb_s * 2**20))
+
+
+def read_shard(path):
+    with h5py.File(path, 'r') as f:
+        return f['particle_bg'][()].sum()
+
+
+def direct_epoch(shards, scratch):
+    for shard in shards: # every read pays the remote cost
+        tmp = os.path.join(scratch, 'direct.h5')
+        slow_copy(shard, tmp)
+        read_shard(tmp)
+        time.sleep(0.1) # training on the shard
+
+
+def staged_epoch(cache, shards, lookahead):
+    for path in cache.iter_staged(shards, lookahead=lookahead):
+        read_shard(path)
+        time.sleep(0.1) # training on the shard while the next one is staged
+
+
+if __name__ == '__main__':
+    remote_dir, cache_dir, scratch = tempfile.mkdtemp(), tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        shards = []
+        for idx in range(n_shards):
+            path = os.path.join(remote_dir, 'shard_%03d.h5' % idx)
+            with h5py.File(path, 'w') as f:
+                f.create_dataset('particle_bg', data=bu.random_particles(rows_per_shard, seed=idx))
+            shards.append(path)
+        shard_mb = os.path.getsize(shards[0]) / 2**20
+        print('{} shards of {:.1f} MB, {:.0f} MB/s simulated remote, quota {:.0f} MB'.format(n_shards, shard_mb, bandwidth_mb_s, quota_gb*1024))
+
+        start = time.perf_counter()
+        for epoch in range(n_epochs):
+            direct_epoch(shards, scratch)
+        print('direct : {:.2f} s / epoch'.format((time.perf_counter() - start) / n_epochs))
+
+        for quota in [quota_gb, 2*n_shards*shard_mb/1024]:
+            for lookahead in [0, 1, 2]:
+                shutil.rmtree(cache_dir)
+                cache = StagingCache(cache_dir, quota_gb=quota, copy_fn=slow_copy)
+                epoch_times = []
+                for epoch in range(n_epochs):
+                    start = time.perf_counter()
+                    staged_epoch(cache, shards, lookahead)
+                    epoch_times.append(time.perf_counter() - start)
+                cache.close()
+                print('staged (quota {:5.0f} MB, lookahead {}) : {} s / epoch, {}'.format(
+                    quota*1024, lookahead, ', '.join('{:.2f}'.format(t) for t in epoch_times), cache.stats))
+    finally:
+        for d in [remote_dir, cache_dir, scratch]:
+            shutil.rmtree(d, ignore_errors=True)
@@ -0,0 +1,57 @@
+import h5py
+from collections import namedtuple
+from datetime import datetime
+import tensorflow as tf
+print('tensorflow version: ', tf.__version__)
+
+import models.cotraining as cotraining
+import utils.input_pipeline as inpipe
+from utils.settings import pnvae_setting, copy_setting
+
+# ********************************************************
+#       co-training of several PNVAE variants on one shared input stream
+# ********************************************************
+
+Parameters = namedtuple('Parameters', 'epochs train_total_n valid_total_n batch_n learning_rate')
+params = Parameters(epochs=100,
+                    train_total_n=int(1*10e5),
+                    valid_total_n=int(1*10e4),
+                    batch_n=256,
+                    learning_rate=0.001)
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+
+with h5py.File(filename_bg, 'r') as inFile:
+    particles_bg = inFile['particle_bg'][0:params.train_total_n]
+    particles_bg_valid = inFile['particle_bg_valid'][0:params.valid_total_n]
+nodes_n, feat_sz = particles_bg.shape[1:]
+
+setting = pnvae_setting(nodes_n, feat_sz)
+
+def variant(**overrides):
+    return copy_setting(setting, **overrides)
+
+settings = {'PN_VAE': variant(),
+            'PN_AE': variant(ae_type='ae'),
+            'PN_VAE_sum': variant(conv_linking='sum'),
+            'PN_VAE_latent5': variant(latent_dim=5)}
+
+model = cotraining.CoTrainer(settings, name='CoTrainer')
+model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=params.learning_rate))
+
+timestamp = str(datetime.now().isoformat(timespec='minutes').replace(':',"_").replace('T','_T_').replace('-','_'))
+checkpoint_filepath = MODELS_PATH + '{name}_weights_'+timestamp+'.{epoch:02d}-{val_loss:.3f}.hdf5'
+callbacks = [tf.keras.callbacks.ReduceLROnPlateau(factor=0.1,min_delta=0.0005, patience=5, verbose=2),
+             tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10, verbose=2),
+             cotraining.CoKLWarmupCallback(),
+             cotraining.VariantCheckpoint(checkpoint_filepath)]
+
+train_ds = inpipe.make_pn_dataset(particles_bg, params.batch_n, shuffle=True, augment_constituents=True)
+history = model.fit(train_ds,
+                    validation_data = ((particles_bg_valid[:,:,0:2], particles_bg_valid) , particles_bg_valid),
+                    epochs=params.epochs,
+                    validation_batch_size=params.batch_n,
+                    verbose=1,
+                    callbacks=callbacks)
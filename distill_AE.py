@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import h5py
+from collections import namedtuple
+import tensorflow as tf
+print('tensorflow version: ', tf.__version__)
+
+import models.models as models
+import models.scoring as scoring
+import models.distillation as distill
+import utils.preprocessing as prepr
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       distill a trained PNVAE (teacher) into a fast DeepSets student scorer
+# ********************************************************
+
+Parameters = namedtuple('Parameters', 'train_total_n valid_total_n epochs batch_n learning_rate z_weight')
+params = Parameters(train_total_n=int(1*10e5),
+                    valid_total_n=int(1*10e4),
+                    epochs=30,
+                    batch_n=1024,
+                    learning_rate=0.001,
+                    z_weight=0.1)
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+SIG_PATH = '/eos/project/d/dshep/TOPCLASS/DijetAnomaly/VAE_data/events/'
+SIG_NAME = 'RSGraviton_WW_NARROW_13TeV_PU40_3.5TeV_NEW'
+filename_sig = SIG_PATH + SIG_NAME + '_parts/' + SIG_NAME + '_concat_001.h5'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+teacher_weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'
+targets_path = {'train': MODELS_PATH + 'teacher_targets_train.h5', 'valid': MODELS_PATH + 'teacher_targets_valid.h5'}
+
+with h5py.File(filename_bg, 'r') as inFile:
+    nodes_n, feat_sz = inFile['particle_bg'].shape[1:]
+
+setting = pnvae_setting(nodes_n, feat_sz)
+
+teacher = scoring.load_pnvae(setting, teacher_weights_path)
+
+# *******************************************************
+#                       teacher targets, computed once and cached
+# *******************************************************
+
+for split, dataset, n in [('train', 'particle_bg', params.train_total_n), ('valid', 'particle_bg_valid', params.valid_total_n)]:
+    if not os.path.exists(targets_path[split]):
+        distill.cache_teacher_targets(teacher, filename_bg, targets_path[split], dataset=dataset, n=n)
+
+with h5py.File(filename_bg, 'r') as inFile:
+    particles_bg = inFile['particle_bg'][0:params.train_total_n]
+    particles_bg_valid = inFile['particle_bg_valid'][0:params.valid_total_n]
+    particles_bg_test = inFile['particle_bg_test'][()]
+targets_train = distill.load_teacher_targets(targets_path['train'], params.train_total_n)
+targets_valid = distill.load_teacher_targets(targets_path['valid'], params.valid_total_n)
+
+# *******************************************************
+#                       train the student
+# *******************************************************
+
+student = models.DeepSetsStudent(nodes_n=nodes_n, feat_sz=feat_sz, activation=tf.keras.layers.LeakyReLU(alpha=0.1),
+                                 latent_dim=setting.latent_dim, z_weight=params.z_weight, name='DeepSetsStudent')
+student.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=params.learning_rate))
+callbacks = [tf.keras.callbacks.ReduceLROnPlateau(factor=0.1, patience=3, verbose=2),
+             tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=6, verbose=2, restore_best_weights=True)]
+student.fit(particles_bg, targets_train,
+            validation_data=(particles_bg_valid, targets_valid),
+            epochs=params.epochs, batch_size=params.batch_n, verbose=1, callbacks=callbacks)
+student.save_weights(MODELS_PATH + 'DeepSetsStudent_weights.hdf5')
+
+# *******************************************************
+#                       student vs teacher : throughput, score correlation, AUC
+# *******************************************************
+
+_,_, particles_sig = prepr.prepare_data_constituents(filename_sig,particles_bg_test.shape[0],0,particles_bg_test.shape[0])
+particles_test = np.concatenate([particles_bg_test, particles_sig])
+labels = np.concatenate([np.zeros(particles_bg_test.shape[0]), np.ones(particles_sig.shape[0])])
+report = distill.compare_to_teacher(student, teacher, particles_test, labels=labels)
+for key, value in report.items():
+    print('{:>20s}: {:.4f}'.format(key, value))
@@ -0,0 +1,88 @@
+import re
+import sys
+import h5py
+from collections import namedtuple
+from datetime import datetime
+import tensorflow as tf
+print('tensorflow version: ', tf.__version__)
+
+import models.models as models
+import models.scoring as scoring
+import utils.input_pipeline as inpipe
+from utils.chunk_sampler import ChunkShuffleSampler, sample_rows
+from utils.staging import default_cache
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       warm-start fine-tuning of a trained PNVAE on newly arriving data shards
+# ********************************************************
+
+Parameters = namedtuple('Parameters', 'model latent_dim beta_kl kl_warmup_time epochs replay_n replay_fraction valid_total_n batch_n activation learning_rate')
+params = Parameters(model='PN_VAE',
+                    latent_dim=10,
+                    beta_kl=10,
+                    kl_warmup_time=3,
+                    epochs=5,
+                    replay_n=int(1*10e4),
+                    replay_fraction=0.2,
+                    valid_total_n=int(1*10e4),
+                    batch_n=256,
+                    activation=tf.keras.layers.LeakyReLU(alpha=0.1),
+                    learning_rate=0.0001)
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+old_files = [DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5']
+new_files = sys.argv[1:] # new shards, same format as old_files : python finetune_AE.py shard_1.h5 [shard_2.h5 ...]
+if not new_files:
+    sys.exit('finetune_AE.py : no new data shards given, usage : python finetune_AE.py shard_1.h5 [shard_2.h5 ...]')
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'
+
+
+def checkpoint_epoch(weights_path):
+    ''' number of epochs already trained, from the ModelCheckpoint file name (...{epoch:02d}-{val_loss:.3f}.hdf5) '''
+    match = re.search(r'\.(\d+)-[\d.]+\.hdf5$', weights_path)
+    return int(match.group(1)) if match else 0
+
+# *******************************************************
+#                       data : new shards streamed + replay of old data
+# *******************************************************
+
+with h5py.File(new_files[-1], 'r') as inFile:
+    nodes_n, feat_sz = inFile['particle_bg'].shape[1:]
+    particles_valid = inFile['particle_bg_valid'][0:params.valid_total_n]
+batch_size = params.batch_n
+sampler = ChunkShuffleSampler(new_files, dataset='particle_bg', batch_size=batch_size, cache=default_cache()) # staged locally if ADGVAE_STAGING_DIR is set
+new_ds = sampler.as_dataset()
+if params.replay_n > 0:
+    replay = sample_rows(old_files, params.replay_n, dataset='particle_bg')
+    new_ds = inpipe.mix_with_replay(new_ds, replay, batch_size, replay_fraction=params.replay_fraction)
+train_ds = inpipe.make_pn_dataset(new_ds, batch_size, batched=True)
+
+# *******************************************************
+#                       restore model : weights and KL warm-up state
+# *******************************************************
+
+setting = pnvae_setting(nodes_n, feat_sz, latent_dim=params.latent_dim, beta_kl=params.beta_kl,
+                        kl_warmup_time=params.kl_warmup_time, activation=params.activation)
+
+model = scoring.load_pnvae(setting, weights_path) # beta_kl_warmup is a model variable, restored with the weights
+model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=params.learning_rate))
+# continue the epoch count so KLWarmupCallback resumes the schedule instead of restarting the warm-up
+initial_epoch = checkpoint_epoch(weights_path)
+print('Fine-tuning from epoch {} (beta_kl_warmup = {:.3f}) on {} new jets'.format(
+    initial_epoch, float(model.beta_kl_warmup.numpy()), sampler.n_rows))
+
+timestamp = str(datetime.now().isoformat(timespec='minutes').replace(':',"_").replace('T','_T_').replace('-','_'))
+checkpoint_filepath = MODELS_PATH + '{}_finetuned_weights_'.format(params.model)+timestamp+'.{epoch:02d}-{val_loss:.3f}.hdf5'
+callbacks = [tf.keras.callbacks.ModelCheckpoint(filepath=checkpoint_filepath, save_weights_only=True, monitor='val_loss', mode='min', save_best_only=True),
+             tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=2, verbose=2),
+             models.KLWarmupCallback()]
+
+history = model.fit(train_ds,
+                    validation_data = ((particles_valid[:,:,0:2], particles_valid) , particles_valid),
+                    initial_epoch=initial_epoch,
+                    epochs=initial_epoch+params.epochs,
+                    validation_batch_size=batch_size,
+                    verbose=1,
+                    callbacks=callbacks)
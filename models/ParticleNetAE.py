@@ -8,6 +8,31 @@ from keras import backend as K
 import models.custom_functions as funcs
 
 
+def knn_engines(setting):
+   ''' kNN engine of every EdgeConv block, setting.knn_engines (names in funcs.KNN_ENGINES), exact by default '''
+   return getattr(setting, 'knn_engines', None) or ['exact']*len(setting.conv_params)
+
+
+def fused_blocks(setting):
+   ''' EdgeConv blocks applying their first conv per point before the neighbour gather, setting.fused_edgeconv : False (default),
+       a per block list, or True for the blocks whose first conv does not widen the input (channels[0] <= C_in, otherwise the
+       gathered (N, P, K, channels[0]) projections are larger than the (N, P, K, C_in) features they replace)
+   '''
+   fused = getattr(setting, 'fused_edgeconv', False)
+   if isinstance(fused, (list, tuple)):
+      return list(fused)
+   blocks, in_channels = [], setting.num_features
+   for K, channels in setting.conv_params:
+      blocks.append(bool(fused) and channels[0] <= in_channels)
+      in_channels = 2*channels[-1] if setting.conv_linking == 'concat' else channels[-1]
+   return blocks
+
+
+def recompute_blocks(setting):
+   ''' EdgeConv blocks whose intermediates are recomputed in the backward pass instead of stored, setting.recompute_blocks (all False by default) '''
+   return getattr(setting, 'recompute_blocks', None) or [False]*len(setting.conv_params)
+
+
 class PNVAE(tf.keras.Model):
 
    def __init__(self,setting, **kwargs):
@@ -30,7 +55,12 @@ class PNVAE(tf.keras.Model):
       self.kl_loss_tracker = keras.metrics.Mean(name="kl_loss")
 
 
-   def build_edgeconv(self,points,features,K=7,channels=32,name=''):
+   def _layer(self, reuse, layer_cls, name, **kwargs):
+      ''' new layer, or the layer of the same name in reuse (the built particlenet) to share its weights '''
+      return reuse.get_layer(name) if reuse is not None else layer_cls(name=name, **kwargs)
+
+
+   def build_edgeconv(self,points,features,K=7,channels=32,name='',knn_indices=None,reuse=None,knn_engine='exact',training=None,fused=False):
       """EdgeConv
         K: int, number of neighbors
         in_channels: # of input channels
@@ -39,29 +69,41 @@ class PNVAE(tf.keras.Model):
     Inputs:
         points: (N, P, C_p)
         features: (N, P, C_0)
+        knn_indices: (N, P, K) precomputed neighbours, points are then unused
+        knn_engine: 'exact' or 'grid' (approximate, O(P K) memory, see funcs.grid_knn_indices)
+        training: passed to BatchNormalization (None : Keras call context, as in the functional model)
+        fused: first conv applied per point before the gather (same layers and weights, see fused_blocks)
     Returns:
         transformed points: (N, P, C_out), C_out = channels[-1]
     """
       with tf.name_scope('EdgeConv_'):        
-         # distance
-         D = funcs.batch_distance_matrix_general(points, points)  # (N, P, P)
-         _, indices = tf.nn.top_k(-D, k=K + 1)  # (N, P, K+1)
-         indices = indices[:, :, 1:]  # (N, P, K)
+         indices = funcs.KNN_ENGINES[knn_engine](points, K) if knn_indices is None else knn_indices  # (N, P, K)
 
          fts = features
-         knn_fts = funcs.knn(self.setting.num_points, K, indices, fts)  # (N, P, K, C)
-         knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, K, 1))  # (N, P, K, C)
-         #knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
-         knn_fts =  tf.subtract(knn_fts, knn_fts_center) #Andre style
+         if fused:
+            # the first 1x1 conv is linear, W(x_j - x_i) + b = Wx_j - Wx_i + b : project the (N, P, C) points once and gather the
+            # projected neighbours, no (N, P, K, C) tiled center / gathered features. same layer and weights as the unfused block
+            conv = self._layer(reuse, keras.layers.Conv2D, '%s_conv0' % name, filters=channels[0], kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                        use_bias=False if self.with_bn else True, kernel_initializer='glorot_normal')
+            proj = tf.squeeze(conv(tf.expand_dims(fts, axis=2)), axis=2)  # (N, P, C1)
+            x = tf.gather(proj, indices, batch_dims=1) - tf.expand_dims(proj, axis=2)  # (N, P, K, C1), the bias cancels out
+            if conv.use_bias:
+               x = tf.nn.bias_add(x, conv.bias)
+         else:
+            knn_fts = funcs.knn(self.setting.num_points, K, indices, fts)  # (N, P, K, C)
+            knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, K, 1))  # (N, P, K, C)
+            #knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
+            knn_fts =  tf.subtract(knn_fts, knn_fts_center) #Andre style
+            x = knn_fts
 
-         x = knn_fts
          for idx, channel in enumerate(channels):
-            x = keras.layers.Conv2D(channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
-                                        use_bias=False if self.with_bn else True, kernel_initializer='glorot_normal', name='%s_conv%d' % (name, idx))(x)
+            if not (fused and idx == 0):
+               x = self._layer(reuse, keras.layers.Conv2D, '%s_conv%d' % (name, idx), filters=channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                        use_bias=False if self.with_bn else True, kernel_initializer='glorot_normal')(x)
             if self.with_bn:
-               x = keras.layers.BatchNormalization(name='%s_bn%d' % (name, idx))(x)
+               x = self._layer(reuse, keras.layers.BatchNormalization, '%s_bn%d' % (name, idx))(x, training=training)
             if self.activation:
-               x = keras.layers.Activation(self.activation, name='%s_act%d' % (name, idx))(x)
+               x = self._layer(reuse, keras.layers.Activation, '%s_act%d' % (name, idx), activation=self.activation)(x)
 
          if self.setting.conv_pooling == 'max':
             fts = tf.reduce_max(x, axis=2)  # (N, P, C')
@@ -69,26 +111,32 @@ class PNVAE(tf.keras.Model):
             fts = tf.reduce_mean(x, axis=2)  # (N, P, C')
                 
          # shortcut of constituents features
-         sc = keras.layers.Conv2D(channels[-1], kernel_size=(1, 1), strides=1, data_format='channels_last',
-                                     use_bias=False if self.with_bn else True, kernel_initializer='glorot_normal', name='%s_sc_conv' % name)(tf.expand_dims(features, axis=2))
+         sc = self._layer(reuse, keras.layers.Conv2D, '%s_sc_conv' % name, filters=channels[-1], kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                     use_bias=False if self.with_bn else True, kernel_initializer='glorot_normal')(tf.expand_dims(features, axis=2))
          if self.with_bn:
-                sc = keras.layers.BatchNormalization(name='%s_sc_bn' % name)(sc)
+                sc = self._layer(reuse, keras.layers.BatchNormalization, '%s_sc_bn' % name)(sc, training=training)
          sc = tf.squeeze(sc, axis=2)
 
          x = sc + fts #sum by default, original PN
          if self.setting.conv_linking == 'concat': #concat or sum
             x = tf.concat([sc,fts],axis=2) 
          if self.activation:
-            x =  keras.layers.Activation(self.activation, name='%s_sc_act' % name)(x)  # (N, P, C') #TO DO : try with concatenation instead of sum
+            x =  self._layer(reuse, keras.layers.Activation, '%s_sc_act' % name, activation=self.activation)(x)  # (N, P, C') #TO DO : try with concatenation instead of sum
          return x
 
 
 
-   def build_particlenet(self):
+   def build_particlenet(self, knn_inputs=False):
+        ''' knn_inputs=True : variant taking (features, kNN indices of every block) instead of (points, features), sharing the weights
+            of the already built self.particlenet, so the kNN can be computed once for several models (see models/ensemble.py)
+            it is returned only (not stored on the model, which would change the checkpoint layout)
+        '''
+        reuse = self.particlenet if knn_inputs else None
         with tf.name_scope('ParticleNetBase'):
 
-           points = klayers.Input(name='points', shape=self.setting.input_shapes['points'])
+           points = klayers.Input(name='points', shape=self.setting.input_shapes['points']) if not knn_inputs else None
            features = klayers.Input(name='features', shape=self.setting.input_shapes['features']) if 'features' in self.setting.input_shapes else None
+           knn = [klayers.Input(name='knn_%d' % idx, shape=[self.setting.num_points, K], dtype=tf.int32) for idx, (K, _) in enumerate(self.setting.conv_params)] if knn_inputs else None
 
            #mask = keras.Input(name='mask', shape=self.setting.input_shapes['mask']) if 'mask' in self.setting.input_shapes else None
            mask = None #TO DO : need to check how to implement that when/if we need it
@@ -97,7 +145,7 @@ class PNVAE(tf.keras.Model):
                mask = tf.cast(tf.not_equal(mask, 0), dtype='float32')  # 1 if valid
                coord_shift = tf.multiply(999., tf.cast(tf.equal(mask, 0), dtype='float32'))  # make non-valid positions to 99
 
-           if self.with_bn:
+           if self.with_bn and not knn_inputs:
                fts = tf.squeeze(klayers.BatchNormalization(name='%s_fts_bn' % self.name)(tf.expand_dims(features, axis=2)), axis=2)
            fts = features 
            for layer_idx, layer_param in enumerate(self.setting.conv_params):
@@ -105,9 +153,9 @@ class PNVAE(tf.keras.Model):
                if mask is not None:
                    pts = tf.add(coord_shift, points) if layer_idx == 0 else tf.add(coord_shift, fts)
                else : pts=points
-               fts_shape = fts.get_shape().as_list()
-               pts_shape = pts.get_shape().as_list()
-               fts = self.build_edgeconv(pts,fts,K=K,channels=channels,name='%s_%i'%(self.name,layer_idx))
+               fts = self.build_edgeconv(pts,fts,K=K,channels=channels,name='%s_%i'%(self.name,layer_idx),
+                                         knn_indices=knn[layer_idx] if knn_inputs else None,reuse=reuse,
+                                         knn_engine=knn_engines(self.setting)[layer_idx],fused=fused_blocks(self.setting)[layer_idx])
 
            if mask is not None:
                fts = tf.multiply(fts, mask)
@@ -116,6 +164,8 @@ class PNVAE(tf.keras.Model):
            # Flatten to format for MLP input
            pool=klayers.Flatten(name='Flatten_PN')(fts)
 
+           if knn_inputs:
+               return tf.keras.Model(inputs=[features]+knn, outputs=pool, name='ParticleNetBaseKNN')
            particle_net_base = tf.keras.Model(inputs=(points,features), outputs=pool,name='ParticleNetBase')
            particle_net_base.summary()
            return particle_net_base 
@@ -184,8 +234,42 @@ class PNVAE(tf.keras.Model):
         return decoder 
 
 
-   def call(self, inputs):
-        pool_layer = self.particlenet(inputs)
+   def particlenet_recompute(self, inputs, training=None):
+        ''' self.particlenet forward pass on tensors, with the blocks of recompute_blocks(setting) wrapped in tf.recompute_grad :
+            their (N, P, K, C) intermediates are recomputed during backprop instead of kept alive (kNN indices are computed once, outside).
+            same layers and weights as self.particlenet, nothing new is tracked so the checkpoint layout is unchanged.
+            the recomputation runs the BatchNormalization layers of the block in training mode again, train steps go through
+            recompute_gradients so that their moving statistics are updated by the forward pass only
+        '''
+        points, fts = inputs
+        for layer_idx, ((K, channels), engine, recompute, fused) in enumerate(zip(self.setting.conv_params, knn_engines(self.setting),
+                                                                                  recompute_blocks(self.setting), fused_blocks(self.setting))):
+            indices = funcs.KNN_ENGINES[engine](points, K)
+            block = lambda x, K=K, channels=channels, indices=indices, fused=fused, name='%s_%i'%(self.name,layer_idx): self.build_edgeconv(
+                        None, x, K=K, channels=channels, name=name, knn_indices=indices, reuse=self.particlenet, training=training, fused=fused)
+            fts = tf.recompute_grad(block)(fts) if recompute else block(fts)
+        return self.particlenet.get_layer('Flatten_PN')(fts)
+
+   def recomputed_bn_statistics(self):
+        ''' moving mean and variance of the BatchNormalization layers in the blocks of recompute_blocks(setting) '''
+        prefixes = tuple('%s_%i_' % (self.name, layer_idx) for layer_idx, recompute in enumerate(recompute_blocks(self.setting)) if recompute)
+        return [stat for layer in self.particlenet.layers if prefixes and isinstance(layer, klayers.BatchNormalization) and layer.name.startswith(prefixes)
+                     for stat in (layer.moving_mean, layer.moving_variance)]
+
+   def recompute_gradients(self, tape, loss, variables):
+        ''' tape.gradient with the moving statistics of recomputed blocks restored to their forward pass values afterwards '''
+        statistics = self.recomputed_bn_statistics()
+        forward_values = [tf.identity(stat.read_value()) for stat in statistics]
+        gradients = tape.gradient(loss, variables)
+        for stat, value in zip(statistics, forward_values):
+            stat.assign(value)
+        return gradients
+
+   def call(self, inputs, training=None):
+        if any(recompute_blocks(self.setting)) and training is not False:
+            pool_layer = self.particlenet_recompute(inputs, training=training)
+        else:
+            pool_layer = self.particlenet(inputs)
         encoder_output = self.encoder(pool_layer)
         if 'vae'.lower() in self.setting.ae_type :
             z, z_mean, z_log_var = encoder_output
@@ -223,7 +307,7 @@ class PNVAE(tf.keras.Model):
        
         # Compute gradients
         trainable_vars = self.trainable_variables
-        gradients = tape.gradient(loss, trainable_vars)
+        gradients = self.recompute_gradients(tape, loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
         self.loss_tracker.update_state(loss)
@@ -261,3 +345,93 @@ class PNVAE(tf.keras.Model):
     
     
 
+
+
+class ImportanceSampledPNVAE(PNVAE):
+
+   ''' PNVAE trained on importance sampled jets (utils/importance_sampling.py) : batches are ((points, features, jet_id), features, weight),
+       the per jet losses are weighted by the importance weights and recorded in loss_store as a by-product of the forward pass
+       validation / inference use the plain PNVAE inputs
+   '''
+
+   def __init__(self, setting, loss_store, **kwargs):
+      super(ImportanceSampledPNVAE, self).__init__(setting, **kwargs)
+      self.loss_store = loss_store
+
+   def train_step(self, data):
+        (coord_in, feats_in, jet_ids) , feats_in, weights = data
+
+        with tf.GradientTape() as tape:
+            encoder_output, decoder_output  = self((coord_in, feats_in))  # Forward pass
+            jet_loss_reco = losses.threeD_loss(feats_in,decoder_output)
+            loss_reco = tf.math.reduce_mean(weights * jet_loss_reco)
+            if 'vae'.lower() in self.setting.ae_type :
+                z, z_mean, z_log_var = encoder_output
+                loss_latent = tf.math.reduce_mean(weights * losses.kl_loss(z_mean, z_log_var))
+                loss = loss_reco + self.setting.beta_kl  * loss_latent *tf.cond(tf.greater(self.beta_kl_warmup, 0), lambda: self.beta_kl_warmup, lambda: 1.)
+            else :
+                loss = loss_reco
+
+        trainable_vars = self.trainable_variables
+        gradients = self.recompute_gradients(tape, loss, trainable_vars)
+        self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_store.update(jet_ids, jet_loss_reco)
+        self.loss_tracker.update_state(loss)
+        return_metrics = {"loss": self.loss_tracker.result()}
+        if 'vae'.lower() in self.setting.ae_type :
+            self.reco_loss_tracker.update_state(loss_reco)
+            self.kl_loss_tracker.update_state(loss_latent)
+            return_metrics["reco_loss"] =  self.reco_loss_tracker.result()
+            return_metrics["kl_loss"] =  self.kl_loss_tracker.result()
+        return return_metrics
+
+
+
+class CachedBackbonePNVAE(PNVAE):
+
+   ''' PNVAE trained on cached backbone features (utils/feature_cache.py) : batches are (pool, features) and
+       train_step applies gradients to the encoder / decoder only. particlenet is left trainable (freezing it would reorder
+       the weights), so call() and the checkpoints are those of PNVAE and validation on jets and inference are unchanged
+   '''
+
+   def load_backbone(self, backbone):
+      ''' copy the particlenet weights of a trained PNVAE layer by layer by name (both built with the same name) '''
+      for layer in self.particlenet.layers:
+          if layer.weights:
+              layer.set_weights(backbone.get_layer(layer.name).get_weights())
+
+   def head_losses(self, pool, feats_in, training=False):
+        encoder_output = self.encoder(pool, training=training)
+        if 'vae'.lower() in self.setting.ae_type :
+            z, z_mean, z_log_var = encoder_output
+            loss_reco = tf.math.reduce_mean(losses.threeD_loss(feats_in,self.decoder(z, training=training)))
+            loss_latent = tf.math.reduce_mean(losses.kl_loss(z_mean, z_log_var))
+            loss = loss_reco + self.setting.beta_kl  * loss_latent *tf.cond(tf.greater(self.beta_kl_warmup, 0), lambda: self.beta_kl_warmup, lambda: 1.)
+        else :
+            loss_reco = tf.math.reduce_mean(losses.threeD_loss(feats_in,self.decoder(encoder_output, training=training)))
+            loss_latent = tf.constant(0.)
+            loss = loss_reco
+        return loss, loss_reco, loss_latent
+
+   def update_metrics(self, loss, loss_reco, loss_latent):
+        self.loss_tracker.update_state(loss)
+        return_metrics = {"loss": self.loss_tracker.result()}
+        if 'vae'.lower() in self.setting.ae_type :
+            self.reco_loss_tracker.update_state(loss_reco)
+            self.kl_loss_tracker.update_state(loss_latent)
+            return_metrics["reco_loss"] =  self.reco_loss_tracker.result()
+            return_metrics["kl_loss"] =  self.kl_loss_tracker.result()
+        return return_metrics
+
+   def train_step(self, data):
+        pool, feats_in = data
+        with tf.GradientTape() as tape:
+            loss, loss_reco, loss_latent = self.head_losses(pool, feats_in, training=True)
+        trainable_vars = self.encoder.trainable_variables + self.decoder.trainable_variables
+        gradients = tape.gradient(loss, trainable_vars)
+        self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        return self.update_metrics(loss, loss_reco, loss_latent)
+
+   def test_step(self, data):
+        pool, feats_in = data
+        return self.update_metrics(*self.head_losses(pool, feats_in, training=False))
@@ -0,0 +1,114 @@
+import numpy as np
+import tensorflow as tf
+import models.losses as losses
+import models.custom_functions as funcs
+import models.ParticleNetAE as pnae
+import models.scoring as scoring
+from models.ensemble import points_key, shared_knn
+
+''' co-training of several PNVAE variants (ae/vae, latent_dim, conv_linking, ...) on one input stream : every batch is read and
+    augmented once and fed to all variants in the same step, the kNN indices are computed once per group of variants with the
+    same points. the variants get independent gradients (each one only sees its own loss, Adam state is per variable),
+    metrics and checkpoints are kept per variant, and each checkpoint loads in a plain PNVAE
+'''
+
+
+class CoTrainer(tf.keras.Model):
+
+    def __init__(self, settings, model_name='PN_AE_', **kwargs):
+        ''' settings : dict variant name -> PNVAE setting '''
+        super(CoTrainer, self).__init__(**kwargs)
+        self.variant_names = list(settings)
+        self.variants = []
+        for variant_name in self.variant_names:
+            setting = settings[variant_name]
+            variant = pnae.PNVAE(setting=setting, name=model_name) # same layer names as a standalone run
+            dummy = np.zeros([1]+list(setting.input_shapes['features']), dtype=np.float32)
+            variant(scoring.pn_inputs(dummy), training=False) # build variables
+            self.variants.append(variant)
+        self.particlenets = [variant.build_particlenet(knn_inputs=True) for variant in self.variants]
+        self.groups = {}
+        for idx, variant in enumerate(self.variants):
+            self.groups.setdefault(points_key(variant.setting), []).append(idx)
+        self.k_max = {key: max(K for idx in members for K, _ in self.variants[idx].setting.conv_params) for key, members in self.groups.items()}
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+        self.variant_trackers = [[tf.keras.metrics.Mean(name='%s_%s' % (variant_name, metric)) for metric in ['loss', 'reco_loss', 'kl_loss']]
+                                 for variant_name in self.variant_names]
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker] + [tracker for trackers in self.variant_trackers for tracker in trackers]
+
+    def variant_losses(self, coord_in, feats_in, training=False):
+        ''' [(loss, loss_reco, loss_latent)] per variant, kNN shared within each group of variants '''
+        variant_losses = [None]*len(self.variants)
+        for key, members in self.groups.items():
+            indices = funcs.knn_indices(coord_in, self.k_max[key])
+            for idx in members:
+                variant = self.variants[idx]
+                knn = shared_knn(indices, coord_in, variant.setting)
+                encoder_output = variant.encoder(self.particlenets[idx]([feats_in]+knn, training=training), training=training)
+                if 'vae'.lower() in variant.setting.ae_type :
+                    z, z_mean, z_log_var = encoder_output
+                    loss_reco = tf.math.reduce_mean(losses.threeD_loss(feats_in, variant.decoder(z, training=training)))
+                    loss_latent = tf.math.reduce_mean(losses.kl_loss(z_mean, z_log_var))
+                    loss = loss_reco + variant.setting.beta_kl * loss_latent * tf.cond(tf.greater(variant.beta_kl_warmup, 0), lambda: variant.beta_kl_warmup, lambda: 1.)
+                else :
+                    loss_reco = tf.math.reduce_mean(losses.threeD_loss(feats_in, variant.decoder(encoder_output, training=training)))
+                    loss_latent = tf.constant(0.)
+                    loss = loss_reco
+                variant_losses[idx] = (loss, loss_reco, loss_latent)
+        return variant_losses
+
+    def update_metrics(self, variant_losses):
+        self.loss_tracker.update_state(tf.add_n([l[0] for l in variant_losses]))
+        for trackers, values in zip(self.variant_trackers, variant_losses):
+            for tracker, value in zip(trackers, values):
+                tracker.update_state(value)
+        return {m.name: m.result() for m in self.metrics}
+
+    def train_step(self, data):
+        (coord_in, feats_in) , feats_in = data
+        with tf.GradientTape() as tape:
+            variant_losses = self.variant_losses(coord_in, feats_in, training=True)
+            loss = tf.add_n([l[0] for l in variant_losses])
+        trainable_vars = self.trainable_variables
+        gradients = tape.gradient(loss, trainable_vars)
+        self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        return self.update_metrics(variant_losses)
+
+    def test_step(self, data):
+        (coord_in, feats_in) , feats_in = data
+        return self.update_metrics(self.variant_losses(coord_in, feats_in, training=False))
+
+
+class CoKLWarmupCallback(tf.keras.callbacks.Callback):
+    ''' KLWarmupCallback schedule applied to every variant '''
+
+    def on_epoch_begin(self, epoch, logs=None):
+        for variant in self.model.variants:
+            if variant.kl_warmup_time!=0 :
+                kl_value = ((epoch+1)/variant.kl_warmup_time) * (epoch < variant.kl_warmup_time) + 1.0 * (epoch >= variant.kl_warmup_time)
+            else :
+                kl_value=1
+            tf.keras.backend.set_value(variant.beta_kl_warmup, kl_value)
+
+
+class VariantCheckpoint(tf.keras.callbacks.Callback):
+    ''' ModelCheckpoint(save_best_only, save_weights_only) per variant on val_<variant>_loss,
+        filepath may use {name}, {epoch} and {val_loss}, e.g. '{name}_weights.{epoch:02d}-{val_loss:.3f}.hdf5'
+    '''
+
+    def __init__(self, filepath):
+        super(VariantCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.best = {}
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        for variant_name, variant in zip(self.model.variant_names, self.model.variants):
+            value = logs.get('val_%s_loss' % variant_name)
+            if value is None or value >= self.best.get(variant_name, np.inf):
+                continue
+            self.best[variant_name] = value
+            variant.save_weights(self.filepath.format(name=variant_name, epoch=epoch+1, val_loss=value))
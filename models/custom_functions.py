@@ -12,6 +12,14 @@ def batch_distance_matrix_general(A, B):
         D = r_A - 2 * m + tf.transpose(r_B, perm=(0, 2, 1))
         return D
 
+def knn_indices(points, k):
+    # points: (N, P, C_p) -> indices of the k nearest neighbours (N, P, K), self excluded, sorted by distance
+    # the first k' columns of knn_indices(points, k) are the k' < k nearest neighbours : one call serves several K
+    with tf.name_scope('knn_indices'):
+        D = batch_distance_matrix_general(points, points)  # (N, P, P)
+        _, indices = tf.nn.top_k(-D, k=k + 1)  # (N, P, K+1)
+        return indices[:, :, 1:]  # (N, P, K)
+
 def knn(num_points, k, topk_indices, features):
     # topk_indices: (N, P, K)
     # features: (N, P, C)
@@ -23,3 +31,57 @@ def knn(num_points, k, topk_indices, features):
         return tf.gather_nd(features, indices)
 
 
+
+def grid_knn_indices(points, k, points_per_cell=None, cell_capacity=None):
+    # approximate knn_indices for fixed 2D (eta, phi) points, same output (N, P, K), O(P K) memory instead of O(P^2)
+    # every jet is binned in a G x G grid of equal population along each axis (rank binning, ~points_per_cell per cell),
+    # neighbours are searched in the 3 x 3 cells around each point only, at most cell_capacity points per cell are considered
+    num_points = points.shape[1]
+    points_per_cell = points_per_cell or max(k // 2, 1)
+    cell_capacity = cell_capacity or 3 * points_per_cell
+    G = max(1, int(round((num_points / points_per_cell) ** 0.5)))
+    n_candidates = 9 * cell_capacity
+    assert points.shape[-1] == 2, 'grid kNN : (eta, phi) points only, use the exact engine on feature space'
+    assert n_candidates >= k, 'grid kNN : 9 * cell_capacity must be >= k'
+    with tf.name_scope('grid_knn_indices'):
+        batch_size = tf.shape(points)[0]
+
+        def bin_axis(x):
+            rank = tf.argsort(tf.argsort(x, axis=1, stable=True), axis=1)
+            return rank * G // num_points  # (N, P) in [0, G)
+
+        cx, cy = bin_axis(points[:, :, 0]), bin_axis(points[:, :, 1])
+        cell = cx * G + cy
+        order = tf.argsort(cell, axis=1, stable=True)  # points sorted by cell
+        sorted_cell = tf.gather(cell, order, batch_dims=1)
+        all_cells = tf.tile(tf.range(G * G)[tf.newaxis, :], (batch_size, 1))
+        cell_start = tf.searchsorted(sorted_cell, all_cells, side='left')  # (N, G*G)
+        cell_end = tf.searchsorted(sorted_cell, all_cells, side='right')
+
+        dx = tf.constant([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+        dy = tf.constant([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+        ncx, ncy = cx[:, :, tf.newaxis] + dx, cy[:, :, tf.newaxis] + dy  # (N, P, 9)
+        inside = (ncx >= 0) & (ncx < G) & (ncy >= 0) & (ncy < G)
+        ncell = tf.clip_by_value(ncx, 0, G - 1) * G + tf.clip_by_value(ncy, 0, G - 1)
+        start = tf.gather(cell_start, ncell, batch_dims=1)
+        count = tf.gather(cell_end, ncell, batch_dims=1) - start
+        slot = tf.range(cell_capacity)
+        position = tf.reshape(tf.minimum(start[..., tf.newaxis] + slot, num_points - 1), (batch_size, num_points, n_candidates))
+        valid = tf.reshape(inside[..., tf.newaxis] & (slot < count[..., tf.newaxis]), (batch_size, num_points, n_candidates))
+        candidates = tf.gather(order, position, batch_dims=1)  # (N, P, 9*C)
+        valid = valid & tf.not_equal(candidates, tf.range(num_points)[tf.newaxis, :, tf.newaxis])  # self excluded
+
+        D = tf.reduce_sum(tf.square(tf.gather(points, candidates, batch_dims=1) - tf.expand_dims(points, axis=2)), axis=-1)
+        D = tf.where(valid, D, float('inf'))
+        neg_D, top = tf.nn.top_k(-D, k=k)  # (N, P, K)
+        indices = tf.gather(candidates, top, batch_dims=2)
+        # fewer than k valid candidates (sparse or degenerate cells, e.g. padded constituents sharing one coordinate) :
+        # the missing slots repeat the nearest valid neighbour, the point itself if it has none
+        found = tf.math.is_finite(neg_D)
+        self_index = tf.tile(tf.range(num_points)[tf.newaxis, :, tf.newaxis], (batch_size, 1, 1))
+        nearest = tf.where(found[:, :, :1], indices[:, :, :1], self_index)  # (N, P, 1)
+        return tf.where(found, indices, nearest)
+
+
+# kNN engines selectable per EdgeConv block (setting.knn_engines)
+KNN_ENGINES = {'exact': knn_indices, 'grid': grid_knn_indices}
@@ -0,0 +1,55 @@
+import time
+import numpy as np
+import h5py
+import models.scoring as scoring
+
+
+def cache_teacher_targets(teacher, filename, out_path, dataset='particle_bg', n=None, read_rows=65536, batch_size=1024):
+    ''' one pass of the PNVAE teacher over filename[dataset], writes per jet score and z_mean to out_path (hdf5) '''
+    with h5py.File(filename, 'r') as inFile, h5py.File(out_path, 'w') as outFile:
+        ds = inFile[dataset]
+        n = ds.shape[0] if n is None else min(n, ds.shape[0])
+        out_score = outFile.create_dataset('score', shape=(n,), dtype='float32')
+        out_z = outFile.create_dataset('z_mean', shape=(n, teacher.latent_dim), dtype='float32')
+        for sl in scoring.batch_slices(n, read_rows):
+            particles = ds[sl]
+            out_score[sl], out_z[sl] = scoring.scores_and_embeddings(teacher, scoring.pn_inputs(particles), particles, batch_size=batch_size)
+        outFile.attrs['source'] = filename
+        outFile.attrs['dataset'] = dataset
+
+
+def load_teacher_targets(targets_path, n=None):
+    ''' log(score), z_mean : the student regresses the log of the (heavy tailed) Chamfer score '''
+    with h5py.File(targets_path, 'r') as f:
+        score = f['score'][0:n]
+        z_mean = f['z_mean'][0:n]
+    return np.log(np.maximum(score, 1e-12)), z_mean
+
+
+def student_scores(student, particles, batch_size=4096):
+    scores = np.empty(particles.shape[0], dtype=np.float32)
+    for sl in scoring.batch_slices(particles.shape[0], batch_size):
+        scores[sl] = np.exp(student(particles[sl], training=False)[0].numpy())
+    return scores
+
+
+def compare_to_teacher(student, teacher, particles, labels=None, batch_size=1024):
+    ''' throughput (jets/s) of student and teacher, correlation of the scores and AUCs if labels (1 = signal) are given '''
+    from scipy.stats import pearsonr, spearmanr
+    from sklearn.metrics import roc_auc_score
+    student_scores(student, particles[:batch_size]) # warmup
+    scoring.reco_loss_scores(teacher, scoring.pn_inputs(particles[:batch_size]), particles[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    s_student = student_scores(student, particles)
+    student_time = time.perf_counter() - start
+    start = time.perf_counter()
+    s_teacher = scoring.reco_loss_scores(teacher, scoring.pn_inputs(particles), particles, batch_size=batch_size)
+    teacher_time = time.perf_counter() - start
+    report = {'student_jets_per_s': particles.shape[0]/student_time,
+              'teacher_jets_per_s': particles.shape[0]/teacher_time,
+              'pearson_log': pearsonr(np.log(np.maximum(s_student, 1e-12)), np.log(np.maximum(s_teacher, 1e-12)))[0],
+              'spearman': spearmanr(s_student, s_teacher)[0]}
+    if labels is not None:
+        report['student_auc'] = roc_auc_score(labels, s_student)
+        report['teacher_auc'] = roc_auc_score(labels, s_teacher)
+    return report
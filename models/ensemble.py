@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import tensorflow as tf
+import models.losses as losses
+import models.custom_functions as funcs
+import models.scoring as scoring
+import models.ParticleNetAE as pnae
+
+''' one pass scoring of several PNVAE checkpoints : every batch is read once and fed to all models.
+    without mask every EdgeConv block builds its kNN graph on the input points, so models with the same points
+    share one distance matrix / top_k : the K nearest neighbours of a block are the first K columns of the top_k with the largest K
+    (blocks with an approximate kNN engine compute their own indices)
+'''
+
+
+def geometric_mean(scores):
+    return np.exp(np.mean(np.log(np.maximum(scores, 1e-12)), axis=1))
+
+
+DEFAULT_COMBINATIONS = {'mean': lambda scores: np.mean(scores, axis=1),
+                        'max': lambda scores: np.max(scores, axis=1),
+                        'min': lambda scores: np.min(scores, axis=1),
+                        'geomean': geometric_mean}
+
+
+def weighted_mean(weights):
+    ''' combination : weighted mean of the model scores, weights in model order '''
+    weights = np.asarray(weights, dtype=np.float32) / np.sum(weights)
+    return lambda scores: scores @ weights
+
+
+def points_key(setting):
+    ''' models with the same key build their kNN graphs on the same points '''
+    return (setting.num_points, tuple(setting.input_shapes['points']))
+
+
+def shared_knn(indices, points, setting):
+    ''' kNN inputs of the blocks of setting : first K columns of the shared exact indices, own indices for the other engines '''
+    return [indices[:, :, :K] if engine == 'exact' else funcs.KNN_ENGINES[engine](points, K)
+            for (K, _), engine in zip(setting.conv_params, pnae.knn_engines(setting))]
+
+
+class EnsembleScorer():
+
+    ''' per model reconstruction loss of N PNVAE models in one forward pass per batch, kNN indices shared where the points agree
+        combinations : name -> function of the [batch x n_models] scores returning [batch] (DEFAULT_COMBINATIONS by default)
+    '''
+
+    def __init__(self, models, names=None, combinations=None, loss_fn=losses.threeD_loss):
+        self.models = models
+        self.names = names or ['model_%d' % idx for idx in range(len(models))]
+        self.combinations = DEFAULT_COMBINATIONS if combinations is None else combinations
+        self.loss_fn = loss_fn
+        self.particlenets = [model.build_particlenet(knn_inputs=True) for model in models]
+        self.groups = {}
+        for idx, model in enumerate(models):
+            self.groups.setdefault(points_key(model.setting), []).append(idx)
+        self.k_max = {key: max(K for idx in members for K, _ in models[idx].setting.conv_params) for key, members in self.groups.items()}
+        self._score_batch = tf.function(self.score_batch)
+
+    def score_batch(self, particles):
+        ''' [batch x n_models] reconstruction losses '''
+        points, features = scoring.pn_inputs(particles)
+        scores = [None]*len(self.models)
+        for key, members in self.groups.items():
+            indices = funcs.knn_indices(points, self.k_max[key]) # computed once for the whole group
+            for idx in members:
+                model = self.models[idx]
+                knn = shared_knn(indices, points, model.setting)
+                pool = self.particlenets[idx]([features]+knn, training=False)
+                z, _ = scoring.split_encoder_output(model.encoder(pool, training=False))
+                scores[idx] = self.loss_fn(particles, model.decoder(z, training=False))
+        return tf.stack(scores, axis=1)
+
+    def combine(self, scores):
+        return {name: fn(scores).astype(np.float32) for name, fn in self.combinations.items()}
+
+    def __call__(self, particles, batch_size=1024):
+        ''' particles -> [N x n_models] scores '''
+        scores = np.empty((particles.shape[0], len(self.models)), dtype=np.float32)
+        for sl in scoring.batch_slices(particles.shape[0], batch_size):
+            scores[sl] = self._score_batch(tf.convert_to_tensor(particles[sl], dtype=tf.float32)).numpy()
+        return scores
+
+    def score_file(self, filename, out_path, dataset='particle_bg', start=0, end=None, read_rows=65536, batch_size=1024):
+        ''' one streaming pass over filename[dataset] : all per model scores and the combinations are written to out_path (hdf5) '''
+        import h5py
+        with h5py.File(filename, 'r') as inFile, h5py.File(out_path, 'w') as outFile:
+            ds = inFile[dataset]
+            end = ds.shape[0] if end is None else min(end, ds.shape[0])
+            n = end - start
+            out_scores = outFile.create_dataset('scores', shape=(n, len(self.models)), dtype='float32')
+            out_scores.attrs['models'] = [str(name) for name in self.names]
+            out_comb = {name: outFile.create_dataset('combined/' + name, shape=(n,), dtype='float32') for name in self.combinations}
+            for sl in scoring.batch_slices(n, read_rows):
+                scores = self(ds[start+sl.start:start+sl.stop], batch_size=batch_size)
+                out_scores[sl] = scores
+                for name, combined in self.combine(scores).items():
+                    out_comb[name][sl] = combined
+            for idx, name in enumerate(self.names):
+                outFile['models/' + name] = outFile['scores'][:, idx]
+            outFile.attrs['source'] = filename
+            outFile.attrs['dataset'] = dataset
+
+
+def load_ensemble(settings, weights_paths, names=None, combinations=None):
+    ''' one PNVAE per (setting, checkpoint), named after the checkpoint file by default '''
+    models = [scoring.load_pnvae(setting, weights_path) for setting, weights_path in zip(settings, weights_paths)]
+    names = names or [os.path.splitext(os.path.basename(path))[0] for path in weights_paths]
+    return EnsembleScorer(models, names=names, combinations=combinations)
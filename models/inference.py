@@ -0,0 +1,262 @@
+import json
+import numpy as np
+import tensorflow as tf
+import models.losses as losses
+import models.layers as layers
+import models.models as models
+import models.custom_functions as funcs
+import models.ParticleNetAE as pnae
+import models.numpy_inference as npinf
+
+''' lean inference version of a trained PNVAE : BatchNormalization folded into the preceding conv / dense weights,
+    1x1 Conv2D (with their expand_dims / squeeze) rewritten as matmuls on the last axis, and the latent sampling
+    replaced by z_mean (deterministic). export_inference_model() checks it against the original model,
+    export_npz() writes the same weights for the TensorFlow-free forward pass of models/numpy_inference.py
+'''
+
+
+def fold_batchnorm(kernel, bias, bn):
+    ''' kernel [C_in x C_out], bias [C_out] or None, followed by bn -> single (kernel, bias) '''
+    scale = bn.gamma.numpy() if bn.scale else np.ones(kernel.shape[-1], dtype=np.float32)
+    shift = bn.beta.numpy() if bn.center else np.zeros(kernel.shape[-1], dtype=np.float32)
+    scale = scale / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    bias = np.zeros(kernel.shape[-1], dtype=np.float32) if bias is None else bias
+    return kernel * scale[np.newaxis, :], (bias - bn.moving_mean.numpy()) * scale + shift
+
+
+def layer_weights(layer, bn=None):
+    ''' (kernel [C_in x C_out], bias) of a Dense or 1x1 Conv2D layer, with bn folded in if given '''
+    kernel = layer.kernel.numpy()
+    kernel = kernel.reshape(-1, kernel.shape[-1])
+    bias = layer.bias.numpy() if layer.use_bias else None
+    if bn is not None:
+        return fold_batchnorm(kernel, bias, bn)
+    return kernel, np.zeros(kernel.shape[-1], dtype=np.float32) if bias is None else bias
+
+
+def dense_last_axis(x, kernel, bias):
+    ''' x [..., C_in] . kernel + bias as one 2D matmul '''
+    shape = tf.shape(x)
+    y = tf.matmul(tf.reshape(x, [-1, kernel.shape[0]]), kernel) + bias
+    return tf.reshape(y, tf.concat([shape[:-1], [kernel.shape[1]]], axis=0))
+
+
+class LeanPNVAE(tf.Module):
+
+    ''' folded, deterministic PNVAE forward pass : __call__(points, features) -> (z_mean, reconstruction) '''
+
+    def __init__(self, model, name=None):
+        super(LeanPNVAE, self).__init__(name=name)
+        setting, prefix = model.setting, model.name
+        self.setting = setting
+        activation = setting.activation
+        self.activation = tf.keras.activations.get(activation) if isinstance(activation, str) else activation
+        bn = lambda sub, bn_name: sub.get_layer(bn_name) if model.with_bn else None
+        variable = lambda w, name: tf.Variable(np.asarray(w, dtype=np.float32), trainable=False, name=name)
+
+        self.blocks = []
+        self.knn_engines = pnae.knn_engines(setting)
+        self.fused = pnae.fused_blocks(setting)
+        for b, (K, channels) in enumerate(setting.conv_params):
+            block_name = '%s_%i' % (prefix, b)
+            convs = [layer_weights(model.particlenet.get_layer('%s_conv%d' % (block_name, j)), bn(model.particlenet, '%s_bn%d' % (block_name, j)))
+                     for j in range(len(channels))]
+            sc = layer_weights(model.particlenet.get_layer('%s_sc_conv' % block_name), bn(model.particlenet, '%s_sc_bn' % block_name))
+            self.blocks.append((K, [(variable(w, '%s_conv%d_w' % (block_name, j)), variable(c, '%s_conv%d_b' % (block_name, j)))
+                                    for j, (w, c) in enumerate(convs)],
+                                (variable(sc[0], '%s_sc_w' % block_name), variable(sc[1], '%s_sc_b' % block_name))))
+
+        if 'vae' in setting.ae_type:
+            latent = model.sampling.get_layer('z_mean')
+        else:
+            latent = [l for l in model.encoder.layers if isinstance(l, tf.keras.layers.Dense)][0]
+        self.latent = tuple(variable(w, 'z_mean_' + n) for w, n in zip(layer_weights(latent), ['w', 'b']))
+
+        dense = [l for l in model.decoder.layers if isinstance(l, tf.keras.layers.Dense)][0]
+        self.decoder_dense = tuple(variable(w, 'dense_0_' + n) for w, n in zip(layer_weights(dense, bn(model.decoder, '%s_dense_0' % prefix)), ['w', 'b']))
+        self.decoder_convs = []
+        for j in range(1, len(setting.conv_params_decoder)):
+            w, c = layer_weights(model.decoder.get_layer('%s_conv_%d' % (prefix, j)), bn(model.decoder, '%s_bn_%d' % (prefix, j)))
+            self.decoder_convs.append((variable(w, 'conv_%d_w' % j), variable(c, 'conv_%d_b' % j)))
+        self.decoder_out = tuple(variable(w, 'conv_out_' + n) for w, n in zip(layer_weights(model.decoder.get_layer('%s_conv_out' % prefix)), ['w', 'b']))
+
+    def act(self, x):
+        return self.activation(x) if self.activation else x
+
+    def encode(self, points, features):
+        fts = features
+        for (K, convs, (sc_w, sc_b)), engine, fused in zip(self.blocks, self.knn_engines, self.fused):
+            indices = funcs.KNN_ENGINES[engine](points, K)
+            if fused:
+                # first (folded) conv applied per point before the gather : W(x_j - x_i) + c = Wx_j - Wx_i + c
+                proj = dense_last_axis(fts, convs[0][0], 0.) # (N, P, C1)
+                x = self.act(tf.gather(proj, indices, batch_dims=1) - tf.expand_dims(proj, axis=2) + convs[0][1]) # (N, P, K, C1)
+            else:
+                x = self.act(dense_last_axis(funcs.knn(self.setting.num_points, K, indices, fts) - tf.expand_dims(fts, axis=2), *convs[0]))
+            for w, c in convs[1:]:
+                x = self.act(dense_last_axis(x, w, c))
+            pooled = tf.reduce_max(x, axis=2) if self.setting.conv_pooling == 'max' else tf.reduce_mean(x, axis=2)
+            sc = dense_last_axis(fts, sc_w, sc_b)
+            fts = self.act(tf.concat([sc, pooled], axis=2) if self.setting.conv_linking == 'concat' else sc + pooled)
+        pool = tf.reshape(fts, [tf.shape(fts)[0], -1])
+        return self.act(tf.matmul(pool, self.latent[0]) + self.latent[1])
+
+    def decode(self, z):
+        x = self.act(tf.matmul(z, self.decoder_dense[0]) + self.decoder_dense[1])
+        x = tf.reshape(x, [-1, self.setting.num_points, self.setting.conv_params_decoder[0]])
+        for w, c in self.decoder_convs:
+            x = self.act(dense_last_axis(x, w, c))
+        return self.act(dense_last_axis(x, *self.decoder_out))
+
+    @tf.function
+    def __call__(self, points, features):
+        z_mean = self.encode(points, features)
+        return z_mean, self.decode(z_mean)
+
+    def scores(self, particles, batch_size=1024):
+        ''' per jet reconstruction loss (threeD_loss) of the deterministic reconstruction '''
+        scores = np.empty(particles.shape[0], dtype=np.float32)
+        for start in range(0, particles.shape[0], batch_size):
+            batch = tf.convert_to_tensor(particles[start:start+batch_size], dtype=tf.float32)
+            _, reco = self(batch[:,:,0:2], batch)
+            scores[start:start+batch_size] = losses.threeD_loss(batch, reco).numpy()
+        return scores
+
+
+def reference_outputs(model, points, features):
+    ''' z_mean and its reconstruction from the original model (decoder run on z_mean, no sampling) '''
+    encoder_output = model.encoder(model.particlenet((points, features), training=False), training=False)
+    z_mean = encoder_output[1] if 'vae' in model.setting.ae_type else encoder_output
+    return z_mean, model.decoder(z_mean, training=False)
+
+
+def max_abs_difference(model, lean, particles):
+    points, features = particles[:,:,0:2], particles
+    z_ref, reco_ref = reference_outputs(model, points, features)
+    z_lean, reco_lean = lean(tf.convert_to_tensor(points), tf.convert_to_tensor(features))
+    return float(np.max(np.abs(z_ref.numpy() - z_lean.numpy()))), float(np.max(np.abs(reco_ref.numpy() - reco_lean.numpy())))
+
+
+def export_inference_model(model, check_particles=None, atol=1e-4, save_path=None):
+    ''' LeanPNVAE of a trained PNVAE, checked against it on check_particles (ValueError above atol), optionally saved (tf.saved_model) '''
+    lean = LeanPNVAE(model, name='Lean' + model.name.strip('_'))
+    if check_particles is not None:
+        check_particles = np.asarray(check_particles, dtype=np.float32)
+        diff_z, diff_reco = max_abs_difference(model, lean, check_particles)
+        if max(diff_z, diff_reco) > atol:
+            raise ValueError('lean model differs from the original : max |dz| = {:.2e}, max |dreco| = {:.2e} (atol {:.1e})'.format(diff_z, diff_reco, atol))
+    if save_path is not None:
+        setting = model.setting
+        signature = lean.__call__.get_concrete_function(tf.TensorSpec([None]+list(setting.input_shapes['points']), tf.float32),
+                                                        tf.TensorSpec([None]+list(setting.input_shapes['features']), tf.float32))
+        tf.saved_model.save(lean, save_path, signatures=signature)
+    return lean
+
+
+def activation_spec(activation):
+    ''' [name, *args] of a keras activation for models.numpy_inference.activation '''
+    if activation is None:
+        return ['linear']
+    if isinstance(activation, tf.keras.layers.LeakyReLU):
+        return ['leaky_relu', float(activation.alpha)]
+    name = activation if isinstance(activation, str) else getattr(activation, '__name__', None)
+    if name not in npinf.ACTIVATIONS:
+        raise ValueError('no numpy implementation of activation {}'.format(activation))
+    return [name]
+
+
+def pnvae_npz_content(model):
+    ''' (meta, arrays) of a PNVAE, weights folded as in LeanPNVAE '''
+    lean = LeanPNVAE(model)
+    setting = lean.setting
+    arrays, blocks = {}, []
+    for b, ((K, convs, (sc_w, sc_b)), engine, fused) in enumerate(zip(lean.blocks, lean.knn_engines, lean.fused)):
+        for j, (w, c) in enumerate(convs):
+            arrays['block%d_conv%d_w' % (b, j)], arrays['block%d_conv%d_b' % (b, j)] = w.numpy(), c.numpy()
+        arrays['block%d_sc_w' % b], arrays['block%d_sc_b' % b] = sc_w.numpy(), sc_b.numpy()
+        blocks.append(dict(K=K, n_convs=len(convs), knn_engine=engine, fused=fused))
+    arrays['latent_w'], arrays['latent_b'] = [v.numpy() for v in lean.latent]
+    arrays['dense_0_w'], arrays['dense_0_b'] = [v.numpy() for v in lean.decoder_dense]
+    for j, (w, c) in enumerate(lean.decoder_convs):
+        arrays['decoder_conv%d_w' % j], arrays['decoder_conv%d_b' % j] = w.numpy(), c.numpy()
+    arrays['conv_out_w'], arrays['conv_out_b'] = [v.numpy() for v in lean.decoder_out]
+    meta = dict(model='pnvae', num_points=setting.num_points, conv_pooling=setting.conv_pooling, conv_linking=setting.conv_linking,
+                activation=activation_spec(setting.activation), blocks=blocks, n_decoder_convs=len(lean.decoder_convs))
+    return meta, arrays
+
+
+def graph_ops(submodel, arrays, prefix, last_layer=None):
+    ''' ops of a functional GraphConvolution* encoder / decoder up to last_layer (z_mean of the VAEs), weights added to arrays '''
+    ops = []
+    for layer in submodel.layers:
+        if isinstance(layer, tf.keras.layers.InputLayer):
+            continue
+        key = '%s_%d' % (prefix, len(ops))
+        if isinstance(layer, (layers.GraphConvolution, layers.GraphConvolutionRecurBias, layers.GraphConvolutionBias)):
+            self_loop = not isinstance(layer, layers.GraphConvolutionBias)
+            arrays[key + '_w1'], arrays[key + '_b'] = layer.wgt1.numpy(), layer.bias.numpy()
+            if self_loop:
+                arrays[key + '_w2'] = layer.wgt2.numpy()
+            ops.append(dict(op='graph_conv', key=key, self_loop=self_loop, activation=activation_spec(layer.activation)))
+        elif isinstance(layer, tf.keras.layers.Dense):
+            arrays[key + '_w'], arrays[key + '_b'] = layer.kernel.numpy(), layer.bias.numpy()
+            ops.append(dict(op='dense', key=key, activation=activation_spec(layer.activation)))
+        elif isinstance(layer, tf.keras.layers.Flatten):
+            ops.append(dict(op='flatten'))
+        elif isinstance(layer, tf.keras.layers.Reshape):
+            ops.append(dict(op='reshape', target_shape=[int(d) for d in layer.target_shape]))
+        else:
+            raise TypeError('no numpy implementation of layer {} ({})'.format(layer.name, type(layer).__name__))
+        if layer.name == last_layer:
+            break
+    return ops
+
+
+def graph_npz_content(model):
+    ''' (meta, arrays) of a dense adjacency GraphConvolution* autoencoder, deterministic (z_mean) for the VAEs '''
+    arrays = {}
+    encoder = model.encoder
+    last_layer = encoder.output_names[1] if len(encoder.outputs) == 3 else encoder.output_names[0]
+    meta = dict(model='graph', nodes_n=model.nodes_n, encoder=graph_ops(encoder, arrays, 'encoder', last_layer=last_layer))
+    if isinstance(model.decoder, layers.InnerProductDecoder):
+        meta['decoder'] = [dict(op='inner_product', activation=activation_spec(model.decoder.activation))]
+    else:
+        meta['decoder'] = graph_ops(model.decoder, arrays, 'decoder')
+    return meta, arrays
+
+
+def graph_reference_outputs(model, features, adjacency):
+    ''' z (z_mean for the VAEs) and the reconstruction of the original graph model '''
+    encoder_output = model.encoder((features, adjacency), training=False)
+    if isinstance(encoder_output, (list, tuple)):
+        encoder_output = encoder_output[1] if len(encoder_output) == 3 else encoder_output[0]
+    if isinstance(model.decoder, layers.InnerProductDecoder):
+        return encoder_output, model.decoder(encoder_output)
+    return encoder_output, model.decoder((encoder_output, adjacency), training=False)
+
+
+def export_npz(model, path, check_inputs=None, atol=1e-4):
+    ''' weights of a trained PNVAE or dense adjacency GraphConvolution* model written to path (.npz appended if missing) for numpy_inference,
+        the numpy model read back from path is returned, checked against the original on check_inputs (ValueError above atol) :
+        particles for a PNVAE, (features, adjacency) for the graph models
+    '''
+    if isinstance(model, pnae.PNVAE):
+        meta, arrays = pnvae_npz_content(model)
+    elif isinstance(model, models.GraphAutoencoder): # GraphConvolution* encoders on a dense adjacency
+        meta, arrays = graph_npz_content(model)
+    else:
+        raise TypeError('export_npz : no numpy forward pass for {}'.format(type(model).__name__))
+    np.savez(npinf.npz_path(path), meta=np.array(json.dumps(meta)), **arrays)
+    np_model = npinf.load_npz(path)
+    if check_inputs is not None:
+        if meta['model'] == 'pnvae':
+            particles = np.asarray(check_inputs, dtype=np.float32)
+            inputs = (particles[:,:,0:2], particles)
+            reference = reference_outputs(model, *inputs)
+        else:
+            inputs = tuple(np.asarray(x, dtype=np.float32) for x in check_inputs)
+            reference = graph_reference_outputs(model, *inputs)
+        diff_z, diff_reco = [float(np.max(np.abs(ref.numpy() - out))) for ref, out in zip(reference, np_model(*inputs))]
+        if max(diff_z, diff_reco) > atol:
+            raise ValueError('numpy model differs from the original : max |dz| = {:.2e}, max |dreco| = {:.2e} (atol {:.1e})'.format(diff_z, diff_reco, atol))
+    return np_model
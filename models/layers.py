@@ -2,7 +2,18 @@ import tensorflow as tf
 import tensorflow.keras.layers as klayers
 from tensorflow import keras
 import models.custom_functions as funcs
- 
+
+
+
+def propagate(adjacency, xw):
+    ''' A.XW for a dense adjacency [batch x P x P] with xw [batch x P x C], or for the edge index (senders, receivers, weights)
+        of a disjoint union graph (see utils.preprocessing.knn_graph) with xw [n_nodes x C] : gather + unsorted_segment_sum, O(n_edges)
+    '''
+    if isinstance(adjacency, (tuple, list)):
+        senders, receivers, weights = adjacency
+        messages = tf.gather(xw, senders) * weights[:, tf.newaxis]
+        return tf.math.unsorted_segment_sum(messages, receivers, num_segments=tf.shape(xw)[0])
+    return tf.matmul(adjacency, xw)
 
 
 class GraphConvolution(tf.keras.layers.Layer):
@@ -24,7 +35,7 @@ class GraphConvolution(tf.keras.layers.Layer):
     def call(self, inputs, adjacency):
         xw1 = tf.matmul(inputs, self.wgt1)
         xw2 = tf.matmul(inputs, self.wgt2)
-        axw1 = tf.matmul(adjacency, xw1)
+        axw1 = propagate(adjacency, xw1)
         axw = axw1 + xw2           # add node and neighbours weighted features (self reccurency)
         layer = tf.nn.bias_add(axw, self.bias) 
         return self.activation(layer)
@@ -54,7 +65,7 @@ class GraphConvolutionRecurBias(tf.keras.layers.Layer):
     def call(self, inputs, adjacency):
         xw1 = tf.matmul(inputs, self.wgt1)
         xw2 = tf.matmul(inputs, self.wgt2)
-        axw1 = tf.matmul(adjacency, xw1)
+        axw1 = propagate(adjacency, xw1)
         axw = axw1 + xw2           # add node and neighbours weighted features (self reccurency)
         layer = tf.nn.bias_add(axw, self.bias) 
         return self.activation(layer)
@@ -83,7 +94,7 @@ class GraphConvolutionBias(tf.keras.layers.Layer):
 
     def call(self, inputs, adjacency):
         xw1 = tf.matmul(inputs, self.wgt1)
-        axw1 = tf.matmul(adjacency, xw1)
+        axw1 = propagate(adjacency, xw1)
         layer = tf.nn.bias_add(axw1, self.bias) 
         return self.activation(layer)
     
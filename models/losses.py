@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 import numpy as np
 
@@ -21,6 +23,17 @@ def threeD_loss(inputs, outputs): #[batch_size x 100 x 3] -> [batch_size]
     return tf.math.reduce_mean(min_dist_to_inputs, 1) + tf.math.reduce_mean(min_dist_to_outputs, 1)
 
 
+def threeD_loss_masked(inputs, outputs, mask): #[batch_size x P x 3], mask [batch_size x P] -> [batch_size]
+    ''' threeD_loss over the real constituents only (same mask for inputs and outputs), for variable size jets padded to P
+        a jet without real constituents has loss 0 '''
+    distances = tf.math.reduce_sum(tf.math.squared_difference(tf.expand_dims(inputs, 2), tf.expand_dims(outputs, 1)), -1)
+    distances = tf.where(tf.logical_and(mask[:,:,tf.newaxis], mask[:,tf.newaxis,:]), distances, 1e9)
+    min_dist_to_inputs = tf.where(mask, tf.math.reduce_min(distances,1), 0.)
+    min_dist_to_outputs = tf.where(mask, tf.math.reduce_min(distances,2), 0.)
+    n_real = tf.math.maximum(tf.math.reduce_sum(tf.cast(mask, inputs.dtype), 1), 1.)
+    return (tf.math.reduce_sum(min_dist_to_inputs, 1) + tf.math.reduce_sum(min_dist_to_outputs, 1)) / n_real
+
+
 def threeD_loss_manual(inputs, outputs):
     distances = np.sum(np.subtract(inputs[:,:,np.newaxis,:],outputs[:,np.newaxis,:,:])**2, axis=-1)
     min_dist_to_inputs = np.min(distances,axis=1)
@@ -28,6 +41,39 @@ def threeD_loss_manual(inputs, outputs):
     return np.sum(min_dist_to_inputs,axis=1) + np.sum(min_dist_to_outputs,axis=1)
 
 
+def _threeD_loss_chunk(inputs, outputs):
+    ''' same as threeD_loss on one chunk, D[i,j] = |x_i|^2 - 2 x_i.y_j + |y_j|^2 without the [n x 100 x 100 x 3] broadcast '''
+    inputs, outputs = inputs.astype(np.float32, copy=False), outputs.astype(np.float32, copy=False)
+    distances = np.matmul(inputs, outputs.transpose(0,2,1)) # [n x 100 x 100]
+    distances *= -2.
+    distances += np.sum(np.square(inputs), axis=-1)[:,:,np.newaxis]
+    distances += np.sum(np.square(outputs), axis=-1)[:,np.newaxis,:]
+    np.maximum(distances, 0., out=distances) # rounding of the expanded form
+    return np.mean(np.min(distances,axis=1),axis=1) + np.mean(np.min(distances,axis=2),axis=1)
+
+
+def _mse_loss_chunk(inputs, outputs):
+    inputs, outputs = inputs.reshape(inputs.shape[0],-1), outputs.reshape(outputs.shape[0],-1)
+    return np.mean(np.square(outputs.astype(np.float32, copy=False)-inputs), axis=-1)
+
+
+def _chunked_loss(chunk_fn, inputs, outputs, chunk_size, n_threads):
+    ''' chunk_fn over fixed-size chunks of jets on a thread pool (numpy releases the GIL), written into a preallocated [N] vector '''
+    n = inputs.shape[0]
+    loss = np.empty(n, dtype=np.float32)
+    def run(start):
+        sl = slice(start, min(start+chunk_size, n))
+        loss[sl] = chunk_fn(inputs[sl], outputs[sl])
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        list(pool.map(run, range(0, n, chunk_size)))
+    return loss
+
+
+def threeD_loss_eval(inputs, outputs, chunk_size=512, n_threads=None): #[N x 100 x 3] -> [N]
+    ''' numpy evaluation version of threeD_loss (mean over points, same values), memory bounded by chunk_size x 100 x 100 per thread '''
+    return _chunked_loss(_threeD_loss_chunk, inputs, outputs, chunk_size, n_threads)
+
+
 # wrapper for mse loss to pass as reco loss
 @tf.function
 def mse_loss(inputs, outputs):
@@ -41,3 +87,8 @@ def mse_loss_manual(inputs, outputs):
     return np.array(reconstruction_loss)
 
 
+def mse_loss_eval(inputs, outputs, chunk_size=4096, n_threads=None): #[N x 100 x 3] -> [N]
+    ''' per jet mse as mse_loss_manual, chunked on a thread pool (mse_loss is the batch mean of it) '''
+    return _chunked_loss(_mse_loss_chunk, inputs, outputs, chunk_size, n_threads)
+
+
@@ -6,6 +6,12 @@ from keras import backend as K
 import models.PNmodel as pn
 
 
+def pos_weight_from_adjacency(adj_orig):
+    ''' no-edge vs edge ratio over the batch, from dynamic shapes so it traces under tf.function '''
+    n_edges = tf.math.reduce_sum(adj_orig)
+    return (tf.cast(tf.size(adj_orig), tf.float32) - n_edges) / n_edges
+
+
 class GraphAutoencoder(tf.keras.Model):
 
     def __init__(self, nodes_n, feat_sz, activation=tf.nn.tanh, **kwargs):
@@ -18,6 +24,7 @@ class GraphAutoencoder(tf.keras.Model):
         self.loss_fn = tf.nn.weighted_cross_entropy_with_logits
         self.encoder = self.build_encoder()
         self.decoder = layers.InnerProductDecoder(activation=tf.keras.activations.linear) # if activation sigmoid -> return probabilities from logits
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
     
     def build_encoder(self):
         ''' reduce feat_sz to 2 '''
@@ -42,15 +49,19 @@ class GraphAutoencoder(tf.keras.Model):
         adj_pred = self.decoder(z)
         return z, adj_pred
 
+    @property
+    def metrics(self):
+        return [self.loss_tracker]
+
     def train_step(self, data):
         (X, adj_tilde), adj_orig = data
         # pos_weight = zero-adj / one-adj -> no-edge vs edge ratio
-        pos_weight = tf.cast(adj_orig.shape[1] * adj_orig.shape[2] - tf.math.reduce_sum(adj_orig), tf.float32) / tf.cast(tf.math.reduce_sum(adj_orig), tf.float32)
+        pos_weight = pos_weight_from_adjacency(adj_orig)
 
         with tf.GradientTape() as tape:
             z, adj_pred = self((X, adj_tilde))  # Forward pass
             # Compute the loss value (binary cross entropy for a_ij in {0,1})
-            loss = self.loss_fn(labels=adj_orig, logits=adj_pred, pos_weight=pos_weight)
+            loss = tf.math.reduce_mean(self.loss_fn(labels=adj_orig, logits=adj_pred, pos_weight=pos_weight))
 
 
         # Compute gradients
@@ -58,18 +69,19 @@ class GraphAutoencoder(tf.keras.Model):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
         # Return a dict mapping metric names to current value
         return {m.name: m.result() for m in self.metrics}
 
 
     def test_step(self, data):
         (X, adj_tilde), adj_orig = data
-        pos_weight = tf.cast(adj_orig.shape[1] * adj_orig.shape[2] - tf.math.reduce_sum(adj_orig), tf.float32) / tf.cast(tf.math.reduce_sum(adj_orig), tf.float32)
+        pos_weight = pos_weight_from_adjacency(adj_orig)
 
         z, adj_pred = self((X, adj_tilde), training=False)  # Forward pass
         loss = tf.math.reduce_mean(self.loss_fn(labels=adj_orig, logits=adj_pred, pos_weight=pos_weight))
-        
-        return {'loss' : loss}
+        self.loss_tracker.update_state(loss)
+        return {m.name: m.result() for m in self.metrics}
 
 
 class GraphVariationalAutoencoder(GraphAutoencoder):
@@ -77,6 +89,8 @@ class GraphVariationalAutoencoder(GraphAutoencoder):
     def __init__(self, nodes_n, feat_sz, activation, **kwargs):
         super(GraphVariationalAutoencoder, self).__init__(nodes_n, feat_sz, activation, **kwargs)
         self.loss_fn_latent = losses.kl_loss
+        self.reco_loss_tracker = tf.keras.metrics.Mean(name="loss_reco")
+        self.kl_loss_tracker = tf.keras.metrics.Mean(name="loss_latent")
 
     def build_encoder(self):
 
@@ -103,10 +117,13 @@ class GraphVariationalAutoencoder(GraphAutoencoder):
         adj_pred = self.decoder(z)
         return z, z_mean, z_log_var, adj_pred
     
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.reco_loss_tracker, self.kl_loss_tracker]
     
     def train_step(self, data):
         (X, adj_tilde), adj_orig = data
-        pos_weight = tf.cast(adj_orig.shape[1] * adj_orig.shape[2] - tf.math.reduce_sum(adj_orig), tf.float32) / tf.cast(tf.math.reduce_sum(adj_orig), tf.float32)
+        pos_weight = pos_weight_from_adjacency(adj_orig)
 
 
         with tf.GradientTape() as tape:
@@ -121,20 +138,25 @@ class GraphVariationalAutoencoder(GraphAutoencoder):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
         # Return a dict mapping metric names to current value
-        return {'loss' : loss_reco+loss_latent, 'loss_reco': loss_reco, 'loss_latent': loss_latent}
+        return {m.name: m.result() for m in self.metrics}
 
 
     def test_step(self, data):
         (X, adj_tilde), adj_orig = data
-        pos_weight = tf.cast(adj_orig.shape[1] * adj_orig.shape[2] - tf.math.reduce_sum(adj_orig), tf.float32) / tf.cast(tf.math.reduce_sum(adj_orig), tf.float32)
+        pos_weight = pos_weight_from_adjacency(adj_orig)
 
         z, z_mean, z_log_var, adj_pred = self((X, adj_tilde), training=False)  # Forward pass
         # Compute the loss value (binary cross entropy for a_ij in {0,1})
         loss_reco =  tf.math.reduce_mean(self.loss_fn(labels=adj_orig, logits=adj_pred, pos_weight=pos_weight))
         loss_latent = tf.math.reduce_mean(self.loss_fn_latent(z_mean, z_log_var))
-        
-        return {'loss' : loss_reco+loss_latent, 'loss_reco': loss_reco, 'loss_latent': loss_latent}
+        self.loss_tracker.update_state(loss_reco+loss_latent)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
+        return {m.name: m.result() for m in self.metrics}
     
     
 class GCNAutoEncoder(GraphAutoencoder):
@@ -204,8 +226,9 @@ class GCNAutoEncoder(GraphAutoencoder):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
         # Return a dict mapping metric names to current value
-        return {'loss' : loss}
+        return {m.name: m.result() for m in self.metrics}
 
 
     def test_step(self, data):
@@ -213,7 +236,8 @@ class GCNAutoEncoder(GraphAutoencoder):
         features_out, z = self((X, adj_orig), training=False)  # Forward pass
         loss_reco = tf.math.reduce_mean(losses.threeD_loss(X,features_out))
         loss = loss_reco 
-        return {'loss' : loss}   
+        self.loss_tracker.update_state(loss)
+        return {m.name: m.result() for m in self.metrics}
 
 
 class GCNVariationalAutoEncoder(GraphAutoencoder):
@@ -227,6 +251,8 @@ class GCNVariationalAutoEncoder(GraphAutoencoder):
         super(GCNVariationalAutoEncoder , self).__init__(nodes_n, feat_sz, activation, **kwargs)
         self.encoder = self.build_encoder()
         self.decoder = self.build_decoder()
+        self.reco_loss_tracker = tf.keras.metrics.Mean(name="loss_reco")
+        self.kl_loss_tracker = tf.keras.metrics.Mean(name="loss_latent")
 
 
 
@@ -283,6 +309,9 @@ class GCNVariationalAutoEncoder(GraphAutoencoder):
         features_out = self.decoder( (z, adj_orig) )
         return features_out, z, z_mean, z_log_var
    
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.reco_loss_tracker, self.kl_loss_tracker]
     
     def train_step(self, data):
         (X, adj_orig) = data
@@ -298,8 +327,13 @@ class GCNVariationalAutoEncoder(GraphAutoencoder):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
         # Return a dict mapping metric names to current value
-        return {'loss' : loss, 'loss_reco': loss_reco, 'loss_latent': loss_latent, 'beta_kl_warmup':self.beta_kl_warmup}
+        return_metrics = {m.name: m.result() for m in self.metrics}
+        return_metrics['beta_kl_warmup'] = self.beta_kl_warmup
+        return return_metrics
 
 
     def test_step(self, data):
@@ -308,7 +342,10 @@ class GCNVariationalAutoEncoder(GraphAutoencoder):
         loss_reco = tf.math.reduce_mean(losses.threeD_loss(X,features_out))
         loss_latent = tf.math.reduce_mean(self.loss_fn_latent(z_mean, z_log_var))
         loss = loss_reco + self.beta_kl * self.beta_kl_warmup * loss_latent
-        return {'loss' : loss, 'loss_reco': loss_reco, 'loss_latent': loss_latent}   
+        self.loss_tracker.update_state(loss)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
+        return {m.name: m.result() for m in self.metrics}
 
 
     
@@ -327,6 +364,7 @@ class EdgeConvAutoEncoder(tf.keras.Model):
         self.input_shape_edges = [self.nodes_n,self.k_neighbors*self.feat_sz]
         self.encoder = self.build_encoder()
         self.decoder = self.build_decoder()
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
 
     def build_encoder(self):
         in_points = klayers.Input(shape=self.input_shape_points, name="in_points")
@@ -382,6 +420,10 @@ class EdgeConvAutoEncoder(tf.keras.Model):
         features_out = self.decoder(self.encoder(inputs))
         return features_out
 
+    @property
+    def metrics(self):
+        return [self.loss_tracker]
+
     def train_step(self, data):
         (nodes_feats_in, edge_feats_in) , nodes_feats_in = data
 
@@ -395,6 +437,7 @@ class EdgeConvAutoEncoder(tf.keras.Model):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
         # Return a dict mapping metric names to current value
         return {m.name: m.result() for m in self.metrics}
 
@@ -404,8 +447,8 @@ class EdgeConvAutoEncoder(tf.keras.Model):
         
         nodes_feats_out = self((nodes_feats_in, edge_feats_in), training=False)  # Forward pass
         loss = tf.math.reduce_mean(losses.threeD_loss(nodes_feats_in,nodes_feats_out))
-        
-        return {'loss' : loss}
+        self.loss_tracker.update_state(loss)
+        return {m.name: m.result() for m in self.metrics}
     
     
 
@@ -419,6 +462,8 @@ class EdgeConvVariationalAutoEncoder(EdgeConvAutoEncoder):
         super(EdgeConvVariationalAutoEncoder, self).__init__(nodes_n, feat_sz, k_neighbors,activation,latent_dim, **kwargs)
         self.encoder = self.build_encoder()
         self.decoder = self.build_decoder()
+        self.reco_loss_tracker = tf.keras.metrics.Mean(name="loss_reco")
+        self.kl_loss_tracker = tf.keras.metrics.Mean(name="loss_latent")
 
     def build_encoder(self):
         in_points = klayers.Input(shape=self.input_shape_points, name="in_points")
@@ -479,6 +524,9 @@ class EdgeConvVariationalAutoEncoder(EdgeConvAutoEncoder):
         features_out = self.decoder(z) 
         return features_out, z, z_mean, z_log_var
 
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.reco_loss_tracker, self.kl_loss_tracker]
     
     def train_step(self, data):
         (nodes_feats_in, edge_feats_in) , nodes_feats_in = data
@@ -494,8 +542,13 @@ class EdgeConvVariationalAutoEncoder(EdgeConvAutoEncoder):
         gradients = tape.gradient(loss, trainable_vars)
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
         # Return a dict mapping metric names to current value
-        return {'loss' : loss, 'loss_reco': loss_reco, 'loss_latent': loss_latent, 'beta_kl_warmup':self.beta_kl_warmup}
+        return_metrics = {m.name: m.result() for m in self.metrics}
+        return_metrics['beta_kl_warmup'] = self.beta_kl_warmup
+        return return_metrics
 
 
     def test_step(self, data):
@@ -504,7 +557,170 @@ class EdgeConvVariationalAutoEncoder(EdgeConvAutoEncoder):
         loss_reco = tf.math.reduce_mean(losses.threeD_loss(nodes_feats_in,features_out))
         loss_latent = tf.math.reduce_mean(losses.kl_loss(z_mean, z_log_var))
         loss = loss_reco + self.beta_kl  * loss_latent *tf.cond(tf.greater(self.beta_kl_warmup, 0), lambda: self.beta_kl_warmup, lambda: 1.)
-        return {'loss' : loss, 'loss_reco': loss_reco, 'loss_latent': loss_latent}   
+        self.loss_tracker.update_state(loss)
+        self.reco_loss_tracker.update_state(loss_reco)
+        self.kl_loss_tracker.update_state(loss_latent)
+        return {m.name: m.result() for m in self.metrics}
+
+
+
+class DeepSetsStudent(tf.keras.Model):
+    
+    ''' small DeepSets scorer distilled from a PNVAE teacher : per constituent MLP (1x1 Conv1D), mean and max pooling over
+        constituents and an MLP head regressing log(teacher score), plus optionally the teacher z_mean (latent_dim not None)
+        targets : log_score or (log_score, z_mean)
+    '''
+
+    def __init__(self, nodes_n, feat_sz, activation, latent_dim=None, phi_channels=(32, 32), rho_channels=(32,), z_weight=1., **kwargs):
+        super(DeepSetsStudent, self).__init__(**kwargs)
+        self.nodes_n = nodes_n
+        self.feat_sz = feat_sz
+        self.activation = activation
+        self.latent_dim = latent_dim
+        self.phi_channels = phi_channels
+        self.rho_channels = rho_channels
+        self.z_weight = z_weight
+        self.student = self.build_student()
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+        self.score_loss_tracker = tf.keras.metrics.Mean(name="score_loss")
+        self.z_loss_tracker = tf.keras.metrics.Mean(name="z_loss")
+
+    def build_student(self):
+        in_particles = klayers.Input(shape=[self.nodes_n, self.feat_sz], name='student_input')
+        h = klayers.BatchNormalization(name='BatchNorm_particles')(in_particles)
+        for idx, channels in enumerate(self.phi_channels):
+            h = klayers.Conv1D(channels, kernel_size=1, strides=1, activation=self.activation,
+                               kernel_initializer='glorot_normal', name='Conv1D_phi_%d' % idx)(h)
+        h = tf.concat([tf.reduce_mean(h, axis=1), tf.reduce_max(h, axis=1)], axis=-1) # permutation invariant pooling
+        for idx, channels in enumerate(self.rho_channels):
+            h = klayers.Dense(channels, activation=self.activation, kernel_initializer='glorot_normal', name='Dense_rho_%d' % idx)(h)
+        outputs = [tf.squeeze(klayers.Dense(1, name='log_score')(h), axis=-1)]
+        if self.latent_dim is not None:
+            outputs.append(klayers.Dense(self.latent_dim, name='z_mean')(h))
+        student = tf.keras.Model(inputs=in_particles, outputs=outputs, name='DeepSetsStudent')
+        student.summary()
+        return student
+
+    def call(self, inputs):
+        ''' returns (log_score,) or (log_score, z_mean) '''
+        outputs = self.student(inputs)
+        return tuple(outputs) if isinstance(outputs, (list, tuple)) else (outputs, )
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.score_loss_tracker, self.z_loss_tracker]
+
+    def compute_losses(self, particles, targets, training):
+        outputs = self(particles, training=training)
+        log_score = targets[0] if isinstance(targets, (list, tuple)) else targets
+        score_loss = tf.math.reduce_mean(tf.math.squared_difference(outputs[0], log_score))
+        z_loss = tf.constant(0.)
+        if self.latent_dim is not None and isinstance(targets, (list, tuple)):
+            z_loss = tf.math.reduce_mean(tf.math.squared_difference(outputs[1], targets[1]))
+        return score_loss + self.z_weight * z_loss, score_loss, z_loss
+
+    def train_step(self, data):
+        particles, targets = data
+        with tf.GradientTape() as tape:
+            loss, score_loss, z_loss = self.compute_losses(particles, targets, training=True)
+        trainable_vars = self.trainable_variables
+        gradients = tape.gradient(loss, trainable_vars)
+        self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
+        self.score_loss_tracker.update_state(score_loss)
+        self.z_loss_tracker.update_state(z_loss)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        particles, targets = data
+        loss, score_loss, z_loss = self.compute_losses(particles, targets, training=False)
+        self.loss_tracker.update_state(loss)
+        self.score_loss_tracker.update_state(score_loss)
+        self.z_loss_tracker.update_state(z_loss)
+        return {m.name: m.result() for m in self.metrics}
+
+
+
+
+class KNNGCNAutoEncoder(tf.keras.Model):
+
+    ''' GCN autoencoder on kNN graphs of the real constituents (utils.preprocessing.knn_graph) instead of the dense fully connected P x P adjacency
+        a batch is one disjoint union graph of variable size jets, inputs = (nodes [n_nodes x C], (senders, receivers, weights), node_graph, node_slot),
+        message passing is gather + unsorted_segment_sum, O(P K) per jet. the latent space is pooled per jet, the decoder
+        broadcasts it back to the nodes of the jet plus an embedding of the constituent slot and runs on the same graph
+    '''
+
+    def __init__(self, nodes_n, feat_sz, activation, latent_dim, gcn_channels=(16, 8), **kwargs):
+        super(KNNGCNAutoEncoder, self).__init__(**kwargs)
+        self.nodes_n = nodes_n # max constituents per jet
+        self.feat_sz = feat_sz
+        self.activation = activation
+        self.latent_dim = latent_dim
+        self.encoder_convs = [layers.GraphConvolutionBias(output_sz=c, activation=activation) for c in gcn_channels]
+        self.encoder_dense = klayers.Dense(latent_dim, activation=activation)
+        self.slot_embedding = klayers.Embedding(nodes_n, latent_dim)
+        self.decoder_dense = klayers.Dense(gcn_channels[-1], activation=activation)
+        self.decoder_convs = [layers.GraphConvolutionBias(output_sz=c, activation=activation) for c in reversed(gcn_channels[:-1])]
+        self.decoder_convs.append(layers.GraphConvolutionBias(output_sz=feat_sz, activation=activation))
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+
+    def encode(self, inputs):
+        nodes, edges, node_graph, node_slot = inputs
+        n_graphs = tf.math.reduce_max(node_graph) + 1
+        x = nodes
+        for conv in self.encoder_convs:
+            x = conv(x, edges)
+        x = tf.concat([tf.math.unsorted_segment_mean(x, node_graph, n_graphs), tf.math.unsorted_segment_max(x, node_graph, n_graphs)], axis=-1)
+        return self.encoder_dense(x) # [n_graphs x latent_dim]
+
+    def decode(self, z, inputs):
+        nodes, edges, node_graph, node_slot = inputs
+        out = self.decoder_dense(tf.gather(z, node_graph) + self.slot_embedding(node_slot))
+        for conv in self.decoder_convs:
+            out = conv(out, edges)
+        return out
+
+    def call(self, inputs):
+        z = self.encode(inputs)
+        features_out = self.decode(z, inputs)
+        return features_out, z
+
+    def to_padded(self, nodes, node_graph, node_slot):
+        ''' [n_nodes x C] -> [n_graphs x nodes_n x C] and mask of the real constituents, for the loss '''
+        n_graphs = tf.math.reduce_max(node_graph) + 1
+        indices = tf.stack([node_graph, node_slot], axis=-1)
+        padded = tf.scatter_nd(indices, nodes, tf.stack([n_graphs, self.nodes_n, tf.shape(nodes)[-1]]))
+        mask = tf.scatter_nd(indices, tf.ones_like(node_graph, dtype=tf.bool), tf.stack([n_graphs, self.nodes_n]))
+        return padded, mask
+
+    def reco_loss(self, inputs, features_out):
+        ''' per jet threeD_loss over its real constituents '''
+        nodes, edges, node_graph, node_slot = inputs
+        padded_in, mask = self.to_padded(nodes, node_graph, node_slot)
+        padded_out, _ = self.to_padded(features_out, node_graph, node_slot)
+        return losses.threeD_loss_masked(padded_in, padded_out, mask)
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker]
+
+    def train_step(self, data):
+        inputs, _ = data
+        with tf.GradientTape() as tape:
+            features_out, z = self(inputs)  # Forward pass
+            loss = tf.math.reduce_mean(self.reco_loss(inputs, features_out))
+        trainable_vars = self.trainable_variables
+        gradients = tape.gradient(loss, trainable_vars)
+        self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self.loss_tracker.update_state(loss)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        inputs, _ = data
+        features_out, z = self(inputs, training=False)
+        loss = tf.math.reduce_mean(self.reco_loss(inputs, features_out))
+        self.loss_tracker.update_state(loss)
+        return {m.name: m.result() for m in self.metrics}
 
 
 
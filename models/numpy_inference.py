@@ -0,0 +1,228 @@
+import json
+import multiprocessing
+import numpy as np
+
+''' TensorFlow-free forward pass of models exported with models.inference.export_npz : the (BatchNormalization folded) weights
+    and a json description are read from one flat .npz and run in vectorized numpy batches. only numpy is imported, so scoring
+    workers start in well under a second and can be forked freely (set OMP_NUM_THREADS=1 with several workers per node)
+'''
+
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0.),
+               'leaky_relu': lambda x, alpha: np.where(x > 0, x, alpha * x),
+               'tanh': np.tanh,
+               'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+               'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0.)))}
+
+
+def activation(spec):
+    ''' spec : [name, *args] as written by models.inference.activation_spec '''
+    fn, args = ACTIVATIONS[spec[0]], spec[1:]
+    return lambda x: fn(x, *args)
+
+
+def dense(x, w, b=None):
+    ''' x [..., C_in] . w + b as one 2D matmul '''
+    y = np.matmul(x.reshape(-1, w.shape[0]), w).reshape(x.shape[:-1] + (w.shape[1],))
+    return y if b is None else y + b
+
+
+def threeD_loss(inputs, outputs):
+    ''' per jet threeD_loss (same expanded form as models.losses.threeD_loss_eval) '''
+    distances = np.matmul(inputs, outputs.transpose(0,2,1))
+    distances *= -2.
+    distances += np.sum(np.square(inputs), axis=-1)[:,:,np.newaxis]
+    distances += np.sum(np.square(outputs), axis=-1)[:,np.newaxis,:]
+    np.maximum(distances, 0., out=distances)
+    return np.mean(np.min(distances,axis=1),axis=1) + np.mean(np.min(distances,axis=2),axis=1)
+
+
+def knn_indices(points, k):
+    ''' models.custom_functions.knn_indices : k nearest neighbours (N, P, K), ties broken by index as tf.nn.top_k '''
+    r = np.sum(points * points, axis=2, keepdims=True)
+    D = r - 2 * np.matmul(points, points.transpose(0,2,1)) + r.transpose(0,2,1)
+    return np.argsort(D, axis=2, kind='stable')[:, :, 1:k+1]
+
+
+def grid_knn_indices(points, k, points_per_cell=None, cell_capacity=None):
+    ''' models.custom_functions.grid_knn_indices (approximate kNN on an equal-population (eta, phi) grid) '''
+    N, P = points.shape[:2]
+    points_per_cell = points_per_cell or max(k // 2, 1)
+    cell_capacity = cell_capacity or 3 * points_per_cell
+    G = max(1, int(round((P / points_per_cell) ** 0.5)))
+
+    def bin_axis(x):
+        rank = np.argsort(np.argsort(x, axis=1, kind='stable'), axis=1, kind='stable')
+        return rank * G // P
+
+    cx, cy = bin_axis(points[:, :, 0]), bin_axis(points[:, :, 1])
+    cell = cx * G + cy
+    order = np.argsort(cell, axis=1, kind='stable')
+    # searchsorted of every jet at once : jets shifted to disjoint cell ranges
+    jet_offset = np.arange(N)[:, np.newaxis]
+    sorted_cell = (np.take_along_axis(cell, order, axis=1) + jet_offset * G * G).ravel()
+    all_cells = (np.arange(G * G)[np.newaxis, :] + jet_offset * G * G).ravel()
+    cell_start = np.searchsorted(sorted_cell, all_cells, side='left').reshape(N, G * G) - jet_offset * P
+    cell_end = np.searchsorted(sorted_cell, all_cells, side='right').reshape(N, G * G) - jet_offset * P
+
+    dx = np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+    dy = np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+    ncx, ncy = cx[:, :, np.newaxis] + dx, cy[:, :, np.newaxis] + dy
+    inside = (ncx >= 0) & (ncx < G) & (ncy >= 0) & (ncy < G)
+    ncell = (np.clip(ncx, 0, G - 1) * G + np.clip(ncy, 0, G - 1)).reshape(N, -1)
+    start = np.take_along_axis(cell_start, ncell, axis=1).reshape(N, P, 9)
+    count = np.take_along_axis(cell_end, ncell, axis=1).reshape(N, P, 9) - start
+    slot = np.arange(cell_capacity)
+    position = np.minimum(start[..., np.newaxis] + slot, P - 1).reshape(N, -1)
+    valid = (inside[..., np.newaxis] & (slot < count[..., np.newaxis])).reshape(N, P, -1)
+    candidates = np.take_along_axis(order, position, axis=1).reshape(N, P, -1)
+    valid &= candidates != np.arange(P)[np.newaxis, :, np.newaxis]
+
+    diff = points[jet_offset[:, :, np.newaxis], candidates] - points[:, :, np.newaxis, :]
+    D = np.where(valid, np.sum(diff * diff, axis=-1), np.inf)
+    top = np.argsort(D, axis=2, kind='stable')[:, :, :k]
+    indices = np.take_along_axis(candidates, top, axis=2)
+    # missing neighbours repeat the nearest valid one, the point itself if it has none (as the tf engine)
+    found = np.isfinite(np.take_along_axis(D, top, axis=2))
+    nearest = np.where(found[:, :, :1], indices[:, :, :1], np.arange(P)[np.newaxis, :, np.newaxis])
+    return np.where(found, indices, nearest)
+
+
+KNN_ENGINES = {'exact': knn_indices, 'grid': grid_knn_indices}
+
+
+def gather_neighbours(features, indices):
+    ''' features (N, P, C), indices (N, P, K) -> (N, P, K, C) '''
+    return features[np.arange(features.shape[0])[:, np.newaxis, np.newaxis], indices]
+
+
+class NumpyPNVAE():
+
+    ''' deterministic PNVAE forward pass (as models.inference.LeanPNVAE) : __call__(points, features) -> (z_mean, reconstruction) '''
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.w = arrays
+        self.act = activation(meta['activation'])
+
+    def encode(self, points, features):
+        meta, w = self.meta, self.w
+        fts = features
+        for b, block in enumerate(meta['blocks']):
+            K = block['K']
+            indices = KNN_ENGINES[block['knn_engine']](points, K)
+            if block.get('fused', True): # files exported before the per block choice are fused
+                # first conv per point before the gather : W(x_j - x_i) + c = Wx_j - Wx_i + c
+                proj = dense(fts, w['block%d_conv0_w' % b])
+                x = self.act(gather_neighbours(proj, indices) - proj[:, :, np.newaxis, :] + w['block%d_conv0_b' % b])
+            else:
+                x = self.act(dense(gather_neighbours(fts, indices) - fts[:, :, np.newaxis, :], w['block%d_conv0_w' % b], w['block%d_conv0_b' % b]))
+            for j in range(1, block['n_convs']):
+                x = self.act(dense(x, w['block%d_conv%d_w' % (b, j)], w['block%d_conv%d_b' % (b, j)]))
+            pooled = np.max(x, axis=2) if meta['conv_pooling'] == 'max' else np.mean(x, axis=2)
+            sc = dense(fts, w['block%d_sc_w' % b], w['block%d_sc_b' % b])
+            fts = self.act(np.concatenate([sc, pooled], axis=2) if meta['conv_linking'] == 'concat' else sc + pooled)
+        return self.act(dense(fts.reshape(fts.shape[0], -1), w['latent_w'], w['latent_b']))
+
+    def decode(self, z):
+        meta, w = self.meta, self.w
+        x = self.act(dense(z, w['dense_0_w'], w['dense_0_b'])).reshape(z.shape[0], meta['num_points'], -1)
+        for j in range(meta['n_decoder_convs']):
+            x = self.act(dense(x, w['decoder_conv%d_w' % j], w['decoder_conv%d_b' % j]))
+        return self.act(dense(x, w['conv_out_w'], w['conv_out_b']))
+
+    def __call__(self, points, features):
+        points, features = np.asarray(points, dtype=np.float32), np.asarray(features, dtype=np.float32)
+        z_mean = self.encode(points, features)
+        return z_mean, self.decode(z_mean)
+
+    def scores(self, particles, batch_size=1024):
+        ''' per jet reconstruction loss (threeD_loss) of the deterministic reconstruction '''
+        scores = np.empty(particles.shape[0], dtype=np.float32)
+        for start in range(0, particles.shape[0], batch_size):
+            batch = np.asarray(particles[start:start+batch_size], dtype=np.float32)
+            _, reco = self(batch[:,:,0:2], batch)
+            scores[start:start+batch_size] = threeD_loss(batch, reco)
+        return scores
+
+
+class NumpyGraphModel():
+
+    ''' dense adjacency GraphConvolution* models (models.models GraphAutoencoder, GCNAutoEncoder and their VAE versions) :
+        __call__(features, adjacency) -> (z or z_mean, reconstruction), the reconstruction being the features (GCN*)
+        or the adjacency logits (inner product decoder)
+    '''
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.w = arrays
+
+    def run(self, ops, x, adjacency):
+        w = self.w
+        for op in ops:
+            if op['op'] == 'graph_conv':
+                y = np.matmul(adjacency, dense(x, w[op['key'] + '_w1']))
+                if op['self_loop']:
+                    y = y + dense(x, w[op['key'] + '_w2'])
+                x = activation(op['activation'])(y + w[op['key'] + '_b'])
+            elif op['op'] == 'dense':
+                x = activation(op['activation'])(dense(x, w[op['key'] + '_w'], w[op['key'] + '_b']))
+            elif op['op'] == 'flatten':
+                x = x.reshape(x.shape[0], -1)
+            elif op['op'] == 'reshape':
+                x = x.reshape([x.shape[0]] + op['target_shape'])
+            elif op['op'] == 'inner_product':
+                x = activation(op['activation'])(np.matmul(x, x.transpose(0,2,1)))
+        return x
+
+    def __call__(self, features, adjacency):
+        features, adjacency = np.asarray(features, dtype=np.float32), np.asarray(adjacency, dtype=np.float32)
+        z = self.run(self.meta['encoder'], features, adjacency)
+        return z, self.run(self.meta['decoder'], z, adjacency)
+
+    def scores(self, features, adjacency, batch_size=4096):
+        ''' per graph threeD_loss of the reconstructed features (GCN* models only) '''
+        if self.meta['decoder'][-1]['op'] == 'inner_product':
+            raise ValueError('scores : the decoder reconstructs the adjacency, not the features')
+        scores = np.empty(features.shape[0], dtype=np.float32)
+        for start in range(0, features.shape[0], batch_size):
+            sl = slice(start, start+batch_size)
+            _, reco = self(features[sl], adjacency[sl])
+            scores[sl] = threeD_loss(np.asarray(features[sl], dtype=np.float32), reco)
+        return scores
+
+
+MODEL_TYPES = {'pnvae': NumpyPNVAE, 'graph': NumpyGraphModel}
+
+
+def npz_path(path):
+    ''' np.savez appends .npz to the file name : same path for export and load '''
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+def load_npz(path):
+    ''' numpy model of an export_npz file '''
+    with np.load(npz_path(path), allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        arrays = {key: data[key] for key in data.files if key != 'meta'}
+    return MODEL_TYPES[meta['model']](meta, arrays)
+
+
+_worker_model = None
+
+
+def _init_worker(path):
+    global _worker_model
+    _worker_model = load_npz(path)
+
+
+def _worker_scores(particles):
+    return _worker_model.scores(particles)
+
+
+def parallel_scores(path, particles, n_workers=None, chunk_size=8192):
+    ''' NumpyPNVAE scores of particles split over n_workers processes, each loading the npz once '''
+    chunks = [particles[start:start+chunk_size] for start in range(0, particles.shape[0], chunk_size)]
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(path,)) as pool:
+        return np.concatenate(pool.map(_worker_scores, chunks))
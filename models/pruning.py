@@ -0,0 +1,170 @@
+import copy
+import numpy as np
+import tensorflow as tf
+import models.scoring as scoring
+
+''' structured channel pruning of PNVAE
+    channel groups : every 1x1 Conv2D output of the EdgeConv blocks (the last one of a block is shared with the shortcut conv
+    and feeds the next block / the flattened encoder input) and every decoder width in conv_params_decoder
+    channels are ranked by |BatchNorm scale| (kernel L2 norm without BN), the lowest ones are removed and a smaller PNVAE
+    is rebuilt from the surviving weights
+'''
+
+
+def _leaf_layers(model):
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            yield from _leaf_layers(layer)
+        else:
+            yield layer
+
+
+def _find_layer(model, name):
+    for layer in _leaf_layers(model):
+        if layer.name == name:
+            return layer
+    raise ValueError('layer {} not found'.format(name))
+
+
+def _importance(model, conv_name, bn_names):
+    ''' per channel importance : sum of |gamma| of the given BN layers, or output kernel norm of the conv without BN '''
+    if model.with_bn:
+        return np.sum([np.abs(_find_layer(model, bn).get_weights()[0]) for bn in bn_names], axis=0)
+    kernel = _find_layer(model, conv_name).get_weights()[0]
+    return np.linalg.norm(kernel.reshape(-1, kernel.shape[-1]), axis=0)
+
+
+def rank_channels(model):
+    ''' importance of every channel group : {'edgeconv': [[array per conv] per block], 'decoder': [array per width]} '''
+    name, setting = model.name, model.setting
+    ranks = {'edgeconv': [], 'decoder': []}
+    for b, (K, channels) in enumerate(setting.conv_params):
+        prefix = '%s_%i' % (name, b)
+        block = []
+        for j in range(len(channels)):
+            # last conv of a block shares its channels with the shortcut
+            bn_names = ['%s_bn%d' % (prefix, j)] + (['%s_sc_bn' % prefix] if j == len(channels)-1 else [])
+            block.append(_importance(model, '%s_conv%d' % (prefix, j), bn_names))
+        ranks['edgeconv'].append(block)
+    P, C0 = setting.num_points, setting.conv_params_decoder[0]
+    # decoder dense layer is reshaped to (P, C0) : average over points
+    if model.with_bn:
+        gamma = np.abs(_find_layer(model, '%s_dense_0' % name).get_weights()[0])
+        ranks['decoder'].append(gamma.reshape(P, C0).mean(axis=0))
+    else:
+        dense = [l for l in _leaf_layers(model.decoder) if isinstance(l, tf.keras.layers.Dense)][0]
+        ranks['decoder'].append(np.linalg.norm(dense.get_weights()[0].reshape(-1, P, C0), axis=(0, 1)))
+    for j in range(1, len(setting.conv_params_decoder)):
+        ranks['decoder'].append(_importance(model, '%s_conv_%d' % (name, j), ['%s_bn_%d' % (name, j)]))
+    return ranks
+
+
+def select_channels(ranks, keep_ratio, min_channels=1):
+    ''' indices (sorted) of the channels kept in every group '''
+    def top(r):
+        n_keep = max(min_channels, int(np.ceil(keep_ratio*len(r))))
+        return np.sort(np.argsort(-r)[:n_keep])
+    return {'edgeconv': [[top(r) for r in block] for block in ranks['edgeconv']], 'decoder': [top(r) for r in ranks['decoder']]}
+
+
+def pruned_setting(setting, keep):
+    new_setting = copy.copy(setting)
+    new_setting.conv_params = [(K, [len(k) for k in block_keep]) for (K, _), block_keep in zip(setting.conv_params, keep['edgeconv'])]
+    new_setting.conv_params_encoder_input = len(keep['edgeconv'][-1][-1])
+    new_setting.conv_params_decoder = [len(k) for k in keep['decoder']]
+    return new_setting
+
+
+def _block_output_keep(setting, keep, b):
+    ''' indices of the features kept at the output of block b : [sc, fts] for concat linking '''
+    k = keep['edgeconv'][b][-1]
+    if setting.conv_linking == 'concat':
+        return np.concatenate([k, setting.conv_params[b][1][-1] + k])
+    return k
+
+
+def _slice_rules(setting, keep, name):
+    ''' layer name -> (input keep, output keep) for conv kernels / output keep for BN '''
+    rules = {}
+    for b, (K, channels) in enumerate(setting.conv_params):
+        prefix = '%s_%i' % (name, b)
+        in_keep = None if b == 0 else _block_output_keep(setting, keep, b-1)
+        for j in range(len(channels)):
+            out_keep = keep['edgeconv'][b][j]
+            rules['%s_conv%d' % (prefix, j)] = (in_keep if j == 0 else keep['edgeconv'][b][j-1], out_keep)
+            rules['%s_bn%d' % (prefix, j)] = (None, out_keep)
+        rules['%s_sc_conv' % prefix] = (in_keep, keep['edgeconv'][b][-1])
+        rules['%s_sc_bn' % prefix] = (None, keep['edgeconv'][b][-1])
+    P, C0 = setting.num_points, setting.conv_params_decoder[0]
+    dense_keep = (np.arange(P)[:, np.newaxis]*C0 + keep['decoder'][0][np.newaxis, :]).reshape(-1)
+    rules['%s_dense_0' % name] = (None, dense_keep)
+    for j in range(1, len(setting.conv_params_decoder)):
+        rules['%s_conv_%d' % (name, j)] = (keep['decoder'][j-1], keep['decoder'][j])
+        rules['%s_bn_%d' % (name, j)] = (None, keep['decoder'][j])
+    rules['%s_conv_out' % name] = (keep['decoder'][-1], None)
+    return rules, dense_keep
+
+
+def _slice(weights, in_keep, out_keep, kind):
+    if kind == 'conv':
+        kernel = weights[0]
+        if in_keep is not None: kernel = kernel[:, :, in_keep, :]
+        if out_keep is not None: kernel = kernel[:, :, :, out_keep]
+        bias = [] if len(weights) == 1 else [weights[1] if out_keep is None else weights[1][out_keep]]
+        return [kernel] + bias
+    if kind == 'bn':
+        return [w[out_keep] for w in weights]
+    if kind == 'dense':
+        kernel, bias = weights
+        if in_keep is not None: kernel = kernel[in_keep, :]
+        if out_keep is not None: kernel, bias = kernel[:, out_keep], bias[out_keep]
+        return [kernel, bias]
+
+
+def prune_pnvae(model, keep):
+    ''' rebuild a smaller PNVAE keeping the channels in keep, initialised from the surviving weights of model '''
+    setting, name = model.setting, model.name
+    new_model = scoring.load_pnvae(pruned_setting(setting, keep), name=name)
+    rules, dense_keep = _slice_rules(setting, keep, name)
+    # flattened encoder input : per point the kept features of the last block
+    last_keep = _block_output_keep(setting, keep, len(setting.conv_params)-1)
+    width = setting.conv_params[-1][1][-1]*(2 if setting.conv_linking == 'concat' else 1)
+    encoder_in_keep = (np.arange(setting.num_points)[:, np.newaxis]*width + last_keep[np.newaxis, :]).reshape(-1)
+    for old_sub, new_sub, sub in [(model.particlenet, new_model.particlenet, 'particlenet'),
+                                  (model.encoder, new_model.encoder, 'encoder'),
+                                  (model.decoder, new_model.decoder, 'decoder')]:
+        for old_layer, new_layer in zip(_leaf_layers(old_sub), _leaf_layers(new_sub)):
+            weights = old_layer.get_weights()
+            if not weights:
+                continue
+            if isinstance(old_layer, tf.keras.layers.Dense):
+                in_keep, out_keep = (encoder_in_keep, None) if sub == 'encoder' else (None, dense_keep)
+                weights = _slice(weights, in_keep, out_keep, 'dense')
+            elif isinstance(old_layer, tf.keras.layers.Conv2D):
+                weights = _slice(weights, *rules[old_layer.name], 'conv')
+            elif isinstance(old_layer, tf.keras.layers.BatchNormalization):
+                weights = _slice(weights, *rules[old_layer.name], 'bn')
+            new_layer.set_weights(weights)
+    return new_model
+
+
+def pnvae_flops(setting):
+    ''' multiply-adds x2 of one forward pass per jet (kNN distances, 1x1 convs, dense layers) '''
+    P, flops = setting.num_points, 0
+    in_dim = setting.num_features
+    pts_dim = setting.input_shapes['points'][-1] # without mask every block builds its kNN graph on the input points
+    for K, channels in setting.conv_params:
+        flops += 2*P*P*pts_dim
+        prev = in_dim
+        for c in channels:
+            flops += 2*P*K*prev*c
+            prev = c
+        flops += 2*P*in_dim*channels[-1] # shortcut
+        in_dim = channels[-1]*(2 if setting.conv_linking == 'concat' else 1)
+    n_latent_heads = 2 if 'vae' in setting.ae_type else 1
+    flops += 2*P*in_dim*setting.latent_dim*n_latent_heads
+    flops += 2*setting.latent_dim*P*setting.conv_params_decoder[0]
+    widths = list(setting.conv_params_decoder) + [setting.num_features]
+    for prev, c in zip(widths[:-1], widths[1:]):
+        flops += 2*P*prev*c
+    return flops
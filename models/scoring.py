@@ -0,0 +1,263 @@
+import time
+import numpy as np
+import tensorflow as tf
+import models.losses as losses
+import models.ParticleNetAE as pnae
+import utils.autotune as autotune
+
+
+def pn_inputs(particles):
+    ''' PNVAE inputs from particles [N x P x (eta,phi,pt)] : points are (eta,phi), features are all '''
+    return (particles[:,:,0:2], particles)
+
+
+def batch_slices(n, batch_size):
+    for start in range(0, n, batch_size):
+        yield slice(start, min(start+batch_size, n))
+
+
+def load_pnvae(setting, weights_path=None, name='PN_AE_'):
+    ''' rebuild a PNVAE from its setting and restore weights from a checkpoint (ModelCheckpoint hdf5) '''
+    score_batch_size = autotune.apply_tuned_config(setting, mode='score', default_batch_size=1024)
+    model = pnae.PNVAE(setting=setting, name=name)
+    model.score_batch_size = score_batch_size
+    dummy = np.zeros([1]+list(setting.input_shapes['features']), dtype=np.float32)
+    model(pn_inputs(dummy), training=False) # build variables
+    if weights_path is not None:
+        model.load_weights(weights_path)
+    return model
+
+
+def check_pnvae_checkpoint(model, setting, path, name='PN_AE_'):
+    ''' save the weights of model (a PNVAE subclass) to path and load them back into a plain PNVAE with load_pnvae :
+        raises AssertionError if any weight or the deterministic output of a random batch differs '''
+    model.save_weights(path)
+    loaded = load_pnvae(setting, path, name=name)
+    assert len(model.weights) == len(loaded.weights), 'check_pnvae_checkpoint : {} weights, PNVAE has {}'.format(len(model.weights), len(loaded.weights))
+    for w, w_loaded in zip(model.weights, loaded.weights):
+        assert w.name == w_loaded.name, 'check_pnvae_checkpoint : weight order {} != {}'.format(w.name, w_loaded.name)
+        np.testing.assert_array_equal(w.numpy(), w_loaded.numpy(), err_msg=w.name)
+    particles = np.random.normal(size=[8]+list(setting.input_shapes['features'])).astype(np.float32)
+    np.testing.assert_allclose(model(pn_inputs(particles), training=False)[1].numpy(),
+                               loaded(pn_inputs(particles), training=False)[1].numpy(), rtol=1e-5, atol=1e-6)
+
+
+def split_encoder_output(encoder_output):
+    ''' returns (z, z_mean) for AE ([latent]) or VAE ([z, z_mean, z_log_var]) encoder outputs, z_mean = z for the AE '''
+    if isinstance(encoder_output, (list, tuple)):
+        if len(encoder_output) == 3:
+            return encoder_output[0], encoder_output[1]
+        encoder_output = encoder_output[0]
+    return encoder_output, encoder_output
+
+
+def reconstruction(model, outputs):
+    ''' pick the reconstructed features from the output of any of the autoencoders call() '''
+    if isinstance(model, pnae.PNVAE):
+        return outputs[1]
+    if isinstance(outputs, (list, tuple)):
+        return outputs[0]
+    return outputs
+
+
+def encode(model, inputs, training=False):
+    ''' encoder-only forward pass, returns z_mean (latent for the AE) : decoder is never run '''
+    if isinstance(model, pnae.PNVAE):
+        encoder_output = model.encoder(model.particlenet(inputs, training=training), training=training)
+    else:
+        encoder_output = model.encoder(inputs, training=training)
+    _, z_mean = split_encoder_output(encoder_output)
+    return z_mean
+
+
+def latent_embeddings(model, inputs, batch_size=1024):
+    ''' z_mean for all jets, computed in batches : inputs is the tuple of model input arrays '''
+    n = inputs[0].shape[0]
+    embeddings = None
+    for sl in batch_slices(n, batch_size):
+        z_mean = encode(model, tuple(x[sl] for x in inputs)).numpy()
+        if embeddings is None:
+            embeddings = np.empty((n, z_mean.shape[-1]), dtype=np.float32)
+        embeddings[sl] = z_mean.reshape(z_mean.shape[0], -1)
+    return embeddings
+
+
+def reco_loss_scores(model, inputs, targets, batch_size=1024, loss_fn=losses.threeD_loss):
+    ''' per jet reconstruction loss (Chamfer by default) : the standard anomaly score '''
+    n = targets.shape[0]
+    scores = np.empty(n, dtype=np.float32)
+    for sl in batch_slices(n, batch_size):
+        outputs = model(tuple(x[sl] for x in inputs), training=False)
+        scores[sl] = loss_fn(targets[sl], reconstruction(model, outputs)).numpy()
+    return scores
+
+
+def scores_and_embeddings(model, inputs, targets, batch_size=1024, loss_fn=losses.threeD_loss):
+    ''' PNVAE reconstruction loss and z_mean per jet from a single forward pass '''
+    n = targets.shape[0]
+    scores, embeddings = np.empty(n, dtype=np.float32), None
+    for sl in batch_slices(n, batch_size):
+        outputs = model(tuple(x[sl] for x in inputs), training=False)
+        scores[sl] = loss_fn(targets[sl], reconstruction(model, outputs)).numpy()
+        _, z_mean = split_encoder_output(outputs[0])
+        if embeddings is None:
+            embeddings = np.empty((n, z_mean.shape[-1]), dtype=np.float32)
+        embeddings[sl] = z_mean.numpy()
+    return scores, embeddings
+
+
+def latent_index_scores(model, inputs, index, k=5, batch_size=1024):
+    ''' encoder-only anomaly score : distance to the k nearest background embeddings stored in index '''
+    return index.score(latent_embeddings(model, inputs, batch_size=batch_size), k=k)
+
+
+def pn_reco_scorer(model, batch_size=None):
+    ''' particles -> reconstruction loss scores for PNVAE, autotuned batch size by default '''
+    batch_size = batch_size or getattr(model, 'score_batch_size', 1024)
+    return lambda particles: reco_loss_scores(model, pn_inputs(particles), particles, batch_size=batch_size)
+
+
+def gcn_reco_scorer(model, batch_size=4096):
+    ''' particles -> reconstruction loss scores for the GCN autoencoders, adjacencies built per batch '''
+    import utils.preprocessing as prepr
+    def score(particles):
+        scores = np.empty(particles.shape[0], dtype=np.float32)
+        for sl in batch_slices(particles.shape[0], batch_size):
+            X = particles[sl]
+            A_tilde = prepr.normalized_adjacency(prepr.make_adjacencies(X)).astype(np.float32)
+            scores[sl] = reco_loss_scores(model, (X, A_tilde), X, batch_size=batch_size)
+        return scores
+    return score
+
+
+def latent_index_scorer(model, index, k=5, batch_size=4096):
+    ''' particles -> encoder-only latent index scores for PNVAE '''
+    return lambda particles: latent_index_scores(model, pn_inputs(particles), index, k=k, batch_size=batch_size)
+
+
+class CascadeScorer():
+
+    ''' two stage scoring : a cheap first stage scores all jets, only jets above its threshold
+        (tuned to keep a fraction bg_efficiency of background) are re-batched and scored by the expensive second stage.
+        stages are callables particles -> scores, e.g. gcn_reco_scorer(gcnae) and pn_reco_scorer(pnvae)
+        jets rejected by the first stage get reject_score, below any second stage score
+    '''
+
+    def __init__(self, first_stage, second_stage, threshold=None, reject_score=np.finfo(np.float32).min):
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        self.threshold = threshold
+        self.reject_score = reject_score
+        self.stats = {}
+
+    def calibrate(self, particles_bg, bg_efficiency):
+        ''' set first stage threshold so that a fraction bg_efficiency of background jets reaches the second stage '''
+        self.threshold = np.quantile(self.first_stage(particles_bg), 1.-bg_efficiency)
+        return self.threshold
+
+    def __call__(self, particles):
+        if self.threshold is None:
+            raise ValueError('CascadeScorer : no first stage threshold, call calibrate() or pass threshold')
+        start = time.perf_counter()
+        first_scores = self.first_stage(particles)
+        passed = first_scores > self.threshold
+        first_time = time.perf_counter() - start
+        scores = np.full(particles.shape[0], self.reject_score, dtype=np.float32)
+        start = time.perf_counter()
+        if np.any(passed):
+            scores[passed] = self.second_stage(particles[passed])
+        self.stats = {'n_jets': particles.shape[0], 'pass_fraction': np.mean(passed),
+                      'first_stage_time': first_time, 'second_stage_time': time.perf_counter() - start}
+        return scores
+
+
+def encoder_outputs(model, inputs, training=False):
+    ''' raw encoder outputs, [z, z_mean, z_log_var] for the VAEs '''
+    if isinstance(model, pnae.PNVAE):
+        return model.encoder(model.particlenet(inputs, training=training), training=training)
+    return model.encoder(inputs, training=training)
+
+
+def decode(model, z, inputs, n_samples=1, training=False):
+    ''' decode a batch of n_samples*batch latents ordered sample-major, GCN decoders also get the adjacency tiled n_samples times '''
+    if len(getattr(model.decoder, 'inputs', None) or []) == 2:
+        adj = tf.tile(tf.convert_to_tensor(inputs[1]), [n_samples, 1, 1])
+        return model.decoder((z, adj), training=training)
+    return model.decoder(z, training=training)
+
+
+def multi_sample_scores(model, inputs, targets, n_samples=10, batch_size=256, loss_fn=losses.threeD_loss, deterministic=False):
+    ''' stochastic VAE anomaly score : the encoder runs once per batch, n_samples latents per jet are drawn in one tensor
+        and all n_samples x batch latents are decoded in one call. returns mean and variance of the reconstruction loss per jet
+        deterministic=True decodes z_mean only (no sampling), variance is then 0
+    '''
+    n = targets.shape[0]
+    scores_mean = np.empty(n, dtype=np.float32)
+    scores_var = np.zeros(n, dtype=np.float32)
+    for sl in batch_slices(n, batch_size):
+        batch_inputs = tuple(x[sl] for x in inputs)
+        _, z_mean, z_log_var = encoder_outputs(model, batch_inputs)
+        if deterministic:
+            scores_mean[sl] = loss_fn(targets[sl], decode(model, z_mean, batch_inputs)).numpy()
+            continue
+        epsilon = tf.random.normal(tf.concat([[n_samples], tf.shape(z_mean)], axis=0))
+        z = z_mean[tf.newaxis] + tf.exp(0.5 * z_log_var)[tf.newaxis] * epsilon # [S x B x ...]
+        z = tf.reshape(z, tf.concat([[-1], tf.shape(z_mean)[1:]], axis=0)) # [S*B x ...]
+        batch_targets = tf.tile(tf.convert_to_tensor(targets[sl]), [n_samples, 1, 1])
+        loss = tf.reshape(loss_fn(batch_targets, decode(model, z, batch_inputs, n_samples)), [n_samples, -1])
+        scores_mean[sl] = tf.math.reduce_mean(loss, axis=0).numpy()
+        scores_var[sl] = tf.math.reduce_variance(loss, axis=0).numpy()
+    return scores_mean, scores_var
+
+
+def aggregate_event_scores(jet_scores, event_idx, jet_slot, n_events):
+    ''' per event jet scores with segment reductions : event_idx in [0, n_events), events without jets get NaN '''
+    jet_scores = tf.convert_to_tensor(jet_scores, dtype=tf.float32)
+    event_idx = tf.convert_to_tensor(event_idx, dtype=tf.int32)
+    n_jets = tf.math.unsorted_segment_sum(tf.ones_like(jet_scores), event_idx, n_events)
+    empty = tf.equal(n_jets, 0)
+    nan = tf.fill([n_events], np.nan)
+    per_slot = [tf.math.unsorted_segment_sum(tf.where(jet_slot == slot, jet_scores, 0.), event_idx, n_events) for slot in [0, 1]]
+    has_slot = [tf.math.unsorted_segment_sum(tf.cast(jet_slot == slot, tf.float32), event_idx, n_events) > 0 for slot in [0, 1]]
+    return {'n_jets': n_jets.numpy().astype(np.int8),
+            'score_j1': tf.where(has_slot[0], per_slot[0], nan).numpy(),
+            'score_j2': tf.where(has_slot[1], per_slot[1], nan).numpy(),
+            'score_min': tf.where(empty, nan, tf.math.unsorted_segment_min(jet_scores, event_idx, n_events)).numpy(),
+            'score_max': tf.where(empty, nan, tf.math.unsorted_segment_max(jet_scores, event_idx, n_events)).numpy(),
+            'score_mean': tf.where(empty, nan, tf.math.unsorted_segment_sum(jet_scores, event_idx, n_events)/tf.maximum(n_jets, 1.)).numpy()}
+
+
+def score_events(scorer, filename, out_path, start=0, end=None, read_events=50000, stats=None):
+    ''' one streaming pass over a raw event file (jetConstituentsList, eventFeatures) : jets passing the cuts are scored with
+        scorer (particles -> scores, e.g. pn_reco_scorer(model)) and aggregated per event, written to out_path with the eventFeatures
+        every block of read_events is normalized with the same statistics stats (prepr.FeatureNormalization.stats(), e.g. of the
+        training data), by default accumulated over all jets of [start, end) in a first pass, so a score does not depend on its block
+    '''
+    import h5py
+    import utils.preprocessing as prepr
+    with h5py.File(filename, 'r') as inFile, h5py.File(out_path, 'w') as outFile:
+        end = inFile['eventFeatures'].shape[0] if end is None else min(end, inFile['eventFeatures'].shape[0])
+        n_events = end - start
+        outFile.create_dataset('eventFeatures', shape=(n_events,)+inFile['eventFeatures'].shape[1:], dtype='float32')
+        if 'eventFeatureNames' in inFile:
+            outFile.create_dataset('eventFeatureNames', data=inFile['eventFeatureNames'][()])
+        if stats is None:
+            normalization = prepr.FeatureNormalization()
+            for sl in batch_slices(n_events, read_events):
+                samples, _, _ = prepr.events_to_indexed_samples(inFile['jetConstituentsList'][start+sl.start:start+sl.stop],
+                                                                inFile['eventFeatures'][start+sl.start:start+sl.stop])
+                normalization.update(samples)
+            stats = normalization.stats()
+        out = None
+        for sl in batch_slices(n_events, read_events):
+            constituents = inFile['jetConstituentsList'][start+sl.start:start+sl.stop]
+            features = inFile['eventFeatures'][start+sl.start:start+sl.stop]
+            samples, event_idx, jet_slot = prepr.events_to_indexed_samples(constituents, features)
+            jet_scores = scorer(prepr.normalize_features(samples, stats)) if samples.shape[0] > 0 else np.empty(0, dtype=np.float32)
+            event_scores = aggregate_event_scores(jet_scores, event_idx, jet_slot, sl.stop-sl.start)
+            if out is None:
+                out = {key: outFile.create_dataset(key, shape=(n_events,), dtype=value.dtype) for key, value in event_scores.items()}
+            for key, value in event_scores.items():
+                out[key][sl] = value
+            outFile['eventFeatures'][sl] = features
+        outFile.create_dataset('event_index', data=np.arange(start, end))
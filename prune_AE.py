@@ -0,0 +1,60 @@
+import h5py
+from collections import namedtuple
+import tensorflow as tf
+print('tensorflow version: ', tf.__version__)
+
+import models.scoring as scoring
+import models.pruning as pruning
+import utils.input_pipeline as inpipe
+from benchmarks.bench_utils import time_call
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       structured channel pruning of a trained PNVAE : rank, prune, rebuild, fine-tune, report
+# ********************************************************
+
+Parameters = namedtuple('Parameters', 'keep_ratios finetune_epochs train_total_n valid_total_n batch_n learning_rate')
+params = Parameters(keep_ratios=[0.75, 0.5, 0.25],
+                    finetune_epochs=5,
+                    train_total_n=int(2*10e4),
+                    valid_total_n=int(1*10e4),
+                    batch_n=256,
+                    learning_rate=0.0005)
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'
+
+with h5py.File(filename_bg, 'r') as inFile:
+    particles_bg = inFile['particle_bg'][0:params.train_total_n]
+    particles_bg_valid = inFile['particle_bg_valid'][0:params.valid_total_n]
+nodes_n, feat_sz = particles_bg.shape[1:]
+
+setting = pnvae_setting(nodes_n, feat_sz, kl_warmup_time=0)
+
+
+def report(model, label):
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=params.learning_rate))
+    valid = model.evaluate((particles_bg_valid[:,:,0:2], particles_bg_valid), particles_bg_valid, batch_size=1024, verbose=0, return_dict=True)
+    batch = scoring.pn_inputs(particles_bg_valid[:1024])
+    infer = tf.function(lambda inputs: model(inputs, training=False))
+    latency = time_call(lambda: infer(batch), n_repeat=10)
+    print('{:>12s}: conv_params={} decoder={} | {:.2f} MFLOPs/jet, {} params, {:.3f} ms/jet, val_loss={:.4f}'.format(
+        label, [c for _, c in model.setting.conv_params], model.setting.conv_params_decoder,
+        pruning.pnvae_flops(model.setting)/1e6, model.count_params(), 1e3*latency/1024, valid['loss']))
+
+
+base_model = scoring.load_pnvae(setting, weights_path)
+report(base_model, 'original')
+ranks = pruning.rank_channels(base_model)
+train_ds = inpipe.make_pn_dataset(particles_bg, params.batch_n)
+
+for keep_ratio in params.keep_ratios:
+    keep = pruning.select_channels(ranks, keep_ratio)
+    model = pruning.prune_pnvae(base_model, keep)
+    report(model, 'keep {:.2f}'.format(keep_ratio))
+    model.fit(train_ds, validation_data=((particles_bg_valid[:,:,0:2], particles_bg_valid), particles_bg_valid),
+              epochs=params.finetune_epochs, validation_batch_size=1024, verbose=2)
+    report(model, '+ fine-tune')
+    model.save_weights(MODELS_PATH + 'PN_VAE_pruned_{:.2f}_weights.hdf5'.format(keep_ratio))
@@ -0,0 +1,95 @@
+import os
+import h5py
+from collections import namedtuple
+from datetime import datetime
+import tensorflow as tf
+print('tensorflow version: ', tf.__version__)
+
+import models.models as models
+import models.ParticleNetAE as pnae
+import models.scoring as scoring
+import utils.feature_cache as fcache
+from utils.staging import staged
+from utils.settings import pnvae_setting, copy_setting
+
+# ********************************************************
+#       retrain the latent / decoder part of a trained PNVAE on cached backbone features :
+#       the ParticleNet backbone is frozen and run once over the data, every epoch then costs only the encoder / decoder
+# ********************************************************
+
+Parameters = namedtuple('Parameters', 'model latent_dim beta_kl kl_warmup_time conv_params_decoder epochs train_total_n valid_total_n batch_n activation learning_rate')
+params = Parameters(model='PN_VAE_head',
+                    latent_dim=5,
+                    beta_kl=10,
+                    kl_warmup_time=3,
+                    conv_params_decoder=[10,8,4],
+                    epochs=100,
+                    train_total_n=int(1*10e5),
+                    valid_total_n=int(1*10e4),
+                    batch_n=256,
+                    activation=tf.keras.layers.LeakyReLU(alpha=0.1),
+                    learning_rate=0.001)
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+backbone_weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'
+CACHE_PATH = os.environ.get('ADGVAE_FEATURE_CACHE', '/tmp/adgvae_feature_cache/') # local disk, the stores are read every epoch
+
+# ********************************************************
+#       data : jets stay in the hdf5 file and are streamed as reconstruction targets
+# ********************************************************
+
+inFile = h5py.File(staged(filename_bg), 'r')
+particles_bg = inFile['particle_bg']
+particles_bg_valid = inFile['particle_bg_valid']
+train_n = min(params.train_total_n, particles_bg.shape[0])
+valid_n = min(params.valid_total_n, particles_bg_valid.shape[0])
+nodes_n, feat_sz = particles_bg.shape[1:]
+
+# *******************************************************
+#                       backbone setting (as trained) and new head
+# *******************************************************
+
+setting = pnvae_setting(nodes_n, feat_sz, kl_warmup_time=params.kl_warmup_time, activation=params.activation)
+
+head_setting = copy_setting(setting, latent_dim=params.latent_dim, beta_kl=params.beta_kl, conv_params_decoder=params.conv_params_decoder)
+
+# *******************************************************
+#                       cache the backbone features (once per backbone checkpoint)
+# *******************************************************
+
+backbone = scoring.load_pnvae(setting, backbone_weights_path).particlenet
+os.makedirs(CACHE_PATH, exist_ok=True)
+store_name = os.path.splitext(os.path.basename(backbone_weights_path))[0]
+features_train = fcache.cached_features(backbone, particles_bg[0:train_n], CACHE_PATH + store_name + '_train.f32', backbone_weights_path,
+                                        inputs=dict(fcache.file_identity(filename_bg), dataset='particle_bg', rows=[0, train_n]))
+features_valid = fcache.cached_features(backbone, particles_bg_valid[0:valid_n], CACHE_PATH + store_name + '_valid.f32', backbone_weights_path,
+                                        inputs=dict(fcache.file_identity(filename_bg), dataset='particle_bg_valid', rows=[0, valid_n]))
+print('Cached backbone features : train {}, valid {}'.format(features_train.shape, features_valid.shape))
+
+# *******************************************************
+#                       train encoder / decoder only
+# *******************************************************
+
+model = pnae.CachedBackbonePNVAE(setting=head_setting, name='PN_AE_')
+model(scoring.pn_inputs(particles_bg[0:1]), training=False) # build variables
+model.load_backbone(backbone)
+scoring.check_pnvae_checkpoint(model, head_setting, CACHE_PATH + 'roundtrip_check.hdf5') # checkpoints must load as a plain PNVAE
+model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=params.learning_rate))
+
+train_ds = fcache.make_cached_dataset(features_train, particles_bg, params.batch_n, shuffle=True)
+valid_ds = fcache.make_cached_dataset(features_valid, particles_bg_valid, params.batch_n, shuffle=False)
+
+timestamp = str(datetime.now().isoformat(timespec='minutes').replace(':',"_").replace('T','_T_').replace('-','_'))
+checkpoint_filepath = MODELS_PATH + '{}_weights_'.format(params.model)+timestamp+'.{epoch:02d}-{val_loss:.3f}.hdf5'
+callbacks = [tf.keras.callbacks.ModelCheckpoint(filepath=checkpoint_filepath, save_weights_only=True, monitor='val_loss', mode='min', save_best_only=True),
+             tf.keras.callbacks.ReduceLROnPlateau(factor=0.1,min_delta=0.0005, patience=5, verbose=2),
+             tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10, verbose=2),
+             models.KLWarmupCallback()]
+
+history = model.fit(train_ds,
+                    validation_data=valid_ds,
+                    epochs=params.epochs,
+                    verbose=1,
+                    callbacks=callbacks)
@@ -0,0 +1,25 @@
+import tensorflow as tf
+import models.ensemble as ensemble
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       one-pass scoring of several PNVAE checkpoints, per model scores + combinations in one file
+# ********************************************************
+
+DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
+filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
+OUTPUT_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_scores/'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+nodes_n, feat_sz = 100, 3
+
+# (ae_type, latent_dim, checkpoint)
+CHECKPOINTS = [('vae', 10, MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'),
+               ('ae', 10, MODELS_PATH + 'PN_AE_weights_2021_07_28_T_10_12.08-0.041.hdf5'),
+               ]
+
+combinations = dict(ensemble.DEFAULT_COMBINATIONS)
+combinations['vae_weighted'] = ensemble.weighted_mean([2., 1.])
+
+scorer = ensemble.load_ensemble([pnvae_setting(nodes_n, feat_sz, ae_type=ae_type, latent_dim=latent_dim) for ae_type, latent_dim, _ in CHECKPOINTS],
+                                [path for _, _, path in CHECKPOINTS], combinations=combinations)
+scorer.score_file(filename_bg, OUTPUT_PATH + 'QCD_test_ensemble_scores.h5', dataset='particle_bg_test')
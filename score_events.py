@@ -0,0 +1,23 @@
+import tensorflow as tf
+import models.scoring as scoring
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       event level (dijet) scoring of raw event files in one streaming pass
+# ********************************************************
+
+DATA_PATH = '/eos/project/d/dshep/TOPCLASS/DijetAnomaly/VAE_data/events/'
+SAMPLES = ['qcd_sqrtshatTeV_13TeV_PU40_NEW_EXT_sideband', 'RSGraviton_WW_NARROW_13TeV_PU40_3.5TeV_NEW']
+OUTPUT_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_scores/'
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5'
+nodes_n, feat_sz = 100, 3
+
+setting = pnvae_setting(nodes_n, feat_sz)
+
+model = scoring.load_pnvae(setting, weights_path)
+scorer = scoring.pn_reco_scorer(model)
+for sample in SAMPLES:
+    filename = DATA_PATH + sample + '_parts/' + sample + ('_000.h5' if sample.startswith('qcd') else '_concat_001.h5')
+    scoring.score_events(scorer, filename, OUTPUT_PATH + sample + '_event_scores.h5')
+    print('Scored', filename)
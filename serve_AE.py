@@ -0,0 +1,28 @@
+import os
+import tensorflow as tf
+
+import models.scoring as scoring
+import models.numpy_inference as npinf
+from utils.scoring_service import ScoringServer
+from utils.settings import pnvae_setting
+
+# ********************************************************
+#       local scoring service : one loaded model, dynamic batching of concurrent requests
+#       clients : utils.scoring_service.ScoringClient(path=SOCKET_PATH).score(particles)
+# ********************************************************
+
+SOCKET_PATH = os.environ.get('ADGVAE_SCORING_SOCKET', '/tmp/adgvae_scoring.sock')
+MODELS_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/output_models/'
+weights_path = MODELS_PATH + 'PN_VAE_weights_2021_08_02_T_13_31.04-0.033.hdf5' # or an export_npz .npz (numpy forward pass)
+max_batch_size, max_wait_ms = 1024, 5.
+nodes_n, feat_sz = 100, 3
+
+setting = pnvae_setting(nodes_n, feat_sz)
+
+if weights_path.endswith('.npz'):
+    score_fn = npinf.load_npz(weights_path).scores
+else:
+    score_fn = scoring.pn_reco_scorer(scoring.load_pnvae(setting, weights_path), batch_size=max_batch_size)
+
+print('Scoring service on', SOCKET_PATH)
+ScoringServer(score_fn, path=SOCKET_PATH, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, input_shape=setting.input_shapes['features']).run()
@@ -13,6 +13,11 @@ import models.models as models
 import models.ParticleNetAE as pnae
 import models.losses as losses
 import utils.preprocessing as prepr
+import utils.autotune as autotune
+import utils.input_pipeline as inpipe
+from utils.chunk_sampler import ChunkShuffleSampler
+from utils.staging import staged
+from utils.settings import pnvae_setting
 
 # ********************************************************
 #       runtime params
@@ -36,7 +41,7 @@ params = Parameters(model='PN_VAE',
 
 DATA_PATH = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/'
 filename_bg = DATA_PATH + 'QCD_training_data_100const_03_08_2021.h5'
-inFile = h5py.File(filename_bg, 'r')
+inFile = h5py.File(staged(filename_bg), 'r') # local copy if ADGVAE_STAGING_DIR is set
 #particles_bg = inFile['particle_bg'][()]
 #particles_bg_valid = inFile['particle_bg_valid'][()]
 particles_bg = inFile['particle_bg'][0:params.train_total_n]
@@ -81,44 +86,35 @@ callbacks = [tf.keras.callbacks.ReduceLROnPlateau(factor=0.1,min_delta=0.0005, p
 #gcnvae.save('output_model_saved_GCN_VAE_{}'.format(timestamp))
 
 #Particle Net
-class _DotDict:
-    pass
-
-setting = _DotDict()
- # conv_params: list of tuple in the format (K, (C1, C2, C3))
-setting.conv_params = [
-        (20, [64]),
-        (15, [32]),
-        (7, [12]),
-      #  (20, (32, 32, 32)),
-      #  (20, (64, 64, 64)),
-      #  (, (32, 32, 32)),
-      #  (20, (64, 64, 64)),
-        ]
-setting.conv_params_encoder_input = 12
-#setting.conv_params_decoder = [64,32,6]
-setting.conv_params_decoder = [10,8,4]
-# conv_pooling: 'average' or 'max'
-setting.conv_pooling = 'average'
-setting.conv_linking = 'concat' #concat or sum
-setting.num_points = nodes_n #num of original consituents
-setting.num_features = feat_sz #num of original features
-setting.input_shapes = {'points': [nodes_n,feat_sz-1],'features':[nodes_n,feat_sz]}
-setting.latent_dim = params.latent_dim
-setting.ae_type = 'vae'  #ae or vae 
-setting.beta_kl = 10
-setting.kl_warmup_time = params.kl_warmup_time
-setting.activation = params.activation
+setting = pnvae_setting(nodes_n, feat_sz,
+                        latent_dim=params.latent_dim,
+                        kl_warmup_time=params.kl_warmup_time,
+                        activation=params.activation,
+                        # knn_engines: per block 'exact' or 'grid' (approximate spatial hash on (eta, phi), for large numbers of constituents)
+                        knn_engines=['exact', 'exact', 'exact'],
+                        # recompute_blocks: per block, recompute the EdgeConv intermediates in the backward pass instead of storing them (less memory, slower steps)
+                        recompute_blocks=[False, False, False],
+                        # fused_edgeconv: first EdgeConv conv applied per point before the neighbour gather (same outputs and weights), True fuses only the
+                        # blocks whose first conv does not widen the input (not the 3 -> 64 first block), see benchmarks/fused_edgeconv_benchmark.py for the peak memory
+                        fused_edgeconv=False)
+
+# thread pools and batch size from autotune_AE.py for this config and host, if tuned
+batch_size = autotune.apply_tuned_config(setting, mode='train', default_batch_size=params.batch_n)
 
 model = pnae.PNVAE(setting=setting,name='PN_AE_')
 model.compile(optimizer=optimizer)
 #model.summary()
 
 model.save('output_model_saved_{}_{}'.format(params.model,timestamp))
-history = model.fit((particles_bg[:,:,0:2], particles_bg) , particles_bg,
+# constituents are permuted per jet and per epoch inside the input pipeline
+train_ds = inpipe.make_pn_dataset(particles_bg, batch_size, shuffle=True, augment_constituents=True)
+# to shuffle over the full file(s) without loading them in memory : 
+#sampler = ChunkShuffleSampler([filename_bg], dataset='particle_bg', batch_size=batch_size)
+#train_ds = inpipe.make_pn_dataset(sampler.as_dataset(), batch_size, batched=True)
+history = model.fit(train_ds,
                     validation_data = ((particles_bg_valid[:,:,0:2], particles_bg_valid) , particles_bg_valid),
                     epochs=params.epochs, 
-                    batch_size=batch_size, 
+                    validation_batch_size=batch_size, 
                     verbose=1,
                     callbacks=callbacks) 
 
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import resource
+import multiprocessing as mp
+import queue as queue_lib
+import numpy as np
+from utils.settings import DotDict
+
+''' CPU autotuning of TensorFlow thread pools and train/score batch sizes for PNVAE
+    every (intra-op, inter-op) thread setting is probed in a fresh process (TF thread pools can only be set before
+    the runtime starts), timing a few train_step and inference calls for increasing batch sizes until the memory ceiling.
+    the best configuration is stored per (model config, host) in a json cache picked up by apply_tuned_config()
+'''
+
+DEFAULT_CACHE_PATH = os.environ.get('ADGVAE_AUTOTUNE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'adgvae', 'autotune.json'))
+SETTING_KEYS = ['conv_params', 'conv_params_encoder_input', 'conv_params_decoder', 'with_bn', 'conv_pooling', 'conv_linking',
+                'num_points', 'num_features', 'input_shapes', 'latent_dim', 'ae_type', 'beta_kl', 'kl_warmup_time',
+                'knn_engines', 'recompute_blocks', 'fused_edgeconv']
+
+
+def host_key():
+    return '{}_{}cpu'.format(socket.gethostname(), os.cpu_count())
+
+
+def setting_to_dict(setting):
+    ''' plain (picklable, json-able) copy of a PNVAE setting, the activation is stored as its keras config '''
+    import tensorflow as tf
+    setting_dict = {key: getattr(setting, key) for key in SETTING_KEYS if hasattr(setting, key)}
+    activation = getattr(setting, 'activation', None)
+    if isinstance(activation, tf.keras.layers.Layer):
+        setting_dict['activation'] = ('layer', tf.keras.layers.serialize(activation))
+    elif activation is not None:
+        setting_dict['activation'] = ('name', activation if isinstance(activation, str) else tf.keras.activations.serialize(activation))
+    return setting_dict
+
+
+def setting_from_dict(setting_dict):
+    import tensorflow as tf
+    setting = DotDict()
+    for key, value in setting_dict.items():
+        setattr(setting, key, value)
+    setting.conv_params = [tuple(p) for p in setting.conv_params]
+    activation = setting_dict.get('activation')
+    if activation is None:
+        setting.activation = None
+    elif activation[0] == 'layer':
+        setting.activation = tf.keras.layers.deserialize(activation[1])
+    else:
+        setting.activation = tf.keras.activations.get(activation[1])
+    return setting
+
+
+def config_key(setting):
+    ''' hash of the model configuration entering the cost of a step '''
+    setting_dict = setting_to_dict(setting)
+    for key in ['activation', 'beta_kl', 'kl_warmup_time']:
+        setting_dict.pop(key, None)
+    # per block options as PNVAE resolves them, so unset / True / explicit lists of the same blocks share a key
+    import models.ParticleNetAE as pnae
+    setting_dict['knn_engines'] = list(pnae.knn_engines(setting))
+    setting_dict['recompute_blocks'] = [bool(r) for r in pnae.recompute_blocks(setting)]
+    setting_dict['fused_edgeconv'] = [bool(f) for f in pnae.fused_blocks(setting)]
+    return hashlib.sha1(json.dumps(setting_dict, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. # kB on linux
+
+
+def _probe(setting_dict, intra, inter, batch_sizes, n_steps, max_memory_mb, queue):
+    ''' runs in a fresh process : set the thread pools, then time train_step and inference per batch size '''
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+    import models.ParticleNetAE as pnae
+    setting = setting_from_dict(setting_dict)
+    model = pnae.PNVAE(setting=setting, name='PN_AE_')
+    model.compile(optimizer=tf.keras.optimizers.Adam())
+    train_step = tf.function(model.train_step)
+    infer = tf.function(lambda inputs: model(inputs, training=False))
+    rng = np.random.default_rng(0)
+    for batch_size in sorted(batch_sizes):
+        x = rng.normal(size=[batch_size]+list(setting.input_shapes['features'])).astype(np.float32)
+        inputs = (tf.constant(x[:,:,0:2]), tf.constant(x))
+        train_step((inputs, inputs[1])) # tracing
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            train_step((inputs, inputs[1]))
+        train_time = (time.perf_counter() - start) / n_steps
+        infer(inputs)
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            infer(inputs)
+        score_time = (time.perf_counter() - start) / n_steps
+        result = {'intra_op_threads': intra, 'inter_op_threads': inter, 'batch_size': batch_size,
+                  'train_jets_per_s': batch_size/train_time, 'score_jets_per_s': batch_size/score_time,
+                  'peak_memory_mb': _peak_memory_mb()}
+        queue.put(result)
+        if max_memory_mb is not None and result['peak_memory_mb'] > max_memory_mb:
+            break
+
+
+def _run_probe(setting_dict, intra, inter, batch_sizes, n_steps, max_memory_mb):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_probe, args=(setting_dict, intra, inter, batch_sizes, n_steps, max_memory_mb, queue))
+    proc.start()
+    results = []
+    while proc.is_alive() or not queue.empty():
+        try:
+            results.append(queue.get(timeout=1.))
+        except queue_lib.Empty:
+            pass
+    proc.join()
+    return results # probes killed (e.g. OOM) only report the batch sizes done so far
+
+
+def load_cache(cache_path=None):
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_cache(cache, cache_path=None):
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+
+def autotune(setting, batch_sizes=(64, 128, 256, 512, 1024), intra_threads=None, inter_threads=(1, 2), n_steps=5, max_memory_mb=None, cache_path=None):
+    ''' probe the grid and store the best train and score configuration for (setting, host), returns the cache entry '''
+    if intra_threads is None:
+        n_cpu = os.cpu_count()
+        intra_threads = sorted(set([2**i for i in range(int(np.log2(n_cpu))+1)] + [n_cpu]))
+    setting_dict = setting_to_dict(setting)
+    results = []
+    for intra in intra_threads:
+        for inter in inter_threads:
+            probe = _run_probe(setting_dict, intra, inter, batch_sizes, n_steps, max_memory_mb)
+            for r in probe:
+                print('intra={intra_op_threads} inter={inter_op_threads} batch={batch_size}: train {train_jets_per_s:.0f} jets/s, '
+                      'score {score_jets_per_s:.0f} jets/s, peak {peak_memory_mb:.0f} MB'.format(**r))
+            results += probe
+    if max_memory_mb is not None:
+        results = [r for r in results if r['peak_memory_mb'] <= max_memory_mb]
+    if not results:
+        raise RuntimeError('autotune: no configuration fits in {} MB'.format(max_memory_mb))
+    best = {mode: max(results, key=lambda r: r[mode+'_jets_per_s']) for mode in ['train', 'score']}
+    entry = {mode: {key: best[mode][key] for key in ['intra_op_threads', 'inter_op_threads', 'batch_size', mode+'_jets_per_s']} for mode in best}
+    entry['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    cache = load_cache(cache_path)
+    cache.setdefault(host_key(), {})[config_key(setting)] = entry
+    save_cache(cache, cache_path)
+    return entry
+
+
+def tuned_config(setting, mode='train', cache_path=None):
+    ''' cached best config for this (setting, host) and mode ('train' or 'score'), None if not tuned '''
+    entry = load_cache(cache_path).get(host_key(), {}).get(config_key(setting))
+    return None if entry is None else entry[mode]
+
+
+def apply_tuned_config(setting, mode='train', default_batch_size=256, cache_path=None):
+    ''' set TF thread pools from the cache (only possible before TF runs any op) and return the tuned batch size '''
+    import tensorflow as tf
+    config = tuned_config(setting, mode, cache_path)
+    if config is None:
+        return default_batch_size
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+    except RuntimeError as e:
+        print('autotune: thread settings not applied, TF runtime already initialized ({})'.format(e))
+    return config['batch_size']
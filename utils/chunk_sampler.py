@@ -0,0 +1,101 @@
+import numpy as np
+import h5py
+
+
+class ChunkShuffleSampler():
+
+    ''' near-uniform shuffling over one or more HDF5 files (shards) at sequential read speed
+        each epoch the order of the chunks (blocks of rows, aligned to the HDF5 storage chunks) is shuffled over all shards,
+        whole chunks are read with one sequential read and buffer_chunks of them are mixed in an in-memory shuffle buffer
+        memory is bounded by buffer_chunks * rows_per_chunk rows
+        cache : optional utils.staging.StagingCache, shards are then staged to local disk in the background and read from there
+    '''
+
+    def __init__(self, filenames, dataset='particle_bg', batch_size=256, rows_per_chunk=None, buffer_chunks=16, max_rows=None, seed=None, cache=None):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        self.cache = cache
+        if cache is not None:
+            cache.prefetch(self.filenames)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.buffer_chunks = buffer_chunks
+        self.rng = np.random.default_rng(seed)
+        self.chunks = [] # (file index, start, stop)
+        total = 0
+        for file_idx, filename in enumerate(self.filenames):
+            with h5py.File(filename, 'r') as f:
+                ds = f[self.dataset]
+                n_rows = ds.shape[0] if max_rows is None else min(ds.shape[0], max_rows-total)
+                self.sample_shape, self.dtype = ds.shape[1:], ds.dtype
+                storage_rows = ds.chunks[0] if ds.chunks is not None else 1
+                # read whole storage chunks : gzip decompresses per storage chunk
+                step = rows_per_chunk or max(storage_rows, 4096)
+                step = int(np.ceil(step/storage_rows)*storage_rows)
+            self.chunks += [(file_idx, start, min(start+step, n_rows)) for start in range(0, n_rows, step)]
+            total += n_rows
+            if max_rows is not None and total >= max_rows:
+                break
+        self.n_rows = total
+
+    def __len__(self):
+        ''' number of batches per epoch '''
+        return int(np.ceil(self.n_rows/self.batch_size))
+
+    def _shuffled_chunks(self):
+        order = self.rng.permutation(len(self.chunks))
+        files = [h5py.File(filename if self.cache is None else self.cache.get(filename), 'r') for filename in self.filenames]
+        try:
+            for idx in order:
+                file_idx, start, stop = self.chunks[idx]
+                yield files[file_idx][self.dataset][start:stop]
+        finally:
+            for f in files:
+                f.close()
+
+    def __iter__(self):
+        ''' one epoch of shuffled batches, the last one may be smaller '''
+        buffer, leftover = [], np.empty((0,)+self.sample_shape, dtype=self.dtype)
+        for chunk in self._shuffled_chunks():
+            buffer.append(chunk)
+            if len(buffer) < self.buffer_chunks:
+                continue
+            leftover = yield from self._emit(np.concatenate([leftover]+buffer), keep_remainder=True)
+            buffer = []
+        yield from self._emit(np.concatenate([leftover]+buffer), keep_remainder=False)
+
+    def _emit(self, samples, keep_remainder):
+        samples = samples[self.rng.permutation(samples.shape[0])]
+        n_full = (samples.shape[0]//self.batch_size)*self.batch_size
+        for start in range(0, n_full, self.batch_size):
+            yield samples[start:start+self.batch_size]
+        if keep_remainder:
+            return samples[n_full:]
+        if n_full < samples.shape[0]:
+            yield samples[n_full:]
+        return None
+
+    def as_dataset(self):
+        ''' tf.data.Dataset of batches, a new chunk order every epoch (pass to input_pipeline.make_pn_dataset(..., batched=True)) '''
+        import tensorflow as tf
+        return tf.data.Dataset.from_generator(lambda: iter(self),
+                            output_signature=tf.TensorSpec(shape=(None,)+tuple(self.sample_shape), dtype=tf.as_dtype(self.dtype)))
+
+
+def sample_rows(filenames, n, dataset='particle_bg', seed=None):
+    ''' uniform random sample of n rows over one or more HDF5 files, e.g. a small replay buffer of old training data '''
+    filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+    rng = np.random.default_rng(seed)
+    sizes = []
+    for filename in filenames:
+        with h5py.File(filename, 'r') as f:
+            sizes.append(f[dataset].shape[0])
+    picked = np.sort(rng.choice(np.sum(sizes), size=min(n, np.sum(sizes)), replace=False))
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    samples = []
+    for file_idx, filename in enumerate(filenames):
+        rows = picked[(picked >= offsets[file_idx]) & (picked < offsets[file_idx+1])] - offsets[file_idx]
+        if len(rows) == 0: continue
+        with h5py.File(filename, 'r') as f:
+            samples.append(f[dataset][rows]) # h5py point selection needs increasing indices
+    samples = np.concatenate(samples)
+    return samples[rng.permutation(samples.shape[0])]
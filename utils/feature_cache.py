@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+''' cached ParticleNet backbone features : the flattened output of a frozen particlenet is computed once over the dataset
+    into a memory-mapped store (raw float32 file + <path>.json with its shape), the encoder / decoder are then trained
+    from the store (CachedBackbonePNVAE) with the reconstruction targets streamed alongside.
+    jets are not augmented : the cached features are those of the stored constituent order
+'''
+
+
+def file_identity(path):
+    ''' absolute path, size and mtime of a file : changes when the file is rewritten in place '''
+    st = os.stat(path)
+    return dict(path=os.path.abspath(path), size=st.st_size, mtime=st.st_mtime)
+
+
+def array_fingerprint(particles, n_rows=64):
+    ''' shape and hash of n_rows rows spread over particles (array or hdf5 dataset), a cheap identity of the inputs '''
+    rows = np.unique(np.linspace(0, particles.shape[0]-1, num=min(n_rows, particles.shape[0])).astype(int))
+    digest = hashlib.sha1(np.ascontiguousarray(particles[rows], dtype=np.float32).tobytes()).hexdigest() if rows.size else ''
+    return dict(shape=list(particles.shape), sha1=digest)
+
+
+def build_feature_store(particlenet, particles, path, batch_size=1024, source=None):
+    ''' particlenet (inference mode) over particles [N x P x F] (array or hdf5 dataset), the [N x D] outputs written to path
+        source : json-able identity of the backbone and inputs, stored with the shape in <path>.json '''
+    n, dim = particles.shape[0], int(particlenet.output_shape[-1])
+    store = np.memmap(path, dtype=np.float32, mode='w+', shape=(n, dim))
+    backbone = tf.function(lambda x: particlenet((x[:,:,0:2], x), training=False))
+    for start in range(0, n, batch_size):
+        batch = tf.convert_to_tensor(particles[start:start+batch_size], dtype=tf.float32)
+        store[start:start+batch_size] = backbone(batch).numpy()
+    store.flush()
+    del store
+    with open(path + '.json', 'w') as f:
+        json.dump(dict(shape=[n, dim], dtype='float32', backbone=particlenet.name, source=source), f, indent=2)
+    return open_feature_store(path)
+
+
+def open_feature_store(path):
+    ''' read-only [N x D] memmap of a store written by build_feature_store '''
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    return np.memmap(path, dtype=meta['dtype'], mode='r', shape=tuple(meta['shape']))
+
+
+def cached_features(particlenet, particles, path, checkpoint, inputs=None, batch_size=1024):
+    ''' store at path if it was built from the same backbone checkpoint file (path, size and mtime) and the same inputs, rebuilt otherwise
+        inputs : json-able identity of particles (e.g. file_identity of the hdf5 file with the dataset name and rows),
+        array_fingerprint(particles) by default
+    '''
+    source = dict(checkpoint=file_identity(checkpoint), inputs=array_fingerprint(particles) if inputs is None else inputs)
+    source = json.loads(json.dumps(source)) # as read back from the json sidecar
+    if os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        if meta.get('source') == source and meta['shape'][0] == particles.shape[0]:
+            return open_feature_store(path)
+    return build_feature_store(particlenet, particles, path, batch_size=batch_size, source=source)
+
+
+def make_cached_dataset(features, targets, batch_size, shuffle=True, seed=None):
+    ''' tf.data pipeline of (features, targets) batches read from the store and the matching jets (row i of the store is
+        row i of targets, targets may be longer), reshuffled every epoch, indices sorted inside a batch for sequential reads
+        (hdf5 targets need increasing indices)
+    '''
+    assert features.shape[0] <= targets.shape[0], 'feature store longer than the targets'
+    n = features.shape[0]
+    rng = np.random.default_rng(seed)
+
+    def generator():
+        order = rng.permutation(n) if shuffle else np.arange(n)
+        for start in range(0, n, batch_size):
+            batch_ids = np.sort(order[start:start+batch_size])
+            yield np.asarray(features[batch_ids], dtype=np.float32), np.asarray(targets[batch_ids], dtype=np.float32)
+
+    spec = (tf.TensorSpec(shape=(None, features.shape[1]), dtype=tf.float32),
+            tf.TensorSpec(shape=(None,)+tuple(targets.shape[1:]), dtype=tf.float32))
+    return tf.data.Dataset.from_generator(generator, output_signature=spec).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,94 @@
+import numpy as np
+import tensorflow as tf
+import utils.input_pipeline as inpipe
+
+''' loss-aware importance sampling of training jets : train_step writes the per jet reconstruction loss into a LossStore
+    (indexed by jet id), each epoch draws jets with probability p_i ~ (1-uniform_mix) * loss_i / sum(loss) + uniform_mix / N
+    and weights them by 1 / (N p_i), so the weighted batch loss stays an unbiased estimate of the mean loss over all jets
+'''
+
+
+class LossStore():
+
+    ''' last seen training loss of every jet, a tf.Variable updated from the compiled train_step (not tracked by the model,
+        so checkpoints are unchanged). jets not seen yet get the largest recorded loss when sampling
+    '''
+
+    def __init__(self, n_jets):
+        self.n_jets = n_jets
+        self.losses = tf.Variable(tf.fill([n_jets], np.nan), trainable=False, name='jet_losses', dtype=tf.float32)
+
+    def update(self, jet_ids, losses):
+        self.losses.scatter_update(tf.IndexedSlices(tf.cast(losses, tf.float32), tf.cast(jet_ids, tf.int32)))
+
+    def snapshot(self):
+        losses = self.losses.numpy()
+        seen = np.isfinite(losses)
+        if not np.any(seen):
+            return np.ones(self.n_jets, dtype=np.float32)
+        return np.where(seen, losses, np.max(losses[seen]))
+
+
+def sampling_distribution(losses, uniform_mix=0.2):
+    ''' p_i and importance weights 1 / (N p_i), mixing with the uniform distribution bounds the weights by 1 / uniform_mix '''
+    n = losses.shape[0]
+    losses = np.maximum(losses, 0.)
+    p = (1.-uniform_mix) * losses / max(np.sum(losses), 1e-12) + uniform_mix / n
+    p /= np.sum(p)
+    return p, (1. / (n * p)).astype(np.float32)
+
+
+class ImportanceSampler():
+
+    ''' per epoch sample of jet ids : uniform for the first warmup_epochs (losses are still recorded),
+        then drawn by loss. epoch_fraction < 1 shortens the epochs, as most of the well reconstructed jets are skipped
+    '''
+
+    def __init__(self, store, batch_size, epoch_fraction=0.5, uniform_mix=0.2, warmup_epochs=2, seed=None):
+        self.store = store
+        self.batch_size = batch_size
+        self.epoch_fraction = epoch_fraction
+        self.uniform_mix = uniform_mix
+        self.warmup_epochs = warmup_epochs
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+
+    def __len__(self):
+        ''' batches per epoch (after warm-up) '''
+        return int(np.ceil(self.epoch_fraction * self.store.n_jets / self.batch_size))
+
+    def sample_epoch(self):
+        ''' (jet ids, importance weights) of the next epoch '''
+        n = self.store.n_jets
+        if self.epoch < self.warmup_epochs:
+            ids, weights = self.rng.permutation(n), np.ones(n, dtype=np.float32)
+        else:
+            p, weights = sampling_distribution(self.store.snapshot(), self.uniform_mix)
+            ids = self.rng.choice(n, size=int(self.epoch_fraction * n), replace=True, p=p)
+            weights = weights[ids]
+        self.epoch += 1
+        return ids, weights
+
+
+def make_importance_dataset(particles, sampler, augment_constituents=True, reflect=False):
+    ''' tf.data pipeline for ImportanceSampledPNVAE : elements ((points, features, jet_id), features, weight),
+        the generator is re-run at every epoch so it samples from the losses recorded so far
+    '''
+    batch_size = sampler.batch_size
+
+    def generator():
+        ids, weights = sampler.sample_epoch()
+        for start in range(0, ids.shape[0], batch_size):
+            batch_ids = ids[start:start+batch_size]
+            yield particles[batch_ids], batch_ids.astype(np.int32), weights[start:start+batch_size]
+
+    spec = (tf.TensorSpec(shape=(None,)+particles.shape[1:], dtype=tf.float32),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32), tf.TensorSpec(shape=(None,), dtype=tf.float32))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=spec)
+
+    def to_inputs(x, jet_ids, weights):
+        if augment_constituents:
+            x = inpipe.augment(x, reflect=reflect)
+        return (x[:,:,0:2], x, jet_ids), x, weights
+
+    return dataset.map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,95 @@
+import numpy as np
+import tensorflow as tf
+import utils.preprocessing as prepr
+
+
+def permute_constituents(particles):
+    ''' independent random permutation of the constituents of every jet, particles [N x P x C] '''
+    shape = tf.shape(particles)
+    perm = tf.argsort(tf.random.uniform(shape[:2]), axis=1)
+    return tf.gather(particles, perm, batch_dims=1)
+
+
+def reflect_eta_phi(particles, idx_eta=0, idx_phi=1):
+    ''' random sign flip of eta and phi per jet (independently), normalized angles are centered at 0 '''
+    batch = tf.shape(particles)[0]
+    num_features = particles.shape[-1]
+    signs = tf.where(tf.random.uniform((batch, 2)) < 0.5, -1., 1.) # [N x 2]
+    flip = 1. + (signs[:,0:1]-1.)*tf.one_hot(idx_eta, num_features) + (signs[:,1:2]-1.)*tf.one_hot(idx_phi, num_features) # [N x C]
+    return particles * tf.cast(flip[:, tf.newaxis, :], particles.dtype)
+
+
+def augment(particles, reflect=False):
+    particles = permute_constituents(particles)
+    if reflect:
+        particles = reflect_eta_phi(particles)
+    return particles
+
+
+def to_pn_inputs(particles):
+    ''' ((points, features), target) as expected by PNVAE.train_step '''
+    return (particles[:,:,0:2], particles), particles
+
+
+def mix_with_replay(batched_dataset, replay_particles, batch_size, replay_fraction=0.2):
+    ''' mix a dataset of new (batched) jets with jets drawn from an in-memory replay buffer of old data,
+        a fraction replay_fraction of each output batch comes from the replay buffer on average. one pass over the new data per epoch
+    '''
+    replay = tf.data.Dataset.from_tensor_slices(replay_particles).shuffle(replay_particles.shape[0]).repeat()
+    mixed = tf.data.Dataset.sample_from_datasets([batched_dataset.unbatch(), replay], weights=[1.-replay_fraction, replay_fraction],
+                                                 stop_on_empty_dataset=True)
+    return mixed.batch(batch_size)
+
+
+def make_pn_dataset(particles, batch_size, shuffle=True, augment_constituents=True, reflect=False, drop_remainder=False, buffer_size=100000, batched=False):
+    ''' tf.data pipeline feeding PNVAE : jets are shuffled and constituents re-permuted per jet each epoch on whole batches,
+        so the stored samples can stay in pt order (see constituents_to_input_samples(shuffle_constituents=False))
+        batched=True : particles is already a dataset of shuffled batches (e.g. ChunkShuffleSampler.as_dataset())
+    '''
+    dataset = particles if isinstance(particles, tf.data.Dataset) else tf.data.Dataset.from_tensor_slices(particles)
+    if not batched:
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    if augment_constituents:
+        dataset = dataset.map(lambda x: augment(x, reflect=reflect), num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(to_pn_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_graph_dataset(inputs, targets=None, batch_size=256, shuffle=True, drop_remainder=True, buffer_size=100000):
+    ''' tf.data pipeline for the GCN / EdgeConv autoencoders, inputs and targets are arrays or tuples of arrays
+        (e.g. (X, A_tilde) and A for GCNAutoEncoder, ((points, edges), points) for EdgeConvAutoEncoder)
+        drop_remainder=True keeps the batch dimension static, so the compiled train step is traced once and not again on the last partial batch
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices(inputs if targets is None else (inputs, targets))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_knn_graph_dataset(particles, mask, k, batch_size=256, shuffle=True):
+    ''' tf.data pipeline for KNNGCNAutoEncoder : every batch of jets becomes one disjoint union kNN graph (prepr.knn_graph),
+        elements are ((nodes, (senders, receivers, weights), node_graph, node_slot), nodes) with a variable number of nodes / edges
+        mask [N x P] : prepr.real_particles_mask before normalization (prepare_data_constituents(..., return_mask=True)),
+        jets without real constituents are skipped
+    '''
+    feat_sz = particles.shape[-1]
+
+    def generator():
+        order = np.random.permutation(particles.shape[0]) if shuffle else np.arange(particles.shape[0])
+        for start in range(0, particles.shape[0], batch_size):
+            idx = np.sort(order[start:start+batch_size]) # sorted for h5py datasets
+            batch_mask = np.asarray(mask[idx])
+            keep = np.any(batch_mask, axis=-1)
+            if not np.any(keep):
+                continue
+            nodes, edges, node_graph, node_slot = prepr.knn_graph(np.asarray(particles[idx])[keep], k, batch_mask[keep])
+            yield (nodes, edges, node_graph, node_slot), nodes
+
+    nodes_spec = tf.TensorSpec(shape=(None, feat_sz), dtype=tf.float32)
+    index_spec = tf.TensorSpec(shape=(None,), dtype=tf.int32)
+    edges_spec = (index_spec, index_spec, tf.TensorSpec(shape=(None,), dtype=tf.float32))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=((nodes_spec, edges_spec, index_spec, index_spec), nodes_spec))
+    return dataset.prefetch(tf.data.AUTOTUNE)
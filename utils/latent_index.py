@@ -0,0 +1,124 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+
+def squared_distances(A, B, B_sq=None):
+    ''' pairwise squared euclidean distances [n_A x n_B] in the matmul form |a|^2 - 2ab + |b|^2 '''
+    A_sq = np.sum(A*A, axis=1, keepdims=True)
+    if B_sq is None:
+        B_sq = np.sum(B*B, axis=1)
+    D = A_sq - 2.*np.matmul(A, B.T) + B_sq[np.newaxis,:]
+    return np.maximum(D, 0.)
+
+
+def _npz_path(path):
+    ''' np.savez appends .npz to the file name : same path for save and load '''
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+def _merge_topk(best_d, best_i, new_d, new_i, k):
+    ''' merge running top-k (smallest) with new candidates, row-wise '''
+    d = np.concatenate([best_d, new_d], axis=1)
+    i = np.concatenate([best_i, new_i], axis=1)
+    if d.shape[1] > k:
+        part = np.argpartition(d, k-1, axis=1)[:,:k]
+        d = np.take_along_axis(d, part, axis=1)
+        i = np.take_along_axis(i, part, axis=1)
+    return d, i
+
+
+class LatentIndex():
+
+    ''' inverted-file (IVF) approximate nearest neighbour index of background latent embeddings
+        fit : k-means coarse quantizer with n_lists centroids, each embedding stored in the list of its closest centroid
+        query : only the n_probe lists closest to the query are searched
+        build and query run in batches on a thread pool (numpy releases the GIL in matmul)
+    '''
+
+    def __init__(self, n_lists=64, n_probe=8, n_threads=None):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_threads = n_threads or os.cpu_count()
+        self.centroids = None
+        self.vectors = None   # embeddings sorted by list
+        self.vectors_sq = None
+        self.offsets = None   # list l occupies vectors[offsets[l]:offsets[l+1]]
+
+    def _map_batches(self, fn, n, batch_size):
+        slices = [slice(s, min(s+batch_size, n)) for s in range(0, n, batch_size)]
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            return list(pool.map(fn, slices))
+
+    def _assign(self, x, batch_size):
+        centroids_sq = np.sum(self.centroids*self.centroids, axis=1)
+        assign = self._map_batches(lambda sl: np.argmin(squared_distances(x[sl], self.centroids, centroids_sq), axis=1), x.shape[0], batch_size)
+        return np.concatenate(assign)
+
+    def fit(self, embeddings, n_iter=10, n_train=100000, batch_size=8192, seed=0):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        n_lists = min(self.n_lists, embeddings.shape[0])
+        train = embeddings[rng.choice(embeddings.shape[0], size=min(n_train, embeddings.shape[0]), replace=False)]
+        self.centroids = train[rng.choice(train.shape[0], size=n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = self._assign(train, batch_size)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=n_lists)
+            filled = counts > 0 # empty lists keep their previous centroid
+            self.centroids[filled] = sums[filled] / counts[filled,np.newaxis]
+        assign = self._assign(embeddings, batch_size)
+        order = np.argsort(assign, kind='stable')
+        self.vectors = embeddings[order]
+        self.vectors_sq = np.sum(self.vectors*self.vectors, axis=1)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return self
+
+    def _query_batch(self, q, k):
+        n_probe = min(self.n_probe, self.centroids.shape[0])
+        probes = np.argpartition(squared_distances(q, self.centroids), n_probe-1, axis=1)[:,:n_probe]
+        best_d = np.full((q.shape[0], k), np.inf, dtype=np.float32)
+        best_i = np.full((q.shape[0], k), -1, dtype=np.int64)
+        # loop over lists, all queries probing a list are handled in one matmul
+        for l in np.unique(probes):
+            start, end = self.offsets[l], self.offsets[l+1]
+            if start == end: continue
+            rows = np.nonzero(np.any(probes == l, axis=1))[0]
+            d = squared_distances(q[rows], self.vectors[start:end], self.vectors_sq[start:end])
+            i = np.broadcast_to(np.arange(start, end), d.shape)
+            best_d[rows], best_i[rows] = _merge_topk(best_d[rows], best_i[rows], d, i, k)
+        order = np.argsort(best_d, axis=1)
+        return np.sqrt(np.take_along_axis(best_d, order, axis=1)), np.take_along_axis(best_i, order, axis=1)
+
+    def query(self, x, k=5, batch_size=4096):
+        ''' returns distances and indices (into self.vectors) of the approx. k nearest neighbours, shape [n x k]
+            when the probed lists hold fewer than k embeddings, the missing neighbours have distance inf and index -1
+        '''
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        results = self._map_batches(lambda sl: self._query_batch(x[sl], k), x.shape[0], batch_size)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def score(self, x, k=5, batch_size=4096):
+        ''' anomaly score : mean distance to the k nearest background embeddings,
+            neighbours missing from the probed lists count as the farthest one found
+        '''
+        dist, _ = self.query(x, k=k, batch_size=batch_size)
+        found = np.isfinite(dist)
+        if not np.all(np.any(found, axis=1)):
+            raise ValueError('LatentIndex.score : no neighbour found for some queries, increase n_probe')
+        farthest = np.max(np.where(found, dist, -np.inf), axis=1, keepdims=True)
+        return np.mean(np.where(found, dist, farthest), axis=1)
+
+    def save(self, path):
+        np.savez(_npz_path(path), centroids=self.centroids, vectors=self.vectors, offsets=self.offsets, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path, n_threads=None):
+        data = np.load(_npz_path(path))
+        index = cls(n_lists=data['centroids'].shape[0], n_probe=int(data['n_probe']), n_threads=n_threads)
+        index.centroids = data['centroids']
+        index.vectors = data['vectors']
+        index.vectors_sq = np.sum(index.vectors*index.vectors, axis=1)
+        index.offsets = data['offsets']
+        return index
@@ -5,6 +5,7 @@ from importlib import reload
 import sys, os
 sys.path.append(os.path.abspath(os.path.join('..')))
 import utils.preprocessing as prepr
+from utils.telemetry import telemetry # ADGVAE_TELEMETRY=1 to record per stage time / memory / cut efficiency
 
 
 #Data Samples
@@ -15,18 +16,19 @@ filename_bg = DATA_PATH + TRAIN_NAME + '_parts/' + TRAIN_NAME + '_000.h5'
 batch_size = 128
 train_set_size = int((5*10e5//batch_size)*batch_size)
 
-nodes_n, feat_sz, particles_bg  = prepr.prepare_data_constituents(filename_bg,train_set_size,0,train_set_size+1)
+nodes_n, feat_sz, particles_bg, mask_bg  = prepr.prepare_data_constituents(filename_bg,train_set_size,0,train_set_size+1,shuffle_constituents=False,return_mask=True) #constituents permuted per epoch in input_pipeline
 
 
 # BG validation
 VALID_NAME = 'qcd_sqrtshatTeV_13TeV_PU40_NEW_EXT_sideband'
 filename_bg_valid = DATA_PATH + VALID_NAME + '_parts/' + VALID_NAME + '_000.h5'
 valid_set_size = int((5*10e4//batch_size)*batch_size)
-_,_, particles_bg_valid = prepr.prepare_data_constituents(filename_bg_valid,valid_set_size,0,valid_set_size+1)
+_,_, particles_bg_valid, mask_bg_valid = prepr.prepare_data_constituents(filename_bg_valid,valid_set_size,0,valid_set_size+1,return_mask=True)
 
 
 #BG test
-_,_, particles_bg_test = prepr.prepare_data_constituents(filename_bg_valid,5000,valid_set_size+1,valid_set_size+5000)
+#jets not shuffled, with the event (row of filename_bg_valid) and jet slot of every jet for event level scores
+_,_, particles_bg_test, mask_bg_test, event_idx_bg_test, jet_slot_bg_test = prepr.prepare_data_constituents(filename_bg_valid,5000,valid_set_size+1,valid_set_size+5000,return_mask=True,return_index=True)
 
 
 output_file = '/eos/user/n/nchernya/MLHEP/AnomalyDetection/ADgvae/input/QCD_training_data_100const_03_08_2021.h5'
@@ -34,4 +36,13 @@ with h5py.File(output_file, 'w')as outFile:
     outFile.create_dataset('particle_bg', data=particles_bg, compression='gzip')
     outFile.create_dataset('particle_bg_valid', data=particles_bg_valid, compression='gzip')
     outFile.create_dataset('particle_bg_test', data=particles_bg_test, compression='gzip')
-
+    # real constituents, taken before normalization (for prepr.knn_graph / input_pipeline.make_knn_graph_dataset)
+    outFile.create_dataset('particle_bg_mask', data=mask_bg, compression='gzip')
+    outFile.create_dataset('particle_bg_valid_mask', data=mask_bg_valid, compression='gzip')
+    outFile.create_dataset('particle_bg_test_mask', data=mask_bg_test, compression='gzip')
+    outFile.create_dataset('particle_bg_test_event_index', data=event_idx_bg_test, compression='gzip')
+    outFile.create_dataset('particle_bg_test_jet_slot', data=jet_slot_bg_test, compression='gzip')
+
+if telemetry.enabled:
+    telemetry.print_report()
+    telemetry.save(output_file.replace('.h5', '_telemetry.json'))
@@ -3,9 +3,12 @@ import numpy as np
 import h5py
 import matplotlib.pyplot as plti
 import sklearn.utils as skutil
+from utils.telemetry import telemetry
+
+LOG_PT_PADDING = -10. # log_transform of the zero pt of padded constituents
 
 def log_transform(x):
-	return np.where(x==0,-10,np.log(x))
+	return np.where(x==0,LOG_PT_PADDING,np.log(x))
 
 def transform_min_max(x):
     return (x-np.min(x))/(np.max(x)-np.min(x))
@@ -18,50 +21,131 @@ def mask_training_cuts(constituents, features):
     ''' get mask for training cuts requiring a jet-pt > 200'''
     jetPt_cut = 200.
     idx_j1Pt, idx_j2Pt = 1, 6
-    mask_j1 = features[:, idx_j1Pt] > jetPt_cut
-    mask_j2 = features[:, idx_j2Pt] > jetPt_cut
-    ''' normalize jet constituents pt to the jet pt'''
-    constituents[:,0,:,2] = np.where(features[:, idx_j1Pt,None]!=0, constituents[:,0,:,2]/features[:, idx_j1Pt,None],0.) #pt is 2nd
-    constituents[:,1,:,2] = np.where(features[:, idx_j2Pt,None]!=0, constituents[:,1,:,2]/features[:, idx_j2Pt,None],0.) #pt is 2nd
+    with telemetry.stage('mask_training_cuts') as stage:
+        mask_j1 = features[:, idx_j1Pt] > jetPt_cut
+        mask_j2 = features[:, idx_j2Pt] > jetPt_cut
+        ''' normalize jet constituents pt to the jet pt'''
+        constituents[:,0,:,2] = np.where(features[:, idx_j1Pt,None]!=0, constituents[:,0,:,2]/features[:, idx_j1Pt,None],0.) #pt is 2nd
+        constituents[:,1,:,2] = np.where(features[:, idx_j2Pt,None]!=0, constituents[:,1,:,2]/features[:, idx_j2Pt,None],0.) #pt is 2nd
+        stage['rows_in'] = 2*features.shape[0] # jets
+        stage['rows_out'] = np.sum(mask_j1) + np.sum(mask_j2)
     ''' log transform pt of constituents'''
-    constituents[:,0,:,2] = log_transform(constituents[:,0,:,2]) 
-    constituents[:,1,:,2] = log_transform(constituents[:,1,:,2]) 
+    with telemetry.stage('log_transform'):
+        constituents[:,0,:,2] = log_transform(constituents[:,0,:,2]) 
+        constituents[:,1,:,2] = log_transform(constituents[:,1,:,2]) 
     return mask_j1, mask_j2
 
-def constituents_to_input_samples(constituents, mask_j1, mask_j2): # -> np.ndarray
-        const_j1 = constituents[:,0,:,:][mask_j1]
-        const_j2 = constituents[:,1,:,:][mask_j2]
-        samples = np.vstack([const_j1, const_j2])
-        np.random.shuffle(samples) #this will only shuffle jets
-        samples = np.array([skutil.shuffle(item) for item in samples]) #this is pretty slow though
+def constituents_to_input_samples(constituents, mask_j1, mask_j2, shuffle_constituents=True): # -> np.ndarray
+        with telemetry.stage('vstack') as stage:
+            const_j1 = constituents[:,0,:,:][mask_j1]
+            const_j2 = constituents[:,1,:,:][mask_j2]
+            samples = np.vstack([const_j1, const_j2])
+            stage['rows_out'] = samples.shape[0]
+        with telemetry.stage('shuffle_jets'):
+            np.random.shuffle(samples) #this will only shuffle jets
+        # shuffle_constituents=False keeps the pt order, constituents are then permuted per epoch in utils/input_pipeline.py
+        if shuffle_constituents:
+            with telemetry.stage('shuffle_constituents'):
+                samples = np.array([skutil.shuffle(item) for item in samples]) #this is pretty slow though
         return samples  
 
-def events_to_input_samples(constituents, features):
+def events_to_input_samples(constituents, features, shuffle_constituents=True):
+    mask_j1, mask_j2 = mask_training_cuts(constituents, features)
+    return constituents_to_input_samples(constituents, mask_j1, mask_j2, shuffle_constituents=shuffle_constituents)
+
+def events_to_indexed_samples(constituents, features, event_offset=0):
+    ''' like events_to_input_samples but keeps the event index and jet slot (0 or 1) of every jet passing the cuts,
+        jets are not shuffled (scoring only) '''
     mask_j1, mask_j2 = mask_training_cuts(constituents, features)
-    return constituents_to_input_samples(constituents, mask_j1, mask_j2)
+    samples = np.vstack([constituents[:,0,:,:][mask_j1], constituents[:,1,:,:][mask_j2]])
+    event_idx = np.concatenate([np.nonzero(mask_j1)[0], np.nonzero(mask_j2)[0]]) + event_offset
+    jet_slot = np.concatenate([np.zeros(np.sum(mask_j1), dtype=np.int8), np.ones(np.sum(mask_j2), dtype=np.int8)])
+    return samples, event_idx, jet_slot
 
 
-def normalize_features(particles):
+def normalize_features(particles, stats=None):
+    ''' stats : FeatureNormalization.stats() to apply fixed statistics (e.g. accumulated over a whole file), computed on particles if None '''
     idx_eta, idx_phi, idx_pt = range(3)
+    if stats is None:
+        stats = FeatureNormalization().update(particles).stats()
     # min-max normalize pt
-    particles[:,:,idx_pt] = transform_min_max(particles[:,:,idx_pt]) 
+    particles[:,:,idx_pt] = (particles[:,:,idx_pt]-stats['pt_min'])/(stats['pt_max']-stats['pt_min'])
     # standard normalize angles
-    particles[:,:,idx_eta] = transform_mean_std(particles[:,:,idx_eta]) 
-    particles[:,:,idx_phi] = transform_mean_std(particles[:,:,idx_phi]) 
+    particles[:,:,idx_eta] = (particles[:,:,idx_eta]-stats['eta_mean'])/(3*stats['eta_std'])
+    particles[:,:,idx_phi] = (particles[:,:,idx_phi]-stats['phi_mean'])/(3*stats['phi_std'])
     return particles
 
 
+class FeatureNormalization():
+
+    ''' statistics of normalize_features (pt min / max, eta and phi mean / std over all constituent slots, as transform_min_max
+        and transform_mean_std) accumulated over blocks of particles, so that every block can be normalized the same way
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.pt_min, self.pt_max = np.inf, -np.inf
+        self.sums = np.zeros(2, dtype=np.float64) # eta, phi
+        self.sums_sq = np.zeros(2, dtype=np.float64)
+
+    def update(self, particles):
+        idx_eta, idx_phi, idx_pt = range(3)
+        if particles.size == 0:
+            return self
+        angles = particles[:,:,[idx_eta, idx_phi]].reshape(-1, 2).astype(np.float64)
+        self.n += angles.shape[0]
+        self.sums += np.sum(angles, axis=0)
+        self.sums_sq += np.sum(np.square(angles), axis=0)
+        self.pt_min = min(self.pt_min, float(np.min(particles[:,:,idx_pt])))
+        self.pt_max = max(self.pt_max, float(np.max(particles[:,:,idx_pt])))
+        return self
+
+    def stats(self):
+        mean = self.sums / self.n
+        std = np.sqrt(np.maximum(self.sums_sq / self.n - np.square(mean), 0.))
+        return dict(pt_min=self.pt_min, pt_max=self.pt_max, eta_mean=mean[0], eta_std=std[0], phi_mean=mean[1], phi_std=std[1])
+
+
 def normalized_adjacency(A):
     D = np.array(np.sum(A, axis=2), dtype=np.float32) # compute outdegree (= rowsum)
     D = np.nan_to_num(np.power(D,-0.5), posinf=0, neginf=0) # normalize (**-(1/2))
     D = np.asarray([np.diagflat(dd) for dd in D]) # and diagonalize
     return np.matmul(D, np.matmul(A, D))
 
-def make_adjacencies(particles):
-    real_p_mask = particles[:,:,0] > 0 # construct mask for real particles
+def real_particles_mask(particles, idx_pt=2):
+    ''' real (non padded) constituents [N x P] of samples after the cuts : padding has log pt exactly LOG_PT_PADDING (log_transform of pt 0)
+        call before normalize_features, which shifts the padding too '''
+    return particles[:,:,idx_pt] != LOG_PT_PADDING
+
+def make_adjacencies(particles, mask=None):
+    real_p_mask = particles[:,:,0] > 0 if mask is None else mask # construct mask for real particles (or real_particles_mask before normalization)
     adjacencies = (real_p_mask[:,:,np.newaxis] * real_p_mask[:,np.newaxis,:]).astype('float32')
     return adjacencies
 
+def knn_graph(particles, k, mask, idx_eta=0, idx_phi=1):
+    ''' graph connecting every constituent to itself and its k nearest eta-phi neighbours, all jets of particles [N x P x C]
+        stored as one disjoint union graph of the real constituents only, so jets keep their own size. mask [N x P] is
+        real_particles_mask of the particles before normalization (normalize_features shifts the padding sentinel)
+        returns nodes [n_nodes x C], edges (senders, receivers, weights) [n_edges], node_graph [n_nodes] jet index, node_slot [n_nodes] index in the jet
+        weights are the symmetric normalization 1/sqrt(deg_i deg_j) as in normalized_adjacency. jets without real constituents get no nodes
+        the neighbour search is brute force, O(P^2) per jet (distances [N x P x P]) : call per batch
+    '''
+    coords = particles[:,:,[idx_eta, idx_phi]].astype(np.float32)
+    r = np.sum(np.square(coords), axis=-1)
+    dist = r[:,:,np.newaxis] - 2*np.matmul(coords, coords.transpose(0,2,1)) + r[:,np.newaxis,:]
+    dist = np.where(mask[:,np.newaxis,:], dist, np.inf)
+    k_self = min(k+1, particles.shape[1])
+    nn_idx = np.argpartition(dist, k_self-1, axis=-1)[:,:,:k_self] # [N x P x k+1], self included (distance 0)
+    valid = mask[:,:,np.newaxis] & np.isfinite(np.take_along_axis(dist, nn_idx, axis=-1))
+    node_id = (np.cumsum(mask.reshape(-1)) - 1).reshape(mask.shape)
+    jet, slot, j = np.nonzero(valid)
+    receivers = node_id[jet, slot].astype(np.int32)
+    senders = node_id[jet, nn_idx[jet, slot, j]].astype(np.int32)
+    node_graph, node_slot = np.nonzero(mask)
+    degree = np.bincount(receivers, minlength=node_graph.shape[0]).astype(np.float32)
+    weights = 1./np.sqrt(degree[receivers]*degree[senders])
+    return particles[mask].astype(np.float32), (senders, receivers, weights), node_graph.astype(np.int32), node_slot.astype(np.int32)
+
 
 def prepare_data(filename,num_instances,start=0,end=-1):
     # set the correct background filename
@@ -84,21 +168,41 @@ def prepare_data(filename,num_instances,start=0,end=-1):
     samples = normalize_features(samples)
     return nodes_n, feat_sz, samples, A, A_tilde
 
-def prepare_data_constituents(filename,num_instances,start=0,end=-1):
-    # set the correct background filename
-    filename = filename
-    data = h5py.File(filename, 'r') 
-    constituents = data['jetConstituentsList'][start:end,]
-    features = data['eventFeatures'][start:end,]
-    #constituents = constituents[:,:,0:50,:] #first select some, as they are ordered in pt, and we shuffle later
-    samples = events_to_input_samples(constituents, features)
-    # The dataset is N_jets x N_constituents x N_features
-    njet     = samples.shape[0]
-    if (njet > num_instances) : samples = samples[:num_instances,:,:]
-    nodes_n = samples.shape[1]
-    feat_sz    = samples.shape[2]
-    print('Number of jets =',njet)
-    print('Number of constituents (nodes) =',nodes_n)
-    print('Number of features =',feat_sz)
-    samples = normalize_features(samples)
-    return nodes_n, feat_sz, samples
+def prepare_data_constituents(filename,num_instances,start=0,end=-1,shuffle_constituents=True,return_mask=False,return_index=False):
+    ''' return_mask=True also returns real_particles_mask [N x P] of the samples, computed before normalization
+        return_index=True does not shuffle the jets and also returns event_idx (row in the file) and jet_slot (0 or 1)
+    '''
+    with telemetry.run(filename, start=start, end=end):
+        # set the correct background filename
+        filename = filename
+        data = h5py.File(filename, 'r') 
+        with telemetry.stage('hdf5_read') as stage:
+            constituents = data['jetConstituentsList'][start:end,]
+            features = data['eventFeatures'][start:end,]
+            stage['bytes_read'] = constituents.nbytes + features.nbytes
+            stage['rows_out'] = features.shape[0] # events
+        #constituents = constituents[:,:,0:50,:] #first select some, as they are ordered in pt, and we shuffle later
+        if return_index:
+            samples, event_idx, jet_slot = events_to_indexed_samples(constituents, features, event_offset=start)
+            if shuffle_constituents:
+                samples = np.array([skutil.shuffle(item) for item in samples])
+        else:
+            samples = events_to_input_samples(constituents, features, shuffle_constituents=shuffle_constituents)
+        # The dataset is N_jets x N_constituents x N_features
+        njet     = samples.shape[0]
+        if (njet > num_instances) : samples = samples[:num_instances,:,:]
+        nodes_n = samples.shape[1]
+        feat_sz    = samples.shape[2]
+        print('Number of jets =',njet)
+        print('Number of constituents (nodes) =',nodes_n)
+        print('Number of features =',feat_sz)
+        mask = real_particles_mask(samples)
+        with telemetry.stage('normalize_features') as stage:
+            samples = normalize_features(samples)
+            stage['rows_out'] = samples.shape[0]
+    outputs = (nodes_n, feat_sz, samples)
+    if return_mask:
+        outputs += (mask,)
+    if return_index:
+        outputs += (event_idx[:num_instances], jet_slot[:num_instances])
+    return outputs
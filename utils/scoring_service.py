@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import socket
+import struct
+import asyncio
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+''' local scoring service : one process keeps the model loaded and serves scores over a Unix socket (or localhost TCP).
+    the protocol is a small length-prefixed binary framing rather than HTTP : a request carries megabytes of float32 particles,
+    sent as raw bytes without an HTTP stack or base64 / json encoding of the arrays on either side.
+    concurrent requests are collected by an asyncio loop into dynamic batches (at most max_batch_size jets, the first
+    request waits at most max_wait_ms for company) that run on one worker thread, so the event loop keeps accepting requests.
+    messages are a 4 byte header length, a json header and a raw float32 payload :
+        {'op': 'score', 'shape': [n, P, F]} + particles  ->  {'shape': [n]} + scores
+        {'op': 'metrics'}                                ->  {'metrics': {...}}
+    a malformed request gets {'error': ...} back, a request of 0 jets an empty result
+'''
+
+_HEADER = struct.Struct('>I')
+
+
+def encode_message(header, payload=None):
+    if payload is not None:
+        header = dict(header, dtype='float32')
+    payload = b'' if payload is None else np.ascontiguousarray(payload, dtype=np.float32).tobytes()
+    header = dict(header, nbytes=len(payload))
+    header_bytes = json.dumps(header).encode()
+    return _HEADER.pack(len(header_bytes)) + header_bytes + payload
+
+
+def decode_payload(header, payload):
+    ''' float32 array of header['shape'] (possibly empty), None for messages without shape '''
+    return np.frombuffer(payload, dtype=np.float32).reshape(header['shape']) if 'shape' in header else None
+
+
+async def read_message(reader):
+    ''' (header, raw payload bytes) from an asyncio stream, None at end of stream. ValueError if the message cannot be framed '''
+    try:
+        size = _HEADER.unpack(await reader.readexactly(_HEADER.size))[0]
+    except asyncio.IncompleteReadError:
+        return None
+    header = json.loads(await reader.readexactly(size))
+    nbytes = header.get('nbytes', 0) if isinstance(header, dict) else None
+    if not isinstance(nbytes, int) or nbytes < 0:
+        raise ValueError('message header must be a json object with nbytes >= 0')
+    return header, await reader.readexactly(nbytes)
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError('scoring service closed the connection')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))[0]
+    header = json.loads(_recv_exactly(sock, size))
+    return header, decode_payload(header, _recv_exactly(sock, header.get('nbytes', 0)))
+
+
+class ServiceMetrics():
+
+    ''' per request latency (queueing + batching + scoring, as seen by the server) and batch fill of the last `window` entries '''
+
+    def __init__(self, max_batch_size, window=10000):
+        self.max_batch_size = max_batch_size
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_jets = collections.deque(maxlen=window)
+        self.batch_requests = collections.deque(maxlen=window)
+        self.n_requests, self.n_jets, self.n_batches = 0, 0, 0
+
+    def record_batch(self, n_jets, n_requests):
+        self.batch_jets.append(n_jets)
+        self.batch_requests.append(n_requests)
+        self.n_batches += 1
+        self.n_jets += n_jets
+
+    def record_request(self, latency):
+        self.latencies.append(latency)
+        self.n_requests += 1
+
+    def summary(self):
+        summary = dict(n_requests=self.n_requests, n_jets=self.n_jets, n_batches=self.n_batches)
+        if self.latencies:
+            latencies = 1e3 * np.asarray(self.latencies)
+            summary.update({'latency_ms_p%d' % q: float(np.percentile(latencies, q)) for q in (50, 90, 99)})
+            summary['latency_ms_mean'] = float(np.mean(latencies))
+        if self.batch_jets:
+            summary['batch_fill_mean'] = float(np.mean(self.batch_jets)) / self.max_batch_size
+            summary['jets_per_batch_mean'] = float(np.mean(self.batch_jets))
+            summary['requests_per_batch_mean'] = float(np.mean(self.batch_requests))
+        return summary
+
+
+class DynamicBatcher():
+
+    ''' collects (particles, future) requests into batches of at most max_batch_size jets, scored by score_fn
+        (particles [N x P x F] -> scores [N]) on a single worker thread. a request larger than max_batch_size is scored alone
+    '''
+
+    def __init__(self, score_fn, max_batch_size=1024, max_wait_ms=5.):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.metrics = ServiceMetrics(max_batch_size)
+        self.queue = asyncio.Queue()
+        self.worker = ThreadPoolExecutor(max_workers=1) # the model is used from one thread only
+        self._pending = None # request taken from the queue that did not fit in the previous batch
+        self._getter = None
+
+    async def score(self, particles):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((particles, future, time.perf_counter()))
+        return await future
+
+    async def _next_request(self, timeout=None):
+        ''' next request, asyncio.TimeoutError after timeout seconds. the queue getter is kept across timeouts
+            (cancelling it could drop a request that just arrived)
+        '''
+        if self._pending is not None:
+            request, self._pending = self._pending, None
+            return request
+        if self._getter is None:
+            if not self.queue.empty():
+                return self.queue.get_nowait()
+            self._getter = asyncio.ensure_future(self.queue.get())
+        done, _ = await asyncio.wait({self._getter}, timeout=timeout)
+        if not done:
+            raise asyncio.TimeoutError()
+        request, self._getter = self._getter.result(), None
+        return request
+
+    async def _collect(self):
+        ''' next batch : first request, then whatever arrives before the deadline or fills the batch '''
+        batch = [await self._next_request()]
+        n_jets = batch[0][0].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while n_jets < self.max_batch_size:
+            try:
+                request = await self._next_request(timeout=max(deadline - time.perf_counter(), 0.))
+            except asyncio.TimeoutError:
+                break
+            if n_jets + request[0].shape[0] > self.max_batch_size:
+                self._pending = request
+                break
+            batch.append(request)
+            n_jets += request[0].shape[0]
+        return batch, n_jets
+
+    async def score_batch(self, batch, n_jets):
+        particles = np.concatenate([request[0] for request in batch]) if len(batch) > 1 else batch[0][0]
+        self.metrics.record_batch(n_jets, len(batch))
+        scores = await asyncio.get_running_loop().run_in_executor(self.worker, self.score_fn, particles)
+        scores = np.asarray(scores, dtype=np.float32)
+        if scores.shape != (n_jets,):
+            raise ValueError('score_fn returned shape {} for {} jets'.format(scores.shape, n_jets))
+        start, now = 0, time.perf_counter()
+        for request, future, t_arrival in batch:
+            n = request.shape[0]
+            if not future.done():
+                future.set_result(scores[start:start+n])
+            self.metrics.record_request(now - t_arrival)
+            start += n
+
+    async def run(self):
+        ''' runs until cancelled, an error while scoring a batch fails the requests of that batch only '''
+        while True:
+            batch, n_jets = await self._collect()
+            try:
+                await self.score_batch(batch, n_jets)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+
+class ScoringServer():
+
+    ''' serves score_fn on a Unix socket (path) or on localhost:port, see the module docstring for the protocol
+        input_shape [P, F] : shape of one jet, score requests of another shape are rejected (any shape if None)
+    '''
+
+    def __init__(self, score_fn, path=None, host='127.0.0.1', port=None, max_batch_size=1024, max_wait_ms=5., input_shape=None):
+        assert (path is None) != (port is None), 'ScoringServer : give either a socket path or a port'
+        self.score_fn = score_fn
+        self.path, self.host, self.port = path, host, port
+        self.max_batch_size, self.max_wait_ms = max_batch_size, max_wait_ms
+        self.input_shape = None if input_shape is None else list(input_shape)
+        self.batcher = None
+
+    def parse_score_request(self, header, payload):
+        ''' particles [n x P x F] of a score request, ValueError if the header does not describe the payload '''
+        shape = header.get('shape')
+        if not isinstance(shape, list) or len(shape) != 3 or not all(isinstance(d, int) and d >= 0 for d in shape):
+            raise ValueError('score request shape must be [n, P, F], got {}'.format(shape))
+        if self.input_shape is not None and shape[1:] != self.input_shape:
+            raise ValueError('score request jets of shape {}, the model expects {}'.format(shape[1:], self.input_shape))
+        if header.get('dtype', 'float32') != 'float32':
+            raise ValueError('score request dtype must be float32, got {}'.format(header.get('dtype')))
+        if len(payload) != 4 * shape[0] * shape[1] * shape[2]:
+            raise ValueError('score request payload of {} bytes for shape {}'.format(len(payload), shape))
+        return decode_payload(header, payload)
+
+    async def score_reply(self, header, payload):
+        try:
+            particles = self.parse_score_request(header, payload)
+            scores = await self.batcher.score(particles) if particles.shape[0] > 0 else np.zeros(0, dtype=np.float32)
+            return encode_message({'shape': list(scores.shape)}, scores)
+        except Exception as error:
+            return encode_message({'error': repr(error)})
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except ValueError as error: # the stream cannot be resynchronized, reply and close
+                    writer.write(encode_message({'error': repr(error)}))
+                    await writer.drain()
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError): # client gone mid-message
+                    break
+                if message is None:
+                    break
+                header, payload = message
+                if header.get('op') == 'score':
+                    writer.write(await self.score_reply(header, payload))
+                elif header.get('op') == 'metrics':
+                    writer.write(encode_message({'metrics': self.batcher.metrics.summary()}))
+                else:
+                    writer.write(encode_message({'error': 'unknown op {}'.format(header.get('op'))}))
+                await writer.drain()
+        except ConnectionError: # client gone before reading its reply
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        ''' runs until cancelled, ready (asyncio.Event or threading.Event) is set once the socket accepts connections '''
+        self.batcher = DynamicBatcher(self.score_fn, self.max_batch_size, self.max_wait_ms)
+        if self.path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=self.path)
+        else:
+            server = await asyncio.start_server(self.handle, host=self.host, port=self.port)
+        batch_task = asyncio.ensure_future(self.batcher.run())
+        serve_task = asyncio.ensure_future(server.serve_forever())
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                # the batcher only stops on an internal error : stop serving then, instead of leaving requests hanging
+                done, _ = await asyncio.wait({serve_task, batch_task}, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        finally:
+            serve_task.cancel()
+            batch_task.cancel()
+            self.batcher.worker.shutdown(wait=False)
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+class ScoringClient():
+
+    ''' blocking client : score(particles [N x P x F]) -> scores [N], metrics() -> server metrics summary '''
+
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+
+    def request(self, header, payload=None):
+        self.sock.sendall(encode_message(header, payload))
+        header, array = recv_message(self.sock)
+        if 'error' in header:
+            raise RuntimeError('scoring service : ' + header['error'])
+        return header, array
+
+    def score(self, particles):
+        particles = np.asarray(particles, dtype=np.float32)
+        return self.request({'op': 'score', 'shape': list(particles.shape)}, particles)[1]
+
+    def metrics(self):
+        return self.request({'op': 'metrics'})[0]['metrics']
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
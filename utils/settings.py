@@ -0,0 +1,41 @@
+''' PNVAE setting of train_AE.py, shared by the scripts and benchmarks that rebuild, retrain or score its checkpoints '''
+
+
+class DotDict:
+    pass
+
+
+def pnvae_setting(nodes_n=100, feat_sz=3, **overrides):
+    ''' setting of train_AE.py for jets of nodes_n constituents with feat_sz features, any attribute can be overridden '''
+    import tensorflow as tf
+    setting = DotDict()
+    # conv_params: list of tuple in the format (K, (C1, C2, C3))
+    setting.conv_params = [
+            (20, [64]),
+            (15, [32]),
+            (7, [12]),
+            ]
+    setting.conv_params_encoder_input = 12
+    setting.conv_params_decoder = [10,8,4]
+    # conv_pooling: 'average' or 'max'
+    setting.conv_pooling = 'average'
+    setting.conv_linking = 'concat' #concat or sum
+    setting.with_bn = True
+    setting.num_points = nodes_n #num of original consituents
+    setting.num_features = feat_sz #num of original features
+    setting.input_shapes = {'points': [nodes_n,feat_sz-1],'features':[nodes_n,feat_sz]}
+    setting.latent_dim = 10
+    setting.ae_type = 'vae'  #ae or vae
+    setting.beta_kl = 10
+    setting.kl_warmup_time = 3
+    setting.activation = tf.keras.layers.LeakyReLU(alpha=0.1)
+    return copy_setting(setting, **overrides)
+
+
+def copy_setting(setting, **overrides):
+    ''' shallow copy of a setting with some attributes replaced '''
+    copied = DotDict()
+    copied.__dict__.update(setting.__dict__)
+    for key, value in overrides.items():
+        setattr(copied, key, value)
+    return copied
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+''' local staging of remote (eos) input files : shards are copied to local disk in the background, reads are served from the
+    local copy while its size and mtime match the remote file, and local copies are evicted least recently used first
+    to stay under a disk quota. set ADGVAE_STAGING_DIR to enable staged() in the scripts
+'''
+
+DEFAULT_QUOTA_GB = float(os.environ.get('ADGVAE_STAGING_QUOTA_GB', 50))
+
+
+def copy_file(src, dst):
+    shutil.copyfile(src, dst)
+
+
+class StagingCache():
+
+    ''' copies of remote files in cache_dir, indexed in cache_dir/index.json (source, size, mtime, last access)
+        copy_fn(src, dst) does the transfer (e.g. a throttled copy standing in for a slow remote mount)
+    '''
+
+    def __init__(self, cache_dir, quota_gb=DEFAULT_QUOTA_GB, n_workers=2, copy_fn=copy_file):
+        self.cache_dir = cache_dir
+        self.quota_bytes = int(quota_gb * 2**30)
+        self.copy_fn = copy_fn
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.entries = self._load_index()
+        self.pending = {} # remote path -> Future of the copy
+        self.lock = threading.RLock() # re-entrant : done callbacks may run in the submitting thread
+        self.pool = ThreadPoolExecutor(max_workers=n_workers)
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evicted': 0, 'bytes_copied': 0}
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            entries = json.load(f)
+        # drop entries whose local copy disappeared or whose copy was interrupted
+        return {remote: e for remote, e in entries.items() if os.path.exists(e['local']) and not e.get('staging')}
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def local_path(self, remote):
+        remote = os.path.abspath(remote)
+        return os.path.join(self.cache_dir, hashlib.sha1(remote.encode()).hexdigest()[:16] + '_' + os.path.basename(remote))
+
+    def used_bytes(self):
+        return sum(e['size'] for e in self.entries.values())
+
+    def is_fresh(self, remote):
+        ''' local copy exists, is not being replaced and size / mtime match the remote file '''
+        entry = self.entries.get(os.path.abspath(remote))
+        if entry is None or entry.get('staging') or not os.path.exists(entry['local']):
+            return False
+        st = os.stat(remote)
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime and os.path.getsize(entry['local']) == st.st_size
+
+    def _evict(self, needed_bytes):
+        ''' remove least recently used copies until needed_bytes fit in the quota (copies in progress are kept) '''
+        for remote, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_access']):
+            if self.used_bytes() + needed_bytes <= self.quota_bytes:
+                break
+            if remote in self.pending:
+                continue
+            if os.path.exists(entry['local']):
+                os.remove(entry['local'])
+            del self.entries[remote]
+            self.stats['evicted'] += 1
+        return self.used_bytes() + needed_bytes <= self.quota_bytes
+
+    def _stage(self, remote):
+        ''' copy remote to the cache (runs in the pool), returns the local path or remote if it does not fit the quota '''
+        st = os.stat(remote)
+        local = self.local_path(remote)
+        with self.lock:
+            self.entries.pop(remote, None)
+            fits = self._evict(st.st_size)
+            if fits: # reserve the space while copying, not fresh until the new copy replaced the old one
+                self.entries[remote] = dict(local=local, size=st.st_size, mtime=st.st_mtime, last_access=time.time(), staging=True)
+        if not fits:
+            return remote
+        tmp_path = local + '.part'
+        try:
+            self.copy_fn(remote, tmp_path)
+            os.replace(tmp_path, local)
+        except Exception:
+            with self.lock:
+                self.entries.pop(remote, None)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            if remote in self.entries:
+                self.entries[remote].pop('staging', None)
+            self.stats['bytes_copied'] += st.st_size
+            self._save_index()
+        return local
+
+    def _submit(self, remote):
+        ''' future of the local copy of remote, a new copy is started only if none is fresh or in progress (call with lock held) '''
+        if remote in self.pending:
+            return self.pending[remote]
+        future = self.pool.submit(self._stage, remote)
+        self.pending[remote] = future
+        future.add_done_callback(lambda f, remote=remote: self._done(remote))
+        return future
+
+    def _done(self, remote):
+        with self.lock:
+            self.pending.pop(remote, None)
+
+    def prefetch(self, remotes):
+        ''' start background copies of the remote files that are not staged yet '''
+        for remote in remotes:
+            remote = os.path.abspath(remote)
+            fresh = self.is_fresh(remote)
+            with self.lock:
+                if not fresh:
+                    self._submit(remote)
+
+    def get(self, remote, prefetch_next=()):
+        ''' local path of remote (waits for its copy if needed), the files in prefetch_next are staged in the background meanwhile '''
+        remote = os.path.abspath(remote)
+        fresh = self.is_fresh(remote)
+        with self.lock:
+            if fresh and remote in self.entries:
+                self.stats['hits'] += 1
+                self.entries[remote]['last_access'] = time.time()
+                local, future = self.entries[remote]['local'], None
+            else:
+                self.stats['stale' if remote in self.entries and remote not in self.pending else 'misses'] += 1
+                future = self._submit(remote)
+        self.prefetch(prefetch_next)
+        if future is None:
+            return local
+        local = future.result()
+        with self.lock:
+            if remote in self.entries:
+                self.entries[remote]['last_access'] = time.time()
+        return local
+
+    def iter_staged(self, remotes, lookahead=1):
+        ''' local paths of remotes in order, the next lookahead files are copied while the current one is used '''
+        remotes = list(remotes)
+        for idx, remote in enumerate(remotes):
+            yield self.get(remote, prefetch_next=remotes[idx+1:idx+1+lookahead])
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            self._save_index()
+
+
+_default_cache = None
+
+
+def default_cache():
+    ''' StagingCache in ADGVAE_STAGING_DIR, None if staging is not enabled '''
+    global _default_cache
+    if _default_cache is None and os.environ.get('ADGVAE_STAGING_DIR'):
+        _default_cache = StagingCache(os.environ['ADGVAE_STAGING_DIR'])
+    return _default_cache
+
+
+def staged(remote, prefetch_next=()):
+    ''' local copy of remote when staging is enabled, remote itself otherwise '''
+    cache = default_cache()
+    return remote if cache is None else cache.get(remote, prefetch_next=prefetch_next)
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+''' stage level telemetry of the preprocessing pipeline : wall time, bytes read, rows in/out and peak (python/numpy) memory
+    delta per stage, grouped in runs (one per prepare_data_constituents call / shard) and aggregated across runs.
+    disabled by default (or ADGVAE_TELEMETRY=1) : stage() then returns a shared no-op context
+'''
+
+STAGE_KEYS = ['rows_in', 'rows_out', 'bytes_read']
+
+
+class _NullStage:
+    ''' no-op stage record used while telemetry is disabled '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class PipelineTelemetry:
+
+    def __init__(self, enabled=False):
+        self.enabled = False
+        self.runs = []
+        self._current = None
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        self.runs, self._current = [], None
+
+    @contextmanager
+    def run(self, label, **info):
+        ''' group the stages recorded inside into one run (e.g. one shard) '''
+        if not self.enabled:
+            yield None
+            return
+        record = dict(label=label, stages=[], **info)
+        previous, self._current = self._current, record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_time_s'] = time.perf_counter() - start
+            self.runs.append(record)
+            self._current = previous
+
+    def stage(self, name):
+        ''' context manager yielding the stage record, the caller can set rows_in, rows_out and bytes_read '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        if self._current is None:
+            self._current = dict(label='default', stages=[])
+            self.runs.append(self._current)
+        record = {'stage': name}
+        mem_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_time_s'] = time.perf_counter() - start
+            record['peak_mem_delta_mb'] = (tracemalloc.get_traced_memory()[1] - mem_start) / 2.**20
+            for key in STAGE_KEYS:
+                if key in record:
+                    record[key] = int(record[key])
+            self._current['stages'].append(record)
+
+    def summary(self):
+        ''' per stage totals across runs, in order of first appearance : wall time, bytes read, rows in/out, cut efficiency, max peak memory delta '''
+        summary = {}
+        for run in self.runs:
+            for record in run['stages']:
+                total = summary.setdefault(record['stage'], dict(calls=0, wall_time_s=0., peak_mem_delta_mb=0.))
+                total['calls'] += 1
+                total['wall_time_s'] += record['wall_time_s']
+                total['peak_mem_delta_mb'] = max(total['peak_mem_delta_mb'], record['peak_mem_delta_mb'])
+                for key in STAGE_KEYS:
+                    if key in record:
+                        total[key] = total.get(key, 0) + record[key]
+        for total in summary.values():
+            if total.get('rows_in'):
+                total['efficiency'] = total.get('rows_out', 0) / total['rows_in']
+        return summary
+
+    def report(self):
+        return {'runs': self.runs, 'summary': self.summary()}
+
+    def print_report(self):
+        total_time = sum(s['wall_time_s'] for s in self.summary().values()) or 1.
+        print('{:>22s} {:>6s} {:>10s} {:>7s} {:>12s} {:>12s} {:>7s} {:>12s}'.format(
+            'stage', 'calls', 'time [s]', '[%]', 'rows in', 'rows out', 'eff', 'peak [MB]'))
+        for name, s in self.summary().items():
+            print('{:>22s} {:>6d} {:>10.3f} {:>7.1f} {:>12s} {:>12s} {:>7s} {:>12.1f}'.format(
+                name, s['calls'], s['wall_time_s'], 100.*s['wall_time_s']/total_time,
+                str(s.get('rows_in', '-')), str(s.get('rows_out', '-')),
+                '{:.3f}'.format(s['efficiency']) if 'efficiency' in s else '-', s['peak_mem_delta_mb']))
+        bytes_read = sum(s.get('bytes_read', 0) for s in self.summary().values())
+        print('{} runs, {:.1f} MB read'.format(len(self.runs), bytes_read / 2.**20))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+
+telemetry = PipelineTelemetry(enabled=os.environ.get('ADGVAE_TELEMETRY', '0') == '1')